@@ -13,6 +13,7 @@ objects=(
   "rabbit-persistentvolumeclaim" \
   "rabbit-service" \
   "runner-worker-deployment" \
+  "runner-worker-rbac" \
   "runner-worker-service"
 )
 
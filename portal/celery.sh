@@ -1,4 +1,10 @@
 #! /bin/bash
 set -e
 
-celery -A jobs worker --loglevel=debug
+# Exactly one worker should also run beat, which drives the periodic tasks
+if [ "${RUNNER_WORKER_BEAT:-off}" == "on" ]; then
+    BEAT=--beat
+fi
+
+# e.g. RUNNER_WORKER_QUEUES=build to dedicate a worker to image builds
+celery -A jobs worker ${BEAT:-} -Q ${RUNNER_WORKER_QUEUES:-celery} --loglevel=debug
@@ -4,7 +4,7 @@ from fsm_admin.mixins import FSMTransitionMixin
 from django_fsm_log.admin import StateLogInline
 
 
-from .models import Job, Comment
+from .models import Job, Comment, CachedImage, RegistryImage, JobPhaseTiming, JobResourceUsage, JobDispatch
 
 
 class CommentsInline(admin.StackedInline):
@@ -13,9 +13,63 @@ class CommentsInline(admin.StackedInline):
     readonly_fields = ['timestamp',]
 
 
+class PhaseTimingsInline(admin.TabularInline):
+    model = JobPhaseTiming
+    extra = 0
+    can_delete = False
+    readonly_fields = ['phase', 'started_at', 'duration',]
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class ResourceUsageInline(admin.TabularInline):
+    model = JobResourceUsage
+    can_delete = False
+    readonly_fields = ['cpu_seconds', 'peak_memory', 'block_read', 'block_written', 'network_received', 'network_sent', 'wall_seconds', 'samples',]
+    exclude = ['recorded_at',]
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class RunsInline(admin.TabularInline):
+    model = Job
+    fk_name = 'parent'
+    verbose_name = 'Run'
+    extra = 0
+    can_delete = False
+    fields = ['run_index', 'parameters', 'stage', 'status', 'failed', 'runner_node',]
+    readonly_fields = fields
+    show_change_link = True
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Job)
 class JobAdmin(FSMTransitionMixin, admin.ModelAdmin):
     fsm_field = ['status',]
-    inlines = [StateLogInline, CommentsInline,]
-    readonly_fields = ['status','submitted_at',]
-    exclude = ['file','output',]
+    inlines = [StateLogInline, PhaseTimingsInline, ResourceUsageInline, RunsInline, CommentsInline,]
+    readonly_fields = ['status','submitted_at','dispatched_at','runner_node','image_id','container_id','run_task_id','deadline','heartbeat_at','parent','run_index','parameters','stage',]
+    exclude = ['file','output','build_log','artifacts',]
+
+
+@admin.register(CachedImage)
+class CachedImageAdmin(admin.ModelAdmin):
+    list_display = ['digest', 'node', 'image_id', 'size', 'hits', 'misses', 'last_used_at',]
+    list_filter = ['node',]
+    readonly_fields = ['node', 'digest', 'image_id', 'size', 'hits', 'misses', 'created_at', 'last_used_at',]
+
+
+@admin.register(RegistryImage)
+class RegistryImageAdmin(admin.ModelAdmin):
+    list_display = ['digest', 'size', 'pulls', 'pushed_at', 'last_used_at',]
+    readonly_fields = ['digest', 'manifest_digest', 'size', 'pulls', 'pushed_at', 'last_used_at',]
+
+
+@admin.register(JobDispatch)
+class JobDispatchAdmin(admin.ModelAdmin):
+    list_display = ['id', 'task', 'job', 'created_at', 'published_at', 'attempts',]
+    list_filter = ['task',]
+    readonly_fields = ['task', 'job', 'created_at', 'published_at', 'attempts', 'last_error',]
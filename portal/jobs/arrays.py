@@ -0,0 +1,151 @@
+import gzip
+import json
+import time
+import tarfile
+import itertools
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Job, private_storage
+
+
+# Runs that are over, one way or another
+FINISHED = (
+    Job.Status.RUN_ERROR, Job.Status.CANCELLED, Job.Status.PENDING_OUTPUT_REVIEW,
+    Job.Status.OUTPUT_REJECTED, Job.Status.RELEASED,
+)
+
+
+def parse_grid(text):
+    """
+    Return the parameter grid in a JSON object of environment variable names
+    mapped to lists of values, as an OrderedDict of lists of strings. Raises
+    ValueError if it is not one, or has more than JOB_ARRAY_MAX_RUNS combinations.
+    """
+    try:
+        grid = json.loads(text, object_pairs_hook=OrderedDict)
+    except ValueError:
+        raise ValueError('The parameter grid is not valid JSON')
+    if not isinstance(grid, dict) or not grid:
+        raise ValueError('The parameter grid must be an object of environment variable names mapped to lists of values')
+    for name, values in grid.items():
+        if not name.isidentifier():
+            raise ValueError(f'{name!r} is not a valid environment variable name')
+        if name in settings.JOB_ENV_DICT:
+            raise ValueError(f'{name} is set for every job and cannot be overridden')
+        if not isinstance(values, list) or not values:
+            raise ValueError(f'{name} must be a non-empty list of values')
+        if any(isinstance(value, (dict, list)) or value is None for value in values):
+            raise ValueError(f'The values of {name} must be strings, numbers or booleans')
+        grid[name] = [value if isinstance(value, str) else json.dumps(value) for value in values]
+    runs = 1
+    for values in grid.values():
+        runs *= len(values)
+    if settings.JOB_ARRAY_MAX_RUNS and runs > settings.JOB_ARRAY_MAX_RUNS:
+        raise ValueError(f'The parameter grid has {runs} combinations, at most {settings.JOB_ARRAY_MAX_RUNS} are allowed')
+    return grid
+
+def expand(grid):
+    """Return the parameters of every run of a grid, as dicts, the last variable changing fastest"""
+    return [OrderedDict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+def create_runs(job):
+    """Create a QUEUED run of an approved array job for every combination of its parameter grid"""
+    for index, parameters in enumerate(expand(parse_grid(job.parameter_grid))):
+        Job.objects.create(
+            name=job.name,
+            description=job.description,
+            status=Job.Status.QUEUED.name,
+            owner=job.owner,
+            filename=job.filename,
+            # The runs share the submission file, so they share its image too
+            file=job.file.name,
+            cpus=job.cpus,
+            memory_mb=job.memory_mb,
+            timeout=job.timeout,
+            run_after=job.run_after,
+            off_peak=job.off_peak,
+            parent=job,
+            run_index=index,
+            parameters=json.dumps(parameters),
+        )
+
+def run_started(run):
+    """Mark the array job or pipeline RUNNING when its first run or stage starts"""
+    with transaction.atomic():
+        job = Job.objects.select_for_update().get(pk=run.parent_id)
+        if job.status_enum is Job.Status.QUEUED:
+            job.run_job()
+            job.save()
+
+def collect(run):
+    """
+    Once every run of the array job has finished, gather their output, errors
+    and artifacts into the array job's and complete it, failed if any run
+    failed, or cancel it if none ever started. Returns whether it did.
+    """
+    with transaction.atomic():
+        # The row lock keeps the last two runs to finish from both collecting
+        job = Job.objects.select_for_update().get(pk=run.parent_id)
+        if job.status_enum not in (Job.Status.QUEUED, Job.Status.RUNNING, Job.Status.CANCELLED) or job.output.name:
+            return False
+        runs = list(job.runs.order_by('run_index'))
+        if not all(finished(run) for run in runs):
+            return False
+        output = _concatenate(job, runs, 'output', 'out')
+        errors = _concatenate(job, runs, 'errors', 'err')
+        artifacts = _bundle_artifacts(job, runs)
+        if job.status_enum is Job.Status.QUEUED:
+            # Every run was cancelled before one started
+            job.cancel()
+        if job.status_enum is Job.Status.CANCELLED:
+            job.set_run_files(output, errors, artifacts)
+        elif any(run.failed or run.status_enum is not Job.Status.PENDING_OUTPUT_REVIEW for run in runs):
+            job.fail_job_run(output, errors, artifacts)
+        else:
+            job.complete_job_run(output, errors, artifacts)
+        job.save()
+    return True
+
+def finished(run):
+    """Whether a run is over and its output collected"""
+    # A cancelled run's container may still be stopping, its output is only
+    # complete once it has been collected
+    return run.status_enum in FINISHED and not (run.status_enum is Job.Status.CANCELLED and run.container_id)
+
+def _header(run):
+    failed = ', failed' if run.failed else ''
+    return f'==> Run {run.run_index}: {run.parameters_label()} ({run.status_enum.value["label"]}{failed}) <==\n'.encode('utf8')
+
+def _concatenate(job, runs, field, stream):
+    """Write the runs' files of a log field one after the other, each under a header, and return the storage name"""
+    name = private_storage.get_available_name(f'{job.id}-{int(time.time())}.{stream}')
+    with private_storage.open(name, 'wb') as combined:
+        for run in runs:
+            combined.write(_header(run))
+            run_file = getattr(run, field)
+            if run_file.name:
+                with run_file.storage.open(run_file.name, 'rb') as run_log:
+                    for chunk in iter(lambda: run_log.read(settings.JOB_FILE_CHUNK_SIZE), b''):
+                        combined.write(chunk)
+    return name
+
+def _bundle_artifacts(job, runs):
+    """Write a gzipped tar of each run's artifacts, as run-<index>.tar.gz, and return its storage name, None if no run has any"""
+    runs = [run for run in runs if run.artifacts.name]
+    if not runs:
+        return None
+    name = private_storage.get_available_name(f'{job.id}-{int(time.time())}.tar.gz')
+    with private_storage.open(name, 'wb') as bundle_file:
+        # The runs' archives are compressed already
+        with gzip.GzipFile(fileobj=bundle_file, mode='wb', compresslevel=1) as compressed:
+            with tarfile.open(fileobj=compressed, mode='w|') as bundle:
+                for run in runs:
+                    member = tarfile.TarInfo(f'run-{run.run_index}.tar.gz')
+                    member.size = private_storage.size(run.artifacts.name)
+                    member.mtime = time.time()
+                    with private_storage.open(run.artifacts.name, 'rb') as artifacts:
+                        bundle.addfile(member, artifacts)
+    return name
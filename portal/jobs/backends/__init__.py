@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .base import ExecutionBackend
+
+
+_backends = {}
+
+
+def get_backend():
+    """Return the JOB_EXECUTION_BACKEND instance of this process"""
+    path = settings.JOB_EXECUTION_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
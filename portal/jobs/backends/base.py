@@ -0,0 +1,96 @@
+import tarfile
+from pathlib import PurePosixPath
+
+from django.conf import settings
+
+
+class ExecutionBackend:
+    """
+    Builds and runs jobs for the celery stages in jobs.celery, which own the
+    job's workflow state, logs, timeouts and storage. A job's "container" is
+    whatever the backend runs it as; its ID is kept in job.container_id and
+    the node it runs on in job.runner_node. Every method may be called from a
+    different worker process than the previous one.
+    """
+
+    def capacity(self):
+        """Return the (CPUs, bytes of memory) jobs may use in total"""
+        raise NotImplementedError
+
+    def place(self, job):
+        """Return the node the job should build and run on"""
+        raise NotImplementedError
+
+    def build(self, job, job_file):
+        """Build the job's submission file on job.runner_node and return an image ID to start it from"""
+        raise NotImplementedError
+
+    def start(self, job, image_id):
+        """
+        Start the job's container and return its ID. If job.container_id is
+        still there, return it instead, so retried runs reattach to it.
+        """
+        raise NotImplementedError
+
+    def attach(self, job):
+        """Yield the container's (stdout, stderr) output, from the start, until it exits"""
+        raise NotImplementedError
+
+    def stats(self, job):
+        """
+        Yield the running container's usage so far, about once a second, as
+        dicts of jobs.usage.FIELDS. Backends that cannot tell yield nothing.
+        """
+        return iter(())
+
+    def wait(self, job):
+        """Wait for the container to exit and return its exit code"""
+        raise NotImplementedError
+
+    def archive_volume(self, job, fileobj):
+        """Write the job's volume to fileobj as an uncompressed tar; return False if there is none"""
+        raise NotImplementedError
+
+    def stop(self, job):
+        """Stop the container, leaving it to be collected"""
+        raise NotImplementedError
+
+    def remove(self, job):
+        """Remove the stopped container and anything else left of the run"""
+        raise NotImplementedError
+
+    def find(self, job):
+        """Return the ID of the job's container if it still exists, running or not, else None"""
+        raise NotImplementedError
+
+
+def open_job_tar(job_file, mode='r|gz'):
+    # Stream mode reads the archive in JOB_FILE_CHUNK_SIZE blocks, so the
+    # whole tarball is never held in memory
+    return tarfile.open(fileobj=job_file, mode=mode, bufsize=settings.JOB_FILE_CHUNK_SIZE)
+
+def find_dockerfile_dir(job_file, stage=''):
+    """
+    Return the archive directory holding the Dockerfile: '' for the root, else a
+    top-level directory name. A pipeline stage's is the directory named after it.
+    """
+    top_level_dirs = []
+    with open_job_tar(job_file) as job_tar:
+        for member in job_tar:
+            parts = PurePosixPath(member.name).parts
+            if not member.isfile() or not parts or parts[-1] != 'Dockerfile':
+                continue
+            if stage:
+                if parts == (stage, 'Dockerfile'):
+                    return stage
+                continue
+            if len(parts) == 1:
+                return ''
+            if len(parts) == 2:
+                top_level_dirs.append(parts[0])
+    if stage:
+        raise FileNotFoundError(f'No Dockerfile found in the {stage} directory of the job file')
+    # If there's no Dockerfile at the root, look for it in a top-level directory
+    if not top_level_dirs:
+        raise FileNotFoundError('No Dockerfile found in the job file')
+    return top_level_dirs[0]
@@ -0,0 +1,251 @@
+import os
+import re
+import time
+import threading
+from pathlib import PurePosixPath
+
+from django.conf import settings
+
+import docker
+
+from ..logs import BuildLogWriter
+from .. import image_cache
+from .. import package_cache
+from .. import registry
+from .. import runner
+from .. import scheduler
+from .. import timings
+from .base import ExecutionBackend, open_job_tar, find_dockerfile_dir
+
+
+# The CFS period docker uses when none is given, in microseconds
+DEFAULT_CPU_PERIOD = 100000
+
+
+class DockerBackend(ExecutionBackend):
+    """
+    Runs jobs as containers on the least loaded of RUNNER_DOCKER_HOSTS, on
+    job-network with the JOB_CONTAINER_* limits. Images are cached per daemon
+    by the digest of the submission file, and shared between daemons through
+    JOB_IMAGE_REGISTRY when one is set.
+    """
+
+    def capacity(self):
+        return runner.cluster_capacity()
+
+    def place(self, job):
+        return runner.choose_docker_host(scheduler.job_reservation(job), job.id)
+
+    def build(self, job, job_file):
+        docker_client = runner.get_docker_client(job.runner_node)
+        return _get_image(job_file, docker_client, job.runner_node, job).id
+
+    def start(self, job, image_id):
+        docker_client = runner.get_docker_client(job.runner_node)
+        return _start_container(job, image_id, docker_client).id
+
+    def attach(self, job):
+        # A single demultiplexed attach replays what the container printed so far
+        # and follows it until exit
+        docker_client = runner.get_docker_client(job.runner_node)
+        return docker_client.api.attach(job.container_id, stream=True, logs=True, demux=True)
+
+    def stats(self, job):
+        for stats in self._container(job).stats(stream=True, decode=True):
+            yield _usage(stats)
+
+    def wait(self, job):
+        return self._container(job).wait()['StatusCode']
+
+    def archive_volume(self, job, fileobj):
+        try:
+            chunks, stat = self._container(job).get_archive(settings.JOB_CONTAINER_VOLUME_MOUNT, chunk_size=settings.JOB_FILE_CHUNK_SIZE)
+        except docker.errors.NotFound:
+            return False
+        for chunk in chunks:
+            fileobj.write(chunk)
+        return True
+
+    def stop(self, job):
+        try:
+            self._container(job).stop(timeout=settings.JOB_STOP_TIMEOUT)
+        except docker.errors.NotFound:
+            pass
+
+    def remove(self, job):
+        try:
+            self._container(job).remove()
+        except docker.errors.NotFound:
+            pass
+
+    def find(self, job):
+        docker_client = runner.get_docker_client(job.runner_node)
+        containers = docker_client.containers.list(all=True, filters={'label': f'{runner.JOB_LABEL}={job.id}'})
+        return containers[0].id if containers else None
+
+    def _container(self, job):
+        return runner.get_docker_client(job.runner_node).containers.get(job.container_id)
+
+
+def _repack_job_dir(job_file, job_dir, context):
+    """Write the members under job_dir to context as an uncompressed tar rooted at job_dir"""
+    with open_job_tar(job_file) as job_tar, open_job_tar(context, 'w|') as context_tar:
+        for member in job_tar:
+            parts = PurePosixPath(member.name).parts
+            if len(parts) < 2 or parts[0] != job_dir:
+                continue
+            member.name = str(PurePosixPath(*parts[1:]))
+            if member.islnk():
+                member.linkname = str(PurePosixPath(*PurePosixPath(member.linkname).parts[1:]))
+            context_tar.addfile(member, job_tar.extractfile(member) if member.isfile() else None)
+
+def _stream_repacked(job_file, job_dir):
+    """
+    Yield _repack_job_dir's tar in JOB_FILE_CHUNK_SIZE chunks as it is written,
+    through a pipe from a thread, so the context is never held in memory nor
+    written to disk
+    """
+    read_fd, write_fd = os.pipe()
+    failures = []
+    def repack():
+        try:
+            with open(write_fd, 'wb') as pipe:
+                _repack_job_dir(job_file, job_dir, pipe)
+        except Exception as ex:
+            # A broken pipe when the upload was abandoned
+            failures.append(ex)
+    thread = threading.Thread(target=repack, daemon=True)
+    thread.start()
+    try:
+        with open(read_fd, 'rb') as pipe:
+            yield from iter(lambda: pipe.read(settings.JOB_FILE_CHUNK_SIZE), b'')
+    finally:
+        thread.join()
+    if failures:
+        raise failures[0]
+
+def _build_image(job_file, docker_client, job=None):
+    # The archive is sent to the daemon as the build context without being
+    # extracted on the worker, so its member paths never touch our filesystem
+    with timings.phase(job, 'extract'):
+        job_dir = find_dockerfile_dir(job_file, job.stage if job else '')
+        job_file.seek(0)
+    if job_dir:
+        # The Dockerfile expects its own directory as the context root, so
+        # strip that prefix from the member names while uploading it
+        context, encoding = _stream_repacked(job_file, job_dir), None
+    else:
+        context, encoding = job_file, 'gzip'
+    with timings.phase(job, 'build'):
+        # The log is written out as the daemon streams it, so a long build can
+        # be followed, and a failed one keeps what the submitter needs to see
+        log_writer = BuildLogWriter(f'{job.id}-{int(time.time())}', job) if job else None
+        try:
+            return _stream_build(
+                docker_client, log_writer,
+                fileobj=context, custom_context=True, encoding=encoding, rm=True,
+                buildargs=package_cache.build_args())
+        except docker.errors.BuildError:
+            raise
+        except docker.errors.APIError as ex:
+            print(ex)
+            raise ex
+        finally:
+            if log_writer is not None:
+                log_writer.close()
+
+def _stream_build(docker_client, log_writer, **kwargs):
+    """Build through the low-level API, writing each log chunk as it arrives, and return the image"""
+    image_id, last_chunk = None, None
+    for chunk in docker_client.api.build(decode=True, **kwargs):
+        if log_writer is not None:
+            log_writer.write_chunks([chunk])
+        if 'error' in chunk:
+            raise docker.errors.BuildError(chunk['error'], [chunk])
+        if 'ID' in chunk.get('aux', {}):
+            image_id = chunk['aux']['ID']
+        match = re.search(r'(^Successfully built |sha256:)([0-9a-f]+)$', chunk.get('stream', ''))
+        if match:
+            image_id = match.group(2)
+        last_chunk = chunk
+    if image_id is None:
+        raise docker.errors.BuildError(last_chunk or 'Unknown', [])
+    return docker_client.images.get(image_id)
+
+def _get_image(job_file, docker_client, node, job=None):
+    # Resubmissions of an identical file reuse the image built the first time,
+    # from this daemon's cache or else from the shared registry
+    digest = image_cache.file_digest(job_file, job.stage if job else '')
+    image = image_cache.get_image(docker_client, node, digest)
+    if image is not None:
+        if settings.JOB_IMAGE_REGISTRY:
+            registry.touch_image(digest)
+        return image
+    if settings.JOB_IMAGE_REGISTRY:
+        with timings.phase(job, 'pull'):
+            image = registry.pull_image(docker_client, digest)
+    built = image is None
+    if built:
+        image = _build_image(job_file, docker_client, job)
+    image_cache.add_image(docker_client, node, digest, image)
+    if built and settings.JOB_IMAGE_REGISTRY:
+        with timings.phase(job, 'push'):
+            registry.push_image(docker_client, image, digest)
+    return image
+
+def _usage(stats):
+    """Return the cumulative usage figures in a sample of the Docker stats stream"""
+    memory = stats.get('memory_stats') or {}
+    blkio = (stats.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+    networks = (stats.get('networks') or {}).values()
+    return {
+        'cpu_seconds': ((stats.get('cpu_stats') or {}).get('cpu_usage') or {}).get('total_usage', 0) / 1e9,
+        # max_usage is the cgroup's own high-water mark, which catches spikes between samples
+        'peak_memory': max(memory.get('max_usage', 0), memory.get('usage', 0)),
+        'block_read': sum(entry['value'] for entry in blkio if entry['op'].lower() == 'read'),
+        'block_written': sum(entry['value'] for entry in blkio if entry['op'].lower() == 'write'),
+        'network_received': sum(network['rx_bytes'] for network in networks),
+        'network_sent': sum(network['tx_bytes'] for network in networks),
+    }
+
+def _start_container(job, image_id, docker_client):
+    # A retried or reconciled run reattaches to the container started before
+    if job.container_id:
+        try:
+            return docker_client.containers.get(job.container_id)
+        except docker.errors.NotFound:
+            pass
+    if image_id is None:
+        # Reconciled, but the container has gone since
+        raise RuntimeError(f'The container of job {job.id} is gone')
+    volume_host_path = job.volume_path()
+    return docker_client.containers.run(
+        image_id,
+        detach=True,
+        network='job-network',
+        labels={runner.JOB_LABEL: str(job.id)},
+        volumes={volume_host_path: {'bind': settings.JOB_CONTAINER_VOLUME_MOUNT, 'mode': 'rw'}},
+        environment=job.environment(),
+        **_container_limits(job)
+    )
+
+def _container_limits(job):
+    """The CPU and memory limits of the job's container: what was approved for it, else the JOB_CONTAINER_* ones"""
+    limits = {
+        'cpu_period': settings.JOB_CONTAINER_CPU_PERIOD,
+        'cpu_quota': settings.JOB_CONTAINER_CPU_QUOTA,
+        'mem_limit': settings.JOB_CONTAINER_MEM_LIMIT,
+        'memswap_limit': settings.JOB_CONTAINER_MEMSWAP_LIMIT,
+    }
+    cpus, memory = scheduler.job_reservation(job)
+    if job.cpus:
+        limits['cpu_period'] = settings.JOB_CONTAINER_CPU_PERIOD or DEFAULT_CPU_PERIOD
+        limits['cpu_quota'] = int(cpus * limits['cpu_period'])
+    if job.memory_mb:
+        limits['mem_limit'] = memory
+        memswap_limit = settings.JOB_CONTAINER_MEMSWAP_LIMIT
+        if memswap_limit and str(memswap_limit) != '-1':
+            # Keep the swap the default limits allow on top of the memory
+            swap = docker.utils.parse_bytes(memswap_limit) - docker.utils.parse_bytes(settings.JOB_CONTAINER_MEM_LIMIT or 0)
+            limits['memswap_limit'] = memory + max(swap, 0)
+    return limits
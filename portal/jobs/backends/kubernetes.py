@@ -0,0 +1,389 @@
+import os
+import time
+import signal
+import socket
+import tarfile
+import ipaddress
+from pathlib import PurePosixPath
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import requests
+
+from ..logs import BuildLogWriter
+from .. import image_cache
+from .. import registry
+from .. import runner
+from .. import scheduler
+from .. import timings
+from .base import ExecutionBackend, find_dockerfile_dir
+
+
+# The NetworkPolicies whitelisting the egress of the job and build pods
+NETWORK_POLICY_NAMES = {'job': 'privascope-jobs', 'build': 'privascope-builds'}
+# Seconds a finished build Job is kept if its worker died before deleting it
+BUILD_JOB_TTL = 60 * 60
+# Where a build pod finds the job's submission, the only file it mounts
+BUILD_CONTEXT = '/workspace/context.tar.gz'
+ROLE_LABEL = 'privascope.role'
+# Reasons a container waits for an image it will never get
+IMAGE_WAITING_REASONS = ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName')
+QUANTITY_SUFFIXES = {
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+    'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+}
+
+
+class KubernetesError(Exception):
+    pass
+
+
+class KubernetesBackend(ExecutionBackend):
+    """
+    Runs jobs as Kubernetes Jobs in KUBERNETES_NAMESPACE, with the JOB_CONTAINER_*
+    limits as their pods' CPU and memory requests, so the cluster's scheduler
+    places them on whichever node has room.
+
+    Images are built by a kaniko Job straight from the submission file on the
+    KUBERNETES_JOB_FILES_CLAIM volume and pushed to JOB_IMAGE_REGISTRY (or else
+    KUBERNETES_IMAGE_REPOSITORY), tagged with the file's digest. Images already
+    in JOB_IMAGE_REGISTRY are not built again. The job's volume is its
+    PRIVATE_JOB_OUTPUT_ROOT/<username>/<job id> directory on that same claim,
+    which workers mount at KUBERNETES_JOB_FILES_MOUNT.
+
+    Job pods may only reach KUBERNETES_JOB_EGRESS_CIDRS (and DNS), like the
+    job-network whitelist of the Docker daemons, and build pods only the
+    registry and KUBERNETES_BUILD_EGRESS_CIDRS. Kubernetes interleaves a pod's
+    stdout and stderr into one log, so all of a job's output ends up in its
+    output file.
+    """
+
+    def __init__(self):
+        # A bare repository name would be pushed to Docker Hub
+        if not settings.JOB_IMAGE_REGISTRY and not settings.KUBERNETES_IMAGE_REPOSITORY:
+            raise ImproperlyConfigured('The Kubernetes backend needs JOB_IMAGE_REGISTRY or KUBERNETES_IMAGE_REPOSITORY to push images to')
+        self.session = requests.Session()
+        self.network_policies_applied = set()
+
+    def capacity(self):
+        cpus = memory = 0
+        for node in self._get('/api/v1/nodes', params=_selector_params(settings.KUBERNETES_NODE_SELECTOR))['items']:
+            if node['spec'].get('unschedulable') or not _node_ready(node):
+                continue
+            allocatable = node['status']['allocatable']
+            cpus += parse_quantity(allocatable['cpu'])
+            memory += parse_quantity(allocatable['memory'])
+        return cpus, int(memory)
+
+    def place(self, job):
+        # The cluster's scheduler picks the node
+        return f'kubernetes:{settings.KUBERNETES_NAMESPACE}'
+
+    def build(self, job, job_file):
+        with timings.phase(job, 'extract'):
+            job_dir = find_dockerfile_dir(job_file, job.stage)
+        digest = image_cache.file_digest(job_file, job.stage)
+        if settings.JOB_IMAGE_REGISTRY:
+            image = f'{registry.repository()}:{digest}'
+            if registry.touch_image(digest):
+                return image
+        else:
+            image = f'{settings.KUBERNETES_IMAGE_REPOSITORY}:{digest}'
+        args = [
+            f'--context=tar://{BUILD_CONTEXT}',
+            f'--destination={image}',
+            '--cache=true',
+        ]
+        if job_dir:
+            args.append(f'--context-sub-path={job_dir}')
+        # The Dockerfile's RUN steps run in the build pod, so it only gets the
+        # job's own submission off the claim, and only reaches the registry
+        self._apply_network_policy('build')
+        name = self._create_job(job, 'build', {
+            'name': 'build',
+            'image': settings.KUBERNETES_BUILD_IMAGE,
+            'args': args,
+            'volumeMounts': [{
+                'name': 'job-files',
+                'mountPath': BUILD_CONTEXT,
+                'subPath': _claim_path(job.file.path),
+                'readOnly': True,
+            }] + (
+                [{'name': 'registry', 'mountPath': '/kaniko/.docker', 'readOnly': True}]
+                if settings.KUBERNETES_REGISTRY_SECRET else []
+            ),
+        })
+        log_writer = BuildLogWriter(f'{job.id}-{int(time.time())}', job)
+        with timings.phase(job, 'build'):
+            try:
+                for chunk in self._follow_log(name, 'build'):
+                    log_writer.write('build', chunk)
+                exit_code = self._exit_code(name)
+            finally:
+                log_writer.close()
+                self._delete_job(name)
+        if exit_code != 0:
+            raise KubernetesError(f'Building the image of job {job.id} failed with exit code {exit_code}')
+        if settings.JOB_IMAGE_REGISTRY:
+            registry.add_image(digest)
+        return image
+
+    def start(self, job, image_id):
+        if job.container_id and self.find(job) == job.container_id:
+            return job.container_id
+        if image_id is None:
+            raise RuntimeError(f'The Kubernetes Job of job {job.id} is gone')
+        self._apply_network_policy('job')
+        volume_path = job.volume_path()
+        os.makedirs(volume_path, exist_ok=True)
+        cpus, memory = scheduler.job_reservation(job)
+        resources = {'cpu': f'{int(cpus * 1000)}m'}
+        if memory:
+            resources['memory'] = str(memory)
+        return self._create_job(job, 'job', {
+            'name': 'job',
+            'image': image_id,
+            'env': [{'name': key, 'value': value} for key, value in job.environment().items()],
+            'resources': {'requests': resources, 'limits': resources},
+            'volumeMounts': [{
+                'name': 'job-files',
+                'mountPath': settings.JOB_CONTAINER_VOLUME_MOUNT,
+                'subPath': _claim_path(volume_path),
+            }],
+        })
+
+    def attach(self, job):
+        # Docker attach demultiplexes, here both streams arrive as one
+        for chunk in self._follow_log(job.container_id, 'job'):
+            yield chunk, None
+
+    def wait(self, job):
+        return self._exit_code(job.container_id)
+
+    def archive_volume(self, job, fileobj):
+        volume = job.volume_path()
+        if not os.path.isdir(volume):
+            return False
+        with tarfile.open(fileobj=fileobj, mode='w|') as volume_tar:
+            volume_tar.add(volume, arcname=PurePosixPath(settings.JOB_CONTAINER_VOLUME_MOUNT).name)
+        return True
+
+    def stop(self, job):
+        # Past its deadline the Job controller terminates the pod, giving it its
+        # terminationGracePeriodSeconds, and does not start another
+        response = self._request(
+            'PATCH', self._jobs_path(job.container_id),
+            json={'spec': {'activeDeadlineSeconds': 1}},
+            headers={'Content-Type': 'application/merge-patch+json'},
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def remove(self, job):
+        self._delete_job(job.container_id)
+
+    def find(self, job):
+        # Not the job's build Job, which has the same job label
+        jobs = self._get(self._jobs_path(), params=_selector_params({runner.JOB_LABEL: job.id, ROLE_LABEL: 'job'}))['items']
+        return jobs[0]['metadata']['name'] if jobs else None
+
+    def _request(self, method, path, stream=False, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if os.path.exists(settings.KUBERNETES_TOKEN_FILE):
+            # Read every time, the kubelet rotates it
+            with open(settings.KUBERNETES_TOKEN_FILE) as token_file:
+                headers['Authorization'] = f'Bearer {token_file.read().strip()}'
+        verify = settings.KUBERNETES_CA_FILE if os.path.exists(settings.KUBERNETES_CA_FILE) else True
+        return self.session.request(
+            method, settings.KUBERNETES_API_URL.rstrip('/') + path,
+            headers=headers, verify=verify, stream=stream,
+            timeout=None if stream else settings.KUBERNETES_API_TIMEOUT, **kwargs
+        )
+
+    def _get(self, path, **kwargs):
+        response = self._request('GET', path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def _jobs_path(self, name=''):
+        return f'/apis/batch/v1/namespaces/{settings.KUBERNETES_NAMESPACE}/jobs/{name}'.rstrip('/')
+
+    def _pods_path(self, name=''):
+        return f'/api/v1/namespaces/{settings.KUBERNETES_NAMESPACE}/pods/{name}'.rstrip('/')
+
+    def _create_job(self, job, role, container):
+        """Create a Kubernetes Job running container for the job in the given role and return its name"""
+        name = f'privascope-{role}-{job.id}-{int(time.time())}'
+        volumes = [{'name': 'job-files', 'persistentVolumeClaim': {'claimName': settings.KUBERNETES_JOB_FILES_CLAIM}}]
+        pod_spec = {
+            'restartPolicy': 'Never',
+            'automountServiceAccountToken': False,
+            'enableServiceLinks': False,
+            'terminationGracePeriodSeconds': settings.JOB_STOP_TIMEOUT,
+            'nodeSelector': settings.KUBERNETES_NODE_SELECTOR,
+            'containers': [container],
+            'volumes': volumes,
+        }
+        if settings.KUBERNETES_REGISTRY_SECRET:
+            pod_spec['imagePullSecrets'] = [{'name': settings.KUBERNETES_REGISTRY_SECRET}]
+            volumes.append({'name': 'registry', 'secret': {
+                'secretName': settings.KUBERNETES_REGISTRY_SECRET,
+                'items': [{'key': '.dockerconfigjson', 'path': 'config.json'}],
+            }})
+        labels = {runner.JOB_LABEL: str(job.id), ROLE_LABEL: role}
+        spec = {
+            'backoffLimit': 0,
+            'template': {'metadata': {'labels': labels}, 'spec': pod_spec},
+        }
+        if role == 'build':
+            # build() deletes it, unless its worker dies first; a job's own
+            # Job is kept until its result has been collected
+            spec['ttlSecondsAfterFinished'] = BUILD_JOB_TTL
+        response = self._request('POST', self._jobs_path(), json={
+            'apiVersion': 'batch/v1',
+            'kind': 'Job',
+            'metadata': {'name': name, 'labels': labels},
+            'spec': spec,
+        })
+        response.raise_for_status()
+        return name
+
+    def _delete_job(self, name):
+        response = self._request('DELETE', self._jobs_path(name), params={'propagationPolicy': 'Background'})
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def _job_finished(self, name):
+        response = self._request('GET', self._jobs_path(name))
+        if response.status_code == 404:
+            return True
+        response.raise_for_status()
+        conditions = response.json().get('status', {}).get('conditions') or []
+        return any(c['type'] in ('Complete', 'Failed') and c['status'] == 'True' for c in conditions)
+
+    def _pod(self, name):
+        """The pod of the Kubernetes Job name, None if it has none"""
+        pods = self._get(self._pods_path(), params={'labelSelector': f'job-name={name}'})['items']
+        return pods[0] if pods else None
+
+    def _started_pod(self, name):
+        """Wait for the pod of the Kubernetes Job name to leave Pending and return it, None if it never will"""
+        while True:
+            pod = self._pod(name)
+            if pod is not None:
+                if pod['status'].get('phase') != 'Pending':
+                    return pod
+                for status in pod['status'].get('containerStatuses') or []:
+                    reason = status['state'].get('waiting', {}).get('reason')
+                    if reason in IMAGE_WAITING_REASONS:
+                        raise KubernetesError(f'Pod {pod["metadata"]["name"]} cannot pull its image: {reason}')
+            elif self._job_finished(name):
+                return None
+            time.sleep(settings.KUBERNETES_POLL_INTERVAL)
+
+    def _follow_log(self, name, container):
+        """Yield the log of the pod of the Kubernetes Job name, from the start, until its container exits"""
+        pod = self._started_pod(name)
+        if pod is None:
+            return
+        response = self._request(
+            'GET', self._pods_path(pod['metadata']['name']) + '/log',
+            params={'container': container, 'follow': 'true'}, stream=True,
+        )
+        response.raise_for_status()
+        with response:
+            for chunk in response.iter_content(chunk_size=None):
+                if chunk:
+                    yield chunk
+
+    def _exit_code(self, name):
+        while True:
+            pod = self._pod(name)
+            if pod is None:
+                # Deleted once stopped, before anyone saw it exit
+                return 128 + signal.SIGKILL
+            for status in pod['status'].get('containerStatuses') or []:
+                terminated = status['state'].get('terminated')
+                if terminated:
+                    return terminated['exitCode']
+            time.sleep(settings.KUBERNETES_POLL_INTERVAL)
+
+    def _apply_network_policy(self, role):
+        """Create or update the NetworkPolicy whitelisting the egress of the pods in role, once per process"""
+        if role in self.network_policies_applied:
+            return
+        if role == 'build':
+            cidrs = egress_cidrs([_registry_host()] + settings.KUBERNETES_BUILD_EGRESS_CIDRS)
+        else:
+            cidrs = egress_cidrs(settings.KUBERNETES_JOB_EGRESS_CIDRS)
+        name = NETWORK_POLICY_NAMES[role]
+        path = f'/apis/networking.k8s.io/v1/namespaces/{settings.KUBERNETES_NAMESPACE}/networkpolicies'
+        policy = {
+            'apiVersion': 'networking.k8s.io/v1',
+            'kind': 'NetworkPolicy',
+            'metadata': {'name': name},
+            'spec': {
+                'podSelector': {'matchLabels': {ROLE_LABEL: role}},
+                'policyTypes': ['Ingress', 'Egress'],
+                'ingress': [],
+                'egress': [
+                    {'to': [{'namespaceSelector': {}}], 'ports': [{'protocol': 'UDP', 'port': 53}, {'protocol': 'TCP', 'port': 53}]},
+                ] + (
+                    [{'to': [{'ipBlock': {'cidr': cidr}} for cidr in cidrs]}] if cidrs else []
+                ),
+            },
+        }
+        response = self._request('POST', path, json=policy)
+        if response.status_code == 409:
+            response = self._request('PUT', f'{path}/{name}', json=policy)
+        response.raise_for_status()
+        self.network_policies_applied.add(role)
+
+def parse_quantity(quantity):
+    """Return a Kubernetes resource quantity such as '3800m' or '16Gi' as a number"""
+    for suffix in sorted(QUANTITY_SUFFIXES, key=len, reverse=True):
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * QUANTITY_SUFFIXES[suffix]
+    return float(quantity)
+
+def egress_cidrs(entries):
+    """
+    Return the NetworkPolicy ipBlock CIDRs of addresses, networks and host
+    names, resolving host names to their addresses now. Names that do not
+    resolve are left out with a warning.
+    """
+    cidrs = []
+    for entry in entries:
+        try:
+            networks = [ipaddress.ip_network(entry, strict=False)]
+        except ValueError:
+            try:
+                addresses = socket.getaddrinfo(entry, None, proto=socket.IPPROTO_TCP)
+            except socket.gaierror as ex:
+                print(f'Leaving {entry} out of the egress whitelist: {ex}')
+                continue
+            networks = [ipaddress.ip_network(address[4][0]) for address in addresses]
+        for network in networks:
+            if str(network) not in cidrs:
+                cidrs.append(str(network))
+    return cidrs
+
+def _registry_host():
+    """The host of the registry job images are pushed to"""
+    repository = registry.repository() if settings.JOB_IMAGE_REGISTRY else settings.KUBERNETES_IMAGE_REPOSITORY
+    return urlparse(f'//{repository}').hostname
+
+def _node_ready(node):
+    return any(c['type'] == 'Ready' and c['status'] == 'True' for c in node['status'].get('conditions', []))
+
+def _selector_params(labels):
+    return {'labelSelector': ','.join(f'{key}={value}' for key, value in labels.items())} if labels else {}
+
+def _claim_path(path):
+    """Return a worker path on the job files claim relative to the claim's root"""
+    relative_path = os.path.relpath(path, settings.KUBERNETES_JOB_FILES_MOUNT)
+    if relative_path.startswith(os.pardir):
+        raise ValueError(f'{path} is not on the job files volume mounted at {settings.KUBERNETES_JOB_FILES_MOUNT}')
+    return relative_path
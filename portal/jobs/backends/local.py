@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import shlex
+import shutil
+import signal
+import tarfile
+import subprocess
+from pathlib import PurePosixPath
+
+from django.conf import settings
+
+from .. import timings
+from .base import ExecutionBackend, open_job_tar, find_dockerfile_dir
+
+
+# Runs the job's command and records its exit code for other worker processes
+WRAPPER = '"$@"; code=$?; echo $code > "$JOB_EXIT_FILE"; exit $code'
+POLL_INTERVAL = 0.05
+
+
+class LocalBackend(ExecutionBackend):
+    """
+    Runs jobs as subprocesses of the worker, to develop against and load test
+    the scheduling and storage pipeline without a Docker daemon. Nothing is
+    built: the Dockerfile's directory is extracted under JOB_LOCAL_ROOT/<job id>
+    and its CMD (or JOB_LOCAL_COMMAND, when set) run there, with the volume's
+    path in $JOB_VOLUME. There is no isolation whatsoever; never approve
+    untrusted code on a portal using it.
+    """
+
+    def capacity(self):
+        memory = settings.JOB_LOCAL_MEMORY or os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return settings.JOB_LOCAL_CPUS or os.cpu_count(), memory
+
+    def place(self, job):
+        return 'local'
+
+    def build(self, job, job_file):
+        job_root = self._path(job)
+        shutil.rmtree(job_root, ignore_errors=True)
+        os.makedirs(self._volume(job), exist_ok=True)
+        with timings.phase(job, 'extract'):
+            job_dir = find_dockerfile_dir(job_file, job.stage)
+            job_file.seek(0)
+            _extract_job_dir(job_file, job_dir, self._path(job, 'context'))
+        if settings.JOB_LOCAL_COMMAND:
+            command = shlex.split(settings.JOB_LOCAL_COMMAND)
+        else:
+            with open(self._path(job, 'context', 'Dockerfile')) as dockerfile:
+                command = _dockerfile_command(dockerfile)
+        with open(self._path(job, 'command.json'), 'w') as command_file:
+            json.dump(command, command_file)
+        return f'local:{job.id}'
+
+    def start(self, job, image_id):
+        if job.container_id and self.find(job) == job.container_id:
+            return job.container_id
+        if image_id is None:
+            raise RuntimeError(f'The process of job {job.id} is gone')
+        with open(self._path(job, 'command.json')) as command_file:
+            command = json.load(command_file)
+        env = dict(
+            job.environment(),
+            PATH=os.environ.get('PATH', os.defpath),
+            JOB_VOLUME=self._volume(job),
+            JOB_EXIT_FILE=self._path(job, 'exit_code'),
+        )
+        with open(self._path(job, 'out'), 'wb') as out, open(self._path(job, 'err'), 'wb') as err:
+            # Its own session, so stopping it takes everything it started too
+            process = subprocess.Popen(
+                ['sh', '-c', WRAPPER, 'sh'] + command,
+                cwd=self._path(job, 'context'), env=env, stdout=out, stderr=err, start_new_session=True,
+            )
+        with open(self._path(job, 'pid'), 'w') as pid_file:
+            pid_file.write(str(process.pid))
+        return str(process.pid)
+
+    def attach(self, job):
+        with open(self._path(job, 'out'), 'rb') as out, open(self._path(job, 'err'), 'rb') as err:
+            while True:
+                exited = self._exit_code(job) is not None
+                stdout = out.read(settings.JOB_FILE_CHUNK_SIZE)
+                stderr = err.read(settings.JOB_FILE_CHUNK_SIZE)
+                if stdout or stderr:
+                    yield stdout or None, stderr or None
+                elif exited:
+                    return
+                else:
+                    time.sleep(POLL_INTERVAL)
+
+    def wait(self, job):
+        while True:
+            exit_code = self._exit_code(job)
+            if exit_code is not None:
+                return exit_code
+            time.sleep(POLL_INTERVAL)
+
+    def archive_volume(self, job, fileobj):
+        volume = self._volume(job)
+        if not os.path.isdir(volume):
+            return False
+        with tarfile.open(fileobj=fileobj, mode='w|') as volume_tar:
+            volume_tar.add(volume, arcname=PurePosixPath(settings.JOB_CONTAINER_VOLUME_MOUNT).name)
+        return True
+
+    def stop(self, job):
+        pid = int(job.container_id)
+        try:
+            os.killpg(pid, signal.SIGTERM)
+            deadline = time.monotonic() + settings.JOB_STOP_TIMEOUT
+            while self._exit_code(job) is None and time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+            if self._exit_code(job) is None:
+                os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def remove(self, job):
+        shutil.rmtree(self._path(job), ignore_errors=True)
+
+    def find(self, job):
+        try:
+            with open(self._path(job, 'pid')) as pid_file:
+                return pid_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _path(self, job, *names):
+        return os.path.join(settings.JOB_LOCAL_ROOT, str(job.id), *names)
+
+    def _volume(self, job):
+        # The stages of a pipeline share their pipeline's
+        return self._path(job.parent if job.stage else job, 'volume')
+
+    def _exit_code(self, job):
+        """The exit code of the job's process, or None while it runs"""
+        try:
+            with open(self._path(job, 'exit_code')) as exit_file:
+                return int(exit_file.read())
+        except (FileNotFoundError, ValueError):
+            # Not exited, or killed before it could say so
+            pass
+        pid = int(job.container_id)
+        try:
+            # Reap it if it is our child; otherwise just see if it still exists
+            finished, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return 128 + signal.SIGKILL
+            return None
+        if not finished:
+            return None
+        return 128 + os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+def _extract_job_dir(job_file, job_dir, path):
+    """Extract the regular files and directories under job_dir into path, refusing anything that would escape it"""
+    os.makedirs(path)
+    with open_job_tar(job_file) as job_tar:
+        for member in job_tar:
+            parts = PurePosixPath(member.name).parts
+            if job_dir:
+                if len(parts) < 2 or parts[0] != job_dir:
+                    continue
+                parts = parts[1:]
+            if not parts or '..' in parts or PurePosixPath(member.name).is_absolute():
+                continue
+            target = os.path.join(path, *parts)
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as target_file:
+                    shutil.copyfileobj(job_tar.extractfile(member), target_file)
+
+def _dockerfile_command(dockerfile):
+    """Return the argv of the last CMD in a Dockerfile, shell form run by sh -c"""
+    command = None
+    for line in dockerfile:
+        instruction, _, argument = line.strip().partition(' ')
+        if instruction.upper() != 'CMD':
+            continue
+        argument = argument.strip()
+        if argument.startswith('['):
+            command = json.loads(argument)
+        else:
+            command = ['sh', '-c', argument]
+    if command is None:
+        raise ValueError('No CMD found in the Dockerfile')
+    return command
@@ -1,14 +1,17 @@
 import os
+import gzip
 import time
-import base64
-import tempfile
-import tarfile
-from subprocess import check_output
-from pathlib import Path
+import datetime
+import threading
+from contextlib import contextmanager
 
 from django.conf import settings
+from django.db import connection
+from django.utils import timezone
 
-from celery import Celery
+from celery import Celery, chain
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init
 import requests
 import docker
 
@@ -29,80 +32,329 @@ app.autodiscover_tasks()
 
 import django
 django.setup()
-from .models import Job
+from .models import Job, private_storage
+from .logs import JobLogWriter
+from .backends import get_backend
+from .backends.docker import DockerBackend
+from . import runner
+from . import scheduler
+from . import timings
+from . import usage
+from . import janitor
+from . import reconciler
+from . import registry
+from . import outbox
+from . import arrays
+from . import pipelines
+
+
+@worker_process_init.connect
+def _init_worker_process(**kwargs):
+    # Never share the parent's sockets across a fork; each prefork child
+    # connects to a daemon the first time one of its tasks uses it
+    runner.reset_docker_clients()
+
+
+# Docker errors and unreachable daemons are worth retrying; anything else
+# (e.g. a Dockerfile that fails to build) fails the job right away
+RETRY_FOR = (docker.errors.APIError, requests.exceptions.ConnectionError)
+
+
+class JobStageTask(app.Task):
+    """A stage of a job run, called with the job ID as its last argument"""
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        # Out of retries: fail the job and give its resources to the next one
+        job = Job.objects.get(pk=args[-1])
+        if job.status_enum is Job.Status.RUNNING:
+            _run_error(job)
+        task_schedule_jobs.delay()
+
+
+def job_stage(func):
+    return app.task(
+        bind=True,
+        base=JobStageTask,
+        autoretry_for=RETRY_FOR,
+        retry_backoff=True,
+        retry_kwargs={'max_retries': settings.JOB_TASK_MAX_RETRIES},
+    )(func)
+
+def _get_job(job_id, *statuses):
+    job = Job.objects.get(pk=job_id)
+    if job.status_enum not in statuses:
+        # Already past this stage, e.g. a duplicate delivery or a cancelled job
+        raise Ignore()
+    return job
 
 
 @app.task(bind=True)
-def task_run_job(self, job_id):
+def task_schedule_jobs(self):
+    scheduler.schedule_jobs(lambda job: outbox.enqueue('jobs.celery.task_run_job', job))
+
+@app.task(bind=True)
+def task_sweep_dispatches(self):
+    return outbox.sweep()
+
+@app.task(bind=True)
+def task_prewarm_base_images(self):
+    if not _uses_runner_daemons():
+        return None
+    return runner.prewarm_base_images()
+
+@app.task(bind=True)
+def task_sweep_runners(self):
+    reports = janitor.sweep() if _uses_runner_daemons() else {}
+    if settings.JOB_IMAGE_REGISTRY:
+        registry.expire_images()
+    return reports
+
+@app.task(bind=True)
+def task_reconcile_jobs(self):
+    # Reattaching replays the container's whole output and waits for it, so a
+    # container that finished while nobody watched is collected right away
+    reconciler.reconcile_jobs(_reconcile_resumed, _reconcile_failed)
+
+def _uses_runner_daemons():
+    # Only the Docker backend runs jobs on RUNNER_DOCKER_HOSTS, the other
+    # backends have no daemons to prewarm or sweep
+    return isinstance(get_backend(), DockerBackend)
+
+def _reconcile_resumed(job):
+    chain(
+        task_run_container.s(job.image_id or None, job.id).set(task_id=job.run_task_id),
+        task_collect_job.s(job.id),
+    ).delay()
+
+def _reconcile_failed(job):
+    if job.status_enum is Job.Status.CANCELLED:
+        # Its container is gone, there is nothing left to collect
+        job.container_id = ''
+        job.save(update_fields=['container_id'])
+        if job.parent_id:
+            _run_finished(job)
+    else:
+        _run_error(job)
+    task_schedule_jobs.delay()
+
+@app.task(bind=True)
+def task_stop_job(self, job_id):
     job = Job.objects.get(pk=job_id)
-    run_job_docker(job)
+    stop_container(job)
+    if job.parent_id:
+        # The last run to finish may have been cancelled before it ever ran
+        _run_finished(job)
+    task_schedule_jobs.delay()
+
+@app.task(bind=True)
+def task_run_job(self, job_id):
+    # Build, run and collect are separate tasks on separately routable queues,
+    # so a failed run is retried without rebuilding the image
+    chain(
+        task_build_job.s(job_id),
+        task_run_container.s(job_id),
+        task_collect_job.s(job_id),
+    ).delay()
+
+@job_stage
+def task_build_job(self, job_id):
+    # A retry finds the job already started by its first attempt
+    job = _get_job(job_id, Job.Status.RUNNING if self.request.retries else Job.Status.QUEUED)
+    _beat(job)
+    try:
+        return build_job(job)
+    except runner.NoRunnerAvailable:
+        # Back in the queue, the rest of the chain is not run
+        raise Ignore()
+
+@job_stage
+def task_run_container(self, image_id, job_id):
+    # The reconciler reattaches to a cancelled job's stopped container to
+    # collect it
+    job = _get_job(job_id, Job.Status.RUNNING, Job.Status.CANCELLED)
+    if job.status_enum is Job.Status.CANCELLED and not job.container_id:
+        raise Ignore()
+    # Beating claims the run stage; once the reconciler has queued it again,
+    # only that task may run it
+    claimed = Job.objects.filter(pk=job.pk, run_task_id__in=['', self.request.id]).update(heartbeat_at=timezone.now())
+    if not claimed:
+        raise Ignore()
+    return run_container(job, image_id)
+
+@job_stage
+def task_collect_job(self, run_result, job_id):
+    # A cancelled job's partial output is still collected
+    job = _get_job(job_id, Job.Status.RUNNING, Job.Status.CANCELLED)
+    _beat(job)
+    collect_job(job, *run_result)
+    task_schedule_jobs.delay()
 
-def run_job_docker(job):
+def run_job(job):
+    """Run every stage of a job in this process"""
     _run_started(job)
     try:
-        volume_host_path = os.path.join(settings.PRIVATE_JOB_OUTPUT_ROOT, job.owner.username)
-        exit_code, encoded_output, encoded_errors = _build_run_job(
-            base64.b64encode(job.file.file.read()).decode('utf8'), volume_host_path)
+        image_id = build_job(job)
+        run_result = run_container(job, image_id)
+    except runner.NoRunnerAvailable:
+        # Back in the queue
+        raise
     except Exception:
         _run_error(job)
         raise
-    if exit_code != 0:
-        _run_failed(job, encoded_output, encoded_errors)
+    collect_job(job, *run_result)
+
+def build_job(job):
+    """Start the job on the node the backend places it on and return the ID of its image there"""
+    if job.status_enum is Job.Status.QUEUED:
+        _run_started(job)
+    backend = get_backend()
+    try:
+        # Later pipeline stages run where the earlier ones left the volume
+        job.runner_node = (job.stage and pipelines.previous_node(job)) or backend.place(job)
+    except runner.NoRunnerAvailable:
+        # The scheduler admits jobs against the free capacity of the whole
+        # cluster, which may be split across nodes none of which has room
+        job.requeue()
+        job.save()
+        raise
+    job.save(update_fields=['runner_node'])
+    with job.file.open('rb') as job_file, _heartbeat(job):
+        image_id = backend.build(job, job_file)
+    # Record that the job is built, so while its run stage waits in the queue
+    # the reconciler queues that again rather than failing the job
+    job.image_id = image_id
+    job.heartbeat_at = timezone.now()
+    job.save(update_fields=['image_id', 'heartbeat_at'])
+    return image_id
+
+def run_container(job, image_id):
+    """Run the job's container, streaming its output into storage, and return (exit code, output, errors)"""
+    backend = get_backend()
+    with timings.phase(job, 'run'):
+        container_id = backend.start(job, image_id)
+        if container_id != job.container_id:
+            timeout = job.timeout if job.timeout is not None else settings.JOB_TIMEOUT
+            job.container_id = container_id
+            job.deadline = timezone.now() + datetime.timedelta(seconds=timeout) if timeout else None
+            job.save(update_fields=['container_id', 'deadline'])
+            if job.parent_id:
+                # The image is built, the runs held back until then can follow
+                outbox.enqueue('jobs.celery.task_schedule_jobs')
+        job.refresh_from_db(fields=['status'])
+        if job.status_enum is Job.Status.CANCELLED:
+            # Cancelled before the container ID was saved for task_stop_job
+            backend.stop(job)
+        watchdog = _start_watchdog(job)
+        log_writer = JobLogWriter(f'{job.id}-{int(time.time())}', job)
+        # Output is written out while the job runs
+        try:
+            with _heartbeat(job), usage.sample(job, backend.stats(job)):
+                log_writer.write_frames(backend.attach(job))
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if job.deadline is not None and timezone.now() >= job.deadline:
+                log_writer.write('err', settings.JOB_TIMEOUT_MARKER.format(timeout=job.timeout or settings.JOB_TIMEOUT).encode('utf8'))
+            output, errors = log_writer.close()
+        exit_code = backend.wait(job)
+    return exit_code, output, errors
+
+def stop_container(job):
+    """Stop the job's container, if it has one, leaving its result to be collected"""
+    if job.container_id:
+        get_backend().stop(job)
+
+def _beat(job):
+    Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now())
+
+@contextmanager
+def _heartbeat(job):
+    """Keep beating for the job from a background thread while the block runs, however long it blocks"""
+    stopped = threading.Event()
+    def beat():
+        while not stopped.wait(settings.RUNNER_HEARTBEAT_INTERVAL):
+            _beat(job)
+        # The thread has its own database connection
+        connection.close()
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+def _start_watchdog(job):
+    """Stop the container at the job's deadline, which ends its output stream; None if it has none"""
+    if job.deadline is None:
+        return None
+    watchdog = threading.Timer(max((job.deadline - timezone.now()).total_seconds(), 0), stop_container, args=(job,))
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+def collect_job(job, exit_code, output, errors):
+    """Record the result of the run on the job and remove its container"""
+    with timings.phase(job, 'collect'):
+        artifacts = None
+        if job.container_id:
+            # The volume of a pipeline stage before the last is left for the
+            # next stage, not archived
+            if not job.stage or pipelines.is_last_stage(job):
+                artifacts = _save_artifacts(job)
+            get_backend().remove(job)
+        job.container_id = ''
+        if job.status_enum is Job.Status.CANCELLED:
+            job.set_run_files(output, errors, artifacts)
+            job.save()
+        elif exit_code != 0:
+            _run_failed(job, output, errors, artifacts)
+        else:
+            _run_completed(job, output, errors, artifacts)
+    if job.parent_id:
+        _run_finished(job)
+
+def _run_finished(job):
+    # Moves on the array job or pipeline the job is a run or stage of
+    if job.stage:
+        pipelines.stage_finished(job)
     else:
-        _run_completed(job, encoded_output, encoded_errors)
+        arrays.collect(job)
 
 def _run_started(job):
+    timings.record_queue_phases(job)
     job.run_job()
     job.save()
+    if job.parent_id:
+        arrays.run_started(job)
 
 def _run_error(job):
     job.error_job_run()
     job.save()
+    if job.parent_id:
+        _run_finished(job)
 
-def _run_completed(job, job_stdout, job_stderr):
-    job.complete_job_run(job_stdout, job_stderr)
+def _run_completed(job, job_stdout, job_stderr, job_artifacts=None):
+    job.complete_job_run(job_stdout, job_stderr, job_artifacts)
     job.save()
 
-def _run_failed(job, job_stdout, job_stderr):
-    job.fail_job_run(job_stdout, job_stderr)
+def _run_failed(job, job_stdout, job_stderr, job_artifacts=None):
+    job.fail_job_run(job_stdout, job_stderr, job_artifacts)
     job.save()
 
-def _build_image(job_file_bytes, docker_client):
-    with tempfile.TemporaryDirectory() as job_dir:
-        with tempfile.NamedTemporaryFile() as job_file:
-            job_file.write(job_file_bytes)
-            job_file.flush()
-            job_file.seek(0)
-            job_tar = tarfile.open(job_file.name, 'r|gz')
-            job_tar.extractall(path=job_dir) # Can create files outside of path. How to secure?
-            # If there's no Dockerfile, try navigating into the first directory to find it
-            if not Path(os.path.join(job_dir, 'Dockerfile')).is_file():
-                job_dir = os.path.join(job_dir, os.listdir(job_dir)[0])
-            try:
-                image, build_log_generator = docker_client.images.build(path=job_dir, rm=True)
-                return image
-            except docker.errors.APIError as ex:
-                print(ex)
-                raise ex
-
-def _build_run_job(job_file_b64, volume_host_path):
-    docker_client = docker.from_env()
-    job_file_bytes = base64.b64decode(job_file_b64)
-    image = _build_image(job_file_bytes, docker_client)
-    container = docker_client.containers.run(
-        image.id,
-        detach=True,
-        network='job-network',
-        volumes={volume_host_path: {'bind': settings.JOB_CONTAINER_VOLUME_MOUNT, 'mode': 'rw'}},
-        environment=settings.JOB_ENV_DICT,
-        cpu_period=settings.JOB_CONTAINER_CPU_PERIOD,
-        cpu_quota=settings.JOB_CONTAINER_CPU_QUOTA,
-        mem_limit=settings.JOB_CONTAINER_MEM_LIMIT,
-        memswap_limit=settings.JOB_CONTAINER_MEMSWAP_LIMIT,
-    )
-    container_result = container.wait()
-    container_output = container.logs(stdout=True, stderr=False)
-    container_errors = container.logs(stderr=True, stdout=False)
-    container.remove()
-    container_exit_code = container_result['StatusCode']
-    return container_exit_code, container_output, container_errors
+def _save_artifacts(job):
+    """Stream the job's volume out of its stopped container into a gzipped tar in private storage and return its name"""
+    # The tar is compressed chunk by chunk straight into storage, never held
+    # in memory or copied to a temp file
+    name = private_storage.get_available_name(f'{job.id}-{int(time.time())}.tar.gz')
+    try:
+        with private_storage.open(name, 'wb') as artifacts_file:
+            with gzip.GzipFile(fileobj=artifacts_file, mode='wb', compresslevel=settings.JOB_ARTIFACT_COMPRESSLEVEL) as artifacts:
+                archived = get_backend().archive_volume(job, artifacts)
+    except Exception:
+        private_storage.delete(name)
+        raise
+    if not archived:
+        private_storage.delete(name)
+        return None
+    return name
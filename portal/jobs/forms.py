@@ -1,15 +1,56 @@
+import tarfile
+
 from django.forms import ModelForm, ValidationError
 
-from .models import Job
+from .models import Job, clamp_requests
+from .backends.base import find_dockerfile_dir
+from . import arrays
+from . import pipelines
 
 class JobSubmissionForm(ModelForm):
     class Meta:
         model = Job
-        fields = ['name', 'description', 'file', 'collaborators']
+        fields = ['name', 'description', 'file', 'collaborators', 'cpus', 'memory_mb', 'timeout', 'parameter_grid', 'stages']
 
     def clean_file(self):
-        import tarfile
         file = self.cleaned_data['file']
         if not tarfile.is_tarfile(file.temporary_file_path()):
             raise ValidationError("File is not a valid tarfile")
         return file
+
+    def clean_parameter_grid(self):
+        parameter_grid = self.cleaned_data['parameter_grid'].strip()
+        if parameter_grid:
+            try:
+                arrays.parse_grid(parameter_grid)
+            except ValueError as ex:
+                raise ValidationError(str(ex))
+        return parameter_grid
+
+    def clean_stages(self):
+        stages = self.cleaned_data['stages'].strip()
+        if stages:
+            try:
+                pipelines.parse_stages(stages)
+            except ValueError as ex:
+                raise ValidationError(str(ex))
+        return stages
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('parameter_grid') and cleaned_data.get('stages'):
+            raise ValidationError('A job cannot be both an array job and a pipeline')
+        file = cleaned_data.get('file')
+        if file and cleaned_data.get('stages'):
+            for stage in pipelines.parse_stages(cleaned_data['stages']):
+                with open(file.temporary_file_path(), 'rb') as job_file:
+                    try:
+                        find_dockerfile_dir(job_file, stage)
+                    except FileNotFoundError as ex:
+                        self.add_error('stages', str(ex))
+                    except tarfile.TarError:
+                        # Left to clean_file to report
+                        break
+        cleaned_data['cpus'], cleaned_data['memory_mb'], cleaned_data['timeout'] = clamp_requests(
+            cleaned_data.get('cpus'), cleaned_data.get('memory_mb'), cleaned_data.get('timeout'))
+        return cleaned_data
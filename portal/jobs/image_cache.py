@@ -0,0 +1,94 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+
+import docker
+
+from .models import CachedImage
+
+
+def file_digest(job_file, stage=''):
+    """
+    Return the hex SHA-256 of job_file, read in chunks, and rewind it. Every
+    stage of a pipeline builds its own image from the same file, so a stage's
+    digest covers its directory name as well.
+    """
+    digest = hashlib.sha256()
+    job_file.seek(0)
+    for chunk in iter(lambda: job_file.read(settings.JOB_FILE_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    job_file.seek(0)
+    if stage:
+        return hashlib.sha256(f'{digest.hexdigest()}:{stage}'.encode('utf8')).hexdigest()
+    return digest.hexdigest()
+
+def get_image(docker_client, node, digest):
+    """Return the image on node built from the file with this digest, or None on a miss"""
+    entry, _ = CachedImage.objects.get_or_create(node=node, digest=digest)
+    if entry.image_id:
+        try:
+            image = docker_client.images.get(entry.tag)
+        except docker.errors.ImageNotFound:
+            # Removed from the daemon behind our back, e.g. by a prune
+            pass
+        else:
+            CachedImage.objects.filter(pk=entry.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+            return image
+    CachedImage.objects.filter(pk=entry.pk).update(image_id='', misses=F('misses') + 1)
+    return None
+
+def add_image(docker_client, node, digest, image):
+    """Tag a freshly built image with its digest and evict images over node's cache limits"""
+    entry = CachedImage.objects.get(node=node, digest=digest)
+    image.tag(settings.JOB_IMAGE_CACHE_REPOSITORY, digest)
+    entry.image_id = image.id
+    entry.size = image.attrs.get('Size', 0)
+    entry.save()
+    evict_images(docker_client, node)
+
+def _within_limits(count, total_bytes):
+    max_images = settings.JOB_IMAGE_CACHE_MAX_IMAGES
+    max_bytes = settings.JOB_IMAGE_CACHE_MAX_BYTES
+    return (not max_images or count <= max_images) and (not max_bytes or total_bytes <= max_bytes)
+
+def evict_images(docker_client, node):
+    """Remove least recently used images from node until its cache is within the limits"""
+    return [entry.digest for entry in _evict(docker_client, _cached(node), _within_limits)]
+
+def expire_images(docker_client, node, max_age):
+    """Remove images from node that no job has used for max_age, returning the evicted entries"""
+    expired = _cached(node).filter(last_used_at__lt=timezone.now() - max_age)
+    return _evict(docker_client, expired, lambda count, total_bytes: False)
+
+def shrink_images(docker_client, node, excess_bytes):
+    """Remove least recently used images from node until at least excess_bytes are freed, returning the evicted entries"""
+    cached = _cached(node)
+    target_bytes = (cached.aggregate(total=Sum('size'))['total'] or 0) - excess_bytes
+    return _evict(docker_client, cached, lambda count, total_bytes: total_bytes <= target_bytes)
+
+def _cached(node):
+    return CachedImage.objects.filter(node=node).exclude(image_id='').order_by('last_used_at')
+
+def _evict(docker_client, cached, within_limits):
+    count = cached.count()
+    total_bytes = cached.aggregate(total=Sum('size'))['total'] or 0
+    evicted = []
+    for entry in cached:
+        if within_limits(count, total_bytes):
+            break
+        try:
+            docker_client.images.remove(entry.tag)
+        except docker.errors.ImageNotFound:
+            pass
+        except docker.errors.APIError as ex:
+            # Most likely still in use by a running container; try again next time
+            print(ex)
+            continue
+        count -= 1
+        total_bytes -= entry.size
+        entry.image_id = ''
+        entry.save()
+        evicted.append(entry)
+    return evicted
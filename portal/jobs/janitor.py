@@ -0,0 +1,99 @@
+import datetime
+
+from django.conf import settings
+
+import docker
+import requests
+
+from .models import Job
+from . import image_cache
+from . import runner
+
+
+# Where the daemon's PRIVATE_JOB_OUTPUT_ROOT is mounted in the sweeping container
+OUTPUT_MOUNT = '/output'
+
+
+def sweep():
+    """Reclaim disk on every runner daemon, returning {host: report} with None for daemons that failed"""
+    reports = {}
+    for host in settings.RUNNER_DOCKER_HOSTS:
+        try:
+            reports[host] = sweep_daemon(host)
+        except (docker.errors.APIError, requests.exceptions.RequestException) as ex:
+            print(f'{host}: {ex}')
+            reports[host] = None
+        else:
+            report = reports[host]
+            print(f"{host}: removed {len(report['containers'])} containers, {len(report['images'])} images "
+                  f"and {len(report['output_dirs'])} output directories, reclaiming {report['bytes']} bytes")
+    return reports
+
+def sweep_daemon(host):
+    """
+    Remove stopped containers no job is waiting to collect, dangling images,
+    job images unused for RUNNER_GC_MAX_AGE and, above RUNNER_GC_DISK_HIGH_WATER
+    bytes of image layers, the least recently used job images. Then expire
+    output directories untouched for RUNNER_GC_MAX_AGE. Returns what was removed.
+    """
+    docker_client = runner.get_docker_client(host)
+    max_age = datetime.timedelta(seconds=settings.RUNNER_GC_MAX_AGE)
+    report = {'containers': [], 'images': [], 'output_dirs': [], 'bytes': 0}
+    _remove_orphaned_containers(docker_client, report)
+    _prune_images(docker_client, host, max_age, report)
+    _expire_output_dirs(docker_client, max_age, report)
+    return report
+
+def _remove_orphaned_containers(docker_client, report):
+    # Only job containers are the janitor's. A stopped one is kept while its
+    # job may still start it, whether or not its ID was saved, and until its
+    # result has been collected, a cancelled job's partial output included.
+    live = Job.objects.filter(status__in=[Job.Status.QUEUED.name, Job.Status.RUNNING.name])
+    live_ids = {str(job_id) for job_id in live.values_list('id', flat=True)}
+    collecting = Job.objects.filter(status__in=[Job.Status.RUNNING.name, Job.Status.CANCELLED.name]).exclude(container_id='')
+    pending = set(collecting.values_list('container_id', flat=True))
+    stopped = docker_client.containers.list(all=True, filters={'status': ['created', 'exited', 'dead'], 'label': runner.JOB_LABEL})
+    for container in stopped:
+        if container.id in pending or container.labels.get(runner.JOB_LABEL) in live_ids:
+            continue
+        try:
+            container.remove()
+        except docker.errors.NotFound:
+            continue
+        report['containers'].append(container.id)
+
+def _prune_images(docker_client, host, max_age, report):
+    pruned = docker_client.images.prune(filters={'dangling': True})
+    report['images'] += [image['Deleted'] for image in pruned.get('ImagesDeleted') or [] if 'Deleted' in image]
+    report['bytes'] += pruned.get('SpaceReclaimed') or 0
+    evicted = image_cache.expire_images(docker_client, host, max_age)
+    high_water = settings.RUNNER_GC_DISK_HIGH_WATER
+    if high_water:
+        used = docker_client.df()['LayersSize'] - sum(entry.size for entry in evicted)
+        if used > high_water:
+            evicted += image_cache.shrink_images(docker_client, host, used - high_water)
+    report['images'] += [entry.tag for entry in evicted]
+    report['bytes'] += sum(entry.size for entry in evicted)
+
+def _expire_output_dirs(docker_client, max_age, report):
+    # Output directories live on the daemon's filesystem, not the worker's, so
+    # they are removed from a throwaway container mounting the output root.
+    # Directories of jobs that may still run are never touched.
+    active = Job.objects.filter(status__in=[Job.Status.QUEUED.name, Job.Status.RUNNING.name])
+    keep = ''.join(f' ! -name {job_id}' for job_id in active.values_list('id', flat=True))
+    minutes = int(max_age.total_seconds() // 60)
+    script = (
+        f'find {OUTPUT_MOUNT} -mindepth 2 -maxdepth 2 -mmin +{minutes}{keep}'
+        r' -exec du -sk {} \; -exec rm -rf {} \;'
+    )
+    output = docker_client.containers.run(
+        settings.RUNNER_GC_IMAGE,
+        ['sh', '-c', script],
+        volumes={settings.PRIVATE_JOB_OUTPUT_ROOT: {'bind': OUTPUT_MOUNT, 'mode': 'rw'}},
+        network_mode='none',
+        remove=True,
+    )
+    for line in output.decode('utf8').splitlines():
+        kilobytes, _, path = line.partition('\t')
+        report['output_dirs'].append(path[len(OUTPUT_MOUNT) + 1:])
+        report['bytes'] += int(kilobytes) * 1024
@@ -0,0 +1,136 @@
+import time
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from .models import private_storage
+
+
+class JobLogWriter:
+    """
+    Writes a container's demultiplexed stdout/stderr into private storage as it arrives.
+
+    Each stream is collected in a buffer of JOB_LOG_BUFFER_SIZE bytes that is
+    written out whenever it fills, so memory use does not depend on how much a
+    job prints. Past JOB_LOG_MAX_BYTES (when set) a stream is cut off with
+    JOB_LOG_TRUNCATION_MARKER. Files are only created for streams that
+    receive data.
+
+    When given a job, a stream's file is recorded on the job's output/errors
+    field as soon as it is created, and buffers are flushed at least every
+    JOB_LOG_FLUSH_INTERVAL seconds, from a background thread when no output
+    arrives, so staff can tail the output of a RUNNING job.
+    """
+
+    STREAMS = ('out', 'err')
+    JOB_FIELDS = {'out': 'output', 'err': 'errors'}
+
+    def __init__(self, name, job=None):
+        self.name = name
+        self.job = job
+        self.flushed_at = time.monotonic()
+        self.files = {}
+        self.names = {}
+        self.buffers = {stream: bytearray() for stream in self.STREAMS}
+        self.sizes = {stream: 0 for stream in self.STREAMS}
+        self.truncated = set()
+        # Writes come from the caller, timed flushes from the flusher thread
+        self.lock = threading.RLock()
+        self.closed = threading.Event()
+        self.flusher = None
+        if job and settings.JOB_LOG_FLUSH_INTERVAL > 0:
+            self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self.flusher.start()
+
+    def write_frames(self, frames):
+        """Consume (stdout, stderr) tuples as yielded by a demultiplexed attach"""
+        for stdout, stderr in frames:
+            if stdout:
+                self.write('out', stdout)
+            if stderr:
+                self.write('err', stderr)
+
+    def write(self, stream, data):
+        with self.lock:
+            self._write(stream, data)
+
+    def _write(self, stream, data):
+        if stream in self.truncated:
+            return
+        max_bytes = settings.JOB_LOG_MAX_BYTES
+        if max_bytes and self.sizes[stream] + len(data) > max_bytes:
+            data = data[:max_bytes - self.sizes[stream]]
+            data += settings.JOB_LOG_TRUNCATION_MARKER.format(max_bytes=max_bytes).encode('utf8')
+            self.truncated.add(stream)
+        self.sizes[stream] += len(data)
+        buffer = self.buffers[stream]
+        buffer += data
+        if len(buffer) >= settings.JOB_LOG_BUFFER_SIZE:
+            self.flush(stream)
+        elif self.job and time.monotonic() - self.flushed_at >= settings.JOB_LOG_FLUSH_INTERVAL:
+            self._flush_all()
+
+    def flush(self, stream):
+        with self.lock:
+            buffer = self.buffers[stream]
+            if not buffer:
+                return
+            if stream not in self.files:
+                self._open(stream)
+            self.files[stream].write(buffer)
+            self.files[stream].flush()
+            buffer.clear()
+
+    def _flush_all(self):
+        for stream in self.STREAMS:
+            self.flush(stream)
+        self.flushed_at = time.monotonic()
+
+    def _flush_periodically(self):
+        # Output followed by silence would otherwise wait for the next write
+        while not self.closed.wait(settings.JOB_LOG_FLUSH_INTERVAL):
+            with self.lock:
+                if time.monotonic() - self.flushed_at >= settings.JOB_LOG_FLUSH_INTERVAL:
+                    self._flush_all()
+        # The thread has its own database connection
+        connection.close()
+
+    def _open(self, stream):
+        self.names[stream] = private_storage.get_available_name(f'{self.name}.{stream}')
+        self.files[stream] = private_storage.open(self.names[stream], 'wb')
+        if self.job:
+            field = self.JOB_FIELDS[stream]
+            getattr(self.job, field).name = self.names[stream]
+            self.job.save(update_fields=[field])
+
+    def close(self):
+        """Flush and close every stream, returning their storage names, e.g. (stdout, stderr), None if empty"""
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        for stream in self.STREAMS:
+            self.flush(stream)
+            if stream in self.files:
+                self.files[stream].close()
+        return tuple(self.names.get(stream) for stream in self.STREAMS)
+
+
+class BuildLogWriter(JobLogWriter):
+    """Writes the decoded JSON chunks of an image build as text, recorded on the job's build_log"""
+
+    STREAMS = ('build',)
+    JOB_FIELDS = {'build': 'build_log'}
+
+    def write_chunks(self, chunks):
+        for chunk in chunks:
+            if 'stream' in chunk:
+                text = chunk['stream']
+            elif 'error' in chunk:
+                text = chunk['error'] + '\n'
+            elif 'status' in chunk and not chunk.get('progressDetail'):
+                # Pull progress bars are left out, their final status is kept
+                text = ': '.join(filter(None, (chunk.get('id'), chunk['status']))) + '\n'
+            else:
+                continue
+            self.write('build', text.encode('utf8'))
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from jobs import runner
+
+
+class Command(BaseCommand):
+    help = 'Report which RUNNER_BASE_IMAGES are present on which runner daemon'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pull', action='store_true', help='Pull missing or outdated base images first')
+
+    def handle(self, *args, **options):
+        if options['pull']:
+            runner.prewarm_base_images()
+        for host, present in runner.base_image_status().items():
+            self.stdout.write(host)
+            if present is None:
+                self.stdout.write(self.style.ERROR('    unreachable'))
+                continue
+            for name in settings.RUNNER_BASE_IMAGES:
+                if present[name]:
+                    self.stdout.write(self.style.SUCCESS(f'    {name}: present'))
+                else:
+                    self.stdout.write(self.style.WARNING(f'    {name}: missing'))
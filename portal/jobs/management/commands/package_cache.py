@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import requests
+
+from jobs import package_cache
+
+
+class Command(BaseCommand):
+    help = "Report the hit rates of each runner daemon's package cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', metavar='FILE', help='Download the URLs listed in FILE, one per line, through every cache first')
+
+    def handle(self, *args, **options):
+        if not settings.RUNNER_PACKAGE_CACHE_PORT:
+            raise CommandError('RUNNER_PACKAGE_CACHE_PORT is not set')
+        urls = []
+        if options['seed']:
+            with open(options['seed']) as seed_file:
+                urls = [line.strip() for line in seed_file if line.strip() and not line.startswith('#')]
+        for host in settings.RUNNER_DOCKER_HOSTS:
+            self.stdout.write(host)
+            if urls:
+                cached, failed = package_cache.seed(host, urls)
+                self.stdout.write(self.style.SUCCESS(f'    seeded {len(cached)} URLs'))
+                for url in failed:
+                    self.stdout.write(self.style.WARNING(f'    not cached: {url}'))
+            try:
+                stats = package_cache.stats(host)
+            except requests.exceptions.RequestException:
+                self.stdout.write(self.style.ERROR('    unreachable'))
+                continue
+            self.stdout.write(
+                f"    {stats['requests']} requests, {stats['hit_ratio']}% hits, "
+                f"{stats['byte_hit_ratio']}% of bytes from cache (last hour)"
+            )
+            self.stdout.write(f"    {stats['disk_kilobytes']} KB on disk, {stats['disk_capacity']}")
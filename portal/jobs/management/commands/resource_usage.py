@@ -0,0 +1,44 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+
+from jobs import usage
+from jobs.models import JobResourceUsage
+
+
+RANKS = (50, 90, 95, 99, 100)
+
+
+class Command(BaseCommand):
+    help = 'Report percentiles of what job containers used, to size the JOB_CONTAINER_* limits by'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Only count jobs that ran in the last DAYS days (default 30)')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - datetime.timedelta(days=options['days'])
+        queryset = JobResourceUsage.objects.filter(recorded_at__gte=since)
+        count = queryset.count()
+        self.stdout.write(f"{count} jobs in the last {options['days']} days")
+        if not count:
+            return
+        self.stdout.write('{:<18}'.format('') + ''.join(f'{f"p{rank}" if rank < 100 else "max":>12}' for rank in RANKS))
+        for field, label, format_value in (
+            ('cpu_cores', 'CPU cores', lambda value: f'{value:.2f}'),
+            ('cpu_seconds', 'CPU time (s)', lambda value: f'{value:.0f}'),
+            ('peak_memory', 'Peak memory', filesizeformat),
+            ('block_read', 'Disk read', filesizeformat),
+            ('block_written', 'Disk written', filesizeformat),
+            ('network_received', 'Network in', filesizeformat),
+            ('network_sent', 'Network out', filesizeformat),
+        ):
+            values = usage.percentiles(queryset, field, RANKS)
+            self.stdout.write(f'{label:<18}' + ''.join(f'{format_value(values[rank]):>12}' for rank in RANKS))
+        if settings.JOB_CONTAINER_CPU_QUOTA and settings.JOB_CONTAINER_CPU_PERIOD:
+            cpus = settings.JOB_CONTAINER_CPU_QUOTA / settings.JOB_CONTAINER_CPU_PERIOD
+            self.stdout.write(f'Current limits: {cpus:.2f} CPU cores, {settings.JOB_CONTAINER_MEM_LIMIT or "no"} memory limit')
+        else:
+            self.stdout.write(f'Current limits: no CPU limit, {settings.JOB_CONTAINER_MEM_LIMIT or "no"} memory limit')
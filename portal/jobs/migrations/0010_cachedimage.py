@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0009_job_errors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(help_text='SHA-256 of the submission file the image was built from.', max_length=64, unique=True, verbose_name='Digest')),
+                ('image_id', models.CharField(blank=True, help_text='Blank once the image has been evicted from the runner.', max_length=128, verbose_name='Image ID')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Size')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('last_used_at', models.DateTimeField(auto_now=True, verbose_name='Last Used At')),
+                ('hits', models.PositiveIntegerField(default=0, verbose_name='Hits')),
+                ('misses', models.PositiveIntegerField(default=0, verbose_name='Misses')),
+            ],
+        ),
+    ]
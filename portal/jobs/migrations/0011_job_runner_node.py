@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0010_cachedimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='runner_node',
+            field=models.CharField(blank=True, help_text='Docker daemon the job was placed on.', max_length=255, verbose_name='Runner Node'),
+        ),
+        migrations.AddField(
+            model_name='cachedimage',
+            name='node',
+            field=models.CharField(default='', max_length=255, verbose_name='Runner Node'),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='cachedimage',
+            name='digest',
+            field=models.CharField(help_text='SHA-256 of the submission file the image was built from.', max_length=64, verbose_name='Digest'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cachedimage',
+            unique_together={('node', 'digest')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0011_job_runner_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, help_text='When the scheduler admitted the job to run.', null=True, verbose_name='Dispatched At'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0012_job_dispatched_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='container_id',
+            field=models.CharField(blank=True, help_text='Container of the current run, until its result is collected.', max_length=64, verbose_name='Container ID'),
+        ),
+    ]
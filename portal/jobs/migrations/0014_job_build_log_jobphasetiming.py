@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0013_job_container_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='build_log',
+            field=models.FileField(blank=True, upload_to='', verbose_name='Build Log'),
+        ),
+        migrations.CreateModel(
+            name='JobPhaseTiming',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phase', models.CharField(choices=[('queue', 'Queue'), ('dispatch', 'Dispatch'), ('extract', 'Extract'), ('build', 'Build'), ('run', 'Run'), ('collect', 'Collect')], max_length=16, verbose_name='Phase')),
+                ('started_at', models.DateTimeField(verbose_name='Started At')),
+                ('duration', models.FloatField(help_text='Seconds.', verbose_name='Duration')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='phase_timings', to='jobs.Job', verbose_name='Job')),
+            ],
+            options={
+                'ordering': ['started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0014_job_build_log_jobphasetiming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='artifacts',
+            field=models.FileField(blank=True, help_text='Gzipped tar of the files the job wrote to its volume.', upload_to='', verbose_name='Artifacts'),
+        ),
+    ]
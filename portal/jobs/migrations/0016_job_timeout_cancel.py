@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0015_job_artifacts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='deadline',
+            field=models.DateTimeField(blank=True, help_text='When the running container will be stopped.', null=True, verbose_name='Deadline'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds the job may run before it is stopped. Leave blank for the default, 0 for no limit.', null=True, verbose_name='Timeout'),
+        ),
+    ]
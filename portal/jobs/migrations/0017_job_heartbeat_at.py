@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0016_job_timeout_cancel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Last sign of life from the worker running the job.', null=True, verbose_name='Heartbeat At'),
+        ),
+    ]
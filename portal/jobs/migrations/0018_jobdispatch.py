@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0017_job_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobDispatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=255, verbose_name='Task')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('published_at', models.DateTimeField(blank=True, null=True, verbose_name='Published At')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last Error')),
+                ('job', models.ForeignKey(blank=True, help_text='Passed to the task as its only argument, if set.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='dispatches', to='jobs.Job', verbose_name='Job')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0018_jobdispatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistryImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(help_text='SHA-256 of the submission file the image was built from, and its tag in the registry.', max_length=64, unique=True, verbose_name='Digest')),
+                ('manifest_digest', models.CharField(blank=True, help_text='Looked up from the registry when blank.', max_length=128, verbose_name='Manifest Digest')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Size')),
+                ('pushed_at', models.DateTimeField(auto_now_add=True, verbose_name='Pushed At')),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Last Used At')),
+                ('pulls', models.PositiveIntegerField(default=0, verbose_name='Pulls')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='jobphasetiming',
+            name='phase',
+            field=models.CharField(choices=[('queue', 'Queue'), ('dispatch', 'Dispatch'), ('extract', 'Extract'), ('pull', 'Pull'), ('build', 'Build'), ('push', 'Push'), ('run', 'Run'), ('collect', 'Collect')], max_length=16, verbose_name='Phase'),
+        ),
+    ]
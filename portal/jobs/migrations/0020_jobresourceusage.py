@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0019_registryimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobResourceUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cpu_seconds', models.FloatField(default=0, help_text='Seconds, over all cores.', verbose_name='CPU Time')),
+                ('peak_memory', models.BigIntegerField(default=0, help_text='Bytes.', verbose_name='Peak Memory')),
+                ('block_read', models.BigIntegerField(default=0, help_text='Bytes.', verbose_name='Block Read')),
+                ('block_written', models.BigIntegerField(default=0, help_text='Bytes.', verbose_name='Block Written')),
+                ('network_received', models.BigIntegerField(default=0, help_text='Bytes.', verbose_name='Network Received')),
+                ('network_sent', models.BigIntegerField(default=0, help_text='Bytes.', verbose_name='Network Sent')),
+                ('wall_seconds', models.FloatField(default=0, help_text='Seconds.', verbose_name='Sampled For')),
+                ('samples', models.PositiveIntegerField(default=0, verbose_name='Samples')),
+                ('recorded_at', models.DateTimeField(auto_now=True, verbose_name='Recorded At')),
+                ('job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='resource_usage', to='jobs.Job', verbose_name='Job')),
+            ],
+        ),
+    ]
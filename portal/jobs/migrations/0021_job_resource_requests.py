@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:32
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0020_jobresourceusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='cpus',
+            field=models.FloatField(blank=True, help_text='CPU cores the job needs. Leave blank for the default.', null=True, validators=[django.core.validators.MinValueValidator(0.01)], verbose_name='CPUs'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='memory_mb',
+            field=models.PositiveIntegerField(blank=True, help_text='Megabytes of memory the job needs. Leave blank for the default.', null=True, validators=[django.core.validators.MinValueValidator(4)], verbose_name='Memory (MB)'),
+        ),
+    ]
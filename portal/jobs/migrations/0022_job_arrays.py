@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0021_job_resource_requests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='parameter_grid',
+            field=models.TextField(blank=True, help_text='JSON object mapping environment variable names to lists of values. The job runs once for every combination of them.', verbose_name='Parameter Grid'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='parameters',
+            field=models.TextField(blank=True, help_text="JSON object of this run's environment variables.", verbose_name='Parameters'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='parent',
+            field=models.ForeignKey(blank=True, help_text='Array job this is one run of.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='jobs.Job', verbose_name='Array Job'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='run_index',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Run'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0022_job_arrays'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='stage',
+            field=models.CharField(blank=True, help_text='Directory of the Dockerfile this pipeline stage runs.', max_length=64, verbose_name='Stage'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='stages',
+            field=models.TextField(blank=True, help_text='JSON list of the top-level directories of a pipeline, each with its own Dockerfile, run one after the other on a shared volume.', verbose_name='Stages'),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='parent',
+            field=models.ForeignKey(blank=True, help_text='Array job or pipeline this is a run or stage of.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='jobs.Job', verbose_name='Parent Job'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0023_job_pipelines'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='off_peak',
+            field=models.BooleanField(default=False, help_text='Only start the approved job in the off-peak window.', verbose_name='Off-Peak'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='run_after',
+            field=models.DateTimeField(blank=True, help_text='Keep the approved job queued until then.', null=True, verbose_name='Run After'),
+        ),
+    ]
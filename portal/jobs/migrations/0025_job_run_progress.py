@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0024_job_run_windows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='image_id',
+            field=models.CharField(blank=True, help_text='Image the container is started from, once it has been built.', max_length=255, verbose_name='Image ID'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='run_task_id',
+            field=models.CharField(blank=True, help_text='Run stage the reconciler queued again last; any other is ignored.', max_length=64, verbose_name='Run Task ID'),
+        ),
+    ]
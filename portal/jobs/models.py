@@ -1,4 +1,5 @@
 import enum
+import json
 import base64
 import time
 import os
@@ -8,8 +9,10 @@ from django.contrib.auth.models import User
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
 from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
+from django.core.validators import MinValueValidator
 
 from django_fsm import FSMField, transition
 from django_fsm_log.decorators import fsm_log_by
@@ -64,6 +67,12 @@ class Job(models.Model):
             'is_failure': True,
             'is_success': False,
         }
+        CANCELLED = {
+            'code': 32,
+            'label': 'Cancelled',
+            'is_failure': True,
+            'is_success': False,
+        }
         PENDING_OUTPUT_REVIEW = {
             'code': 40,
             'label': 'Pending Output Review',
@@ -107,6 +116,26 @@ class Job(models.Model):
     collaborators = models.ManyToManyField(User, verbose_name='Collaborators', related_name='collaborating', blank=True, help_text='Collaborators will be able to check and update the request and download the data. Currently, only individuals with a U-M account may be added as collaborators.')
     output = models.FileField(storage=private_storage, verbose_name='Output', blank=True)
     errors = models.FileField(storage=private_storage, verbose_name='Errors', blank=True)
+    build_log = models.FileField(storage=private_storage, verbose_name='Build Log', blank=True)
+    artifacts = models.FileField(storage=private_storage, verbose_name='Artifacts', blank=True, help_text='Gzipped tar of the files the job wrote to its volume.')
+    dispatched_at = models.DateTimeField(verbose_name='Dispatched At', null=True, blank=True, help_text='When the scheduler admitted the job to run.')
+    runner_node = models.CharField(verbose_name='Runner Node', max_length=255, blank=True, help_text='Docker daemon the job was placed on.')
+    image_id = models.CharField(verbose_name='Image ID', max_length=255, blank=True, help_text='Image the container is started from, once it has been built.')
+    container_id = models.CharField(verbose_name='Container ID', max_length=64, blank=True, help_text='Container of the current run, until its result is collected.')
+    run_task_id = models.CharField(verbose_name='Run Task ID', max_length=64, blank=True, help_text='Run stage the reconciler queued again last; any other is ignored.')
+    cpus = models.FloatField(verbose_name='CPUs', null=True, blank=True, validators=[MinValueValidator(0.01)], help_text='CPU cores the job needs. Leave blank for the default.')
+    memory_mb = models.PositiveIntegerField(verbose_name='Memory (MB)', null=True, blank=True, validators=[MinValueValidator(4)], help_text='Megabytes of memory the job needs. Leave blank for the default.')
+    timeout = models.PositiveIntegerField(verbose_name='Timeout', null=True, blank=True, help_text='Seconds the job may run before it is stopped. Leave blank for the default, 0 for no limit.')
+    run_after = models.DateTimeField(verbose_name='Run After', null=True, blank=True, help_text='Keep the approved job queued until then.')
+    off_peak = models.BooleanField(verbose_name='Off-Peak', default=False, help_text='Only start the approved job in the off-peak window.')
+    heartbeat_at = models.DateTimeField(verbose_name='Heartbeat At', null=True, blank=True, help_text='Last sign of life from the worker running the job.')
+    deadline = models.DateTimeField(verbose_name='Deadline', null=True, blank=True, help_text='When the running container will be stopped.')
+    parameter_grid = models.TextField(verbose_name='Parameter Grid', blank=True, help_text='JSON object mapping environment variable names to lists of values. The job runs once for every combination of them.')
+    stages = models.TextField(verbose_name='Stages', blank=True, help_text='JSON list of the top-level directories of a pipeline, each with its own Dockerfile, run one after the other on a shared volume.')
+    parent = models.ForeignKey('self', verbose_name='Parent Job', related_name='runs', null=True, blank=True, on_delete=models.CASCADE, help_text='Array job or pipeline this is a run or stage of.')
+    run_index = models.PositiveIntegerField(verbose_name='Run', null=True, blank=True)
+    stage = models.CharField(verbose_name='Stage', max_length=64, blank=True, help_text='Directory of the Dockerfile this pipeline stage runs.')
+    parameters = models.TextField(verbose_name='Parameters', blank=True, help_text="JSON object of this run's environment variables.")
 
     def output_filename(self):
         return os.path.basename(self.output.file.name)
@@ -114,6 +143,12 @@ class Job(models.Model):
     def errors_filename(self):
         return os.path.basename(self.errors.file.name)
 
+    def build_log_filename(self):
+        return os.path.basename(self.build_log.file.name)
+
+    def artifacts_filename(self):
+        return os.path.basename(self.artifacts.file.name)
+
     @property
     def status_enum(self):
         return self.Status[self.status]
@@ -125,16 +160,49 @@ class Job(models.Model):
     def status_badge(self):
         return status_type_badges[self.status_enum]
 
+    @property
+    def is_array(self):
+        return bool(self.parameter_grid)
+
+    @property
+    def is_pipeline(self):
+        return bool(self.stages)
+
+    def pipeline_stages(self):
+        """The (directory, stage run or None if it has not been queued yet) of every stage of a pipeline"""
+        runs = {run.run_index: run for run in self.runs.all()}
+        return [(stage, runs.get(index)) for index, stage in enumerate(json.loads(self.stages))]
+
+    def volume_path(self):
+        """The job's scratch directory under PRIVATE_JOB_OUTPUT_ROOT, shared by all the stages of a pipeline"""
+        owner = self.parent if self.stage else self
+        return os.path.join(settings.PRIVATE_JOB_OUTPUT_ROOT, owner.owner.username, str(owner.id))
+
+    def run_parameters(self):
+        return json.loads(self.parameters) if self.parameters else {}
+
+    def parameters_label(self):
+        return ' '.join(f'{name}={value}' for name, value in self.run_parameters().items())
+
+    def environment(self):
+        """The environment of the job's container: JOB_ENV_DICT, plus this run's parameters for a run of an array job"""
+        return dict(settings.JOB_ENV_DICT, **self.run_parameters())
+
     def can_view(self, user):
+        if self.parent_id:
+            return self.parent.can_view(user)
         return user.is_staff or user == self.owner or user in self.collaborators.all()
 
+    def clamp_requests(self):
+        """Bring the job's requested CPUs, memory and timeout within the JOB_MAX_* ceilings"""
+        self.cpus, self.memory_mb, self.timeout = clamp_requests(self.cpus, self.memory_mb, self.timeout)
+
     def _enqueue(self):
-        try:
-            from .celery import task_run_job
-            task_run_job.apply_async(countdown=10, args=[self.id])
-        except Exception:
-            self._queue_failed()
-            raise
+        # The scheduler decides when the job actually gets dispatched to a
+        # runner. It is woken through the outbox, so it only runs once the
+        # approval is committed, and a broker outage only delays it.
+        from . import outbox
+        outbox.enqueue('jobs.celery.task_schedule_jobs')
 
     @fsm_log_by
     @transition(field=status, source=Status.QUEUED.name, target=Status.QUEUED_ERROR.name)
@@ -144,6 +212,16 @@ class Job(models.Model):
     @fsm_log_by
     @transition(field=status, source=Status.PENDING_CODE_REVIEW.name, target=Status.QUEUED.name)
     def approve_code(self, by=None):
+        # Staff may have adjusted the requests while reviewing
+        self.clamp_requests()
+        # Approved once for every run or stage, which the scheduler then runs
+        # instead of the array job or pipeline itself
+        if self.is_array:
+            from . import arrays
+            arrays.create_runs(self)
+        elif self.is_pipeline:
+            from . import pipelines
+            pipelines.queue_stage(self, 0)
         self._enqueue()
 
     @fsm_log_by
@@ -156,35 +234,72 @@ class Job(models.Model):
     def run_job(self, by=None):
         pass
 
+    @fsm_log_by
+    @transition(field=status, source=Status.RUNNING.name, target=Status.QUEUED.name)
+    def requeue(self, by=None):
+        # No node had room for the admitted job; the scheduler admits it again
+        self.dispatched_at = None
+        self.runner_node = ''
+
     @fsm_log_by
     @transition(field=status, source=Status.RUNNING.name, target=Status.RUN_ERROR.name)
     def error_job_run(self, by=None):
         pass
 
-    @transition(field=status, source=Status.RUNNING.name, target=Status.PENDING_OUTPUT_REVIEW.name)
-    def complete_job_run(self, output=None, errors=None):
+    @fsm_log_by
+    @transition(field=status, source=[Status.QUEUED.name, Status.RUNNING.name], target=Status.CANCELLED.name)
+    def cancel(self, by=None):
+        # The job stops counting against the scheduler's capacity right away;
+        # its container is stopped once the cancellation is committed
+        from . import outbox
+        outbox.enqueue('jobs.celery.task_stop_job', self)
+        for run in self.runs.filter(status__in=[self.Status.QUEUED.name, self.Status.RUNNING.name]):
+            run.cancel(by=by)
+            run.save()
+
+    # output and errors are the names of the files the runner streamed the
+    # container's stdout and stderr into in private storage, artifacts the
+    # archive of its volume
+
+    def set_run_files(self, output=None, errors=None, artifacts=None):
         if output:
-            self.output.save(f'{self.id}-{int(time.time())}.out', ContentFile(output))
+            self.output.name = output
         if errors:
-            self.errors.save(f'{self.id}-{int(time.time())}.err', ContentFile(errors))
+            self.errors.name = errors
+        if artifacts:
+            self.artifacts.name = artifacts
 
     @transition(field=status, source=Status.RUNNING.name, target=Status.PENDING_OUTPUT_REVIEW.name)
-    def fail_job_run(self, output=None, errors=None):
+    def complete_job_run(self, output=None, errors=None, artifacts=None):
+        self.set_run_files(output, errors, artifacts)
+
+    @transition(field=status, source=Status.RUNNING.name, target=Status.PENDING_OUTPUT_REVIEW.name)
+    def fail_job_run(self, output=None, errors=None, artifacts=None):
         self.failed = True
-        if output:
-            self.output.save(f'{self.id}-{int(time.time())}.out', ContentFile(output))
-        if errors:
-            self.errors.save(f'{self.id}-{int(time.time())}.err', ContentFile(errors))
+        self.set_run_files(output, errors, artifacts)
 
     @fsm_log_by
     @transition(field=status, source=Status.PENDING_OUTPUT_REVIEW.name, target=Status.RELEASED.name)
     def approve_output(self, by=None):
-        pass
+        self._review_runs('approve_output', by)
 
     @fsm_log_by
     @transition(field=status, source=Status.PENDING_OUTPUT_REVIEW.name, target=Status.OUTPUT_REJECTED.name)
     def reject_output(self, by=None):
-        pass
+        self._review_runs('reject_output', by)
+
+    def _review_runs(self, transition_name, by):
+        # An array job's output is reviewed as a whole, along with its runs'.
+        # A pipeline's is its last stage's; the output of the stages before
+        # it was never reviewed, so it is never released.
+        runs = self.runs.filter(status=self.Status.PENDING_OUTPUT_REVIEW.name).order_by('run_index')
+        last_stage = len(json.loads(self.stages)) - 1 if self.is_pipeline else None
+        for run in runs:
+            if self.is_pipeline and run.run_index != last_stage:
+                run.reject_output(by=by)
+            else:
+                getattr(run, transition_name)(by=by)
+            run.save()
 
     @fsm_log_by
     @transition(field=status, source=Status.PENDING_CODE_REVIEW.name, target=Status.DELETED.name)
@@ -195,6 +310,22 @@ class Job(models.Model):
         return f'<Job {self.id}:{self.name}:{self.submitted_at}:{self.owner}:{self.filename}:{self.status}>'
 
 
+def runnable_jobs():
+    """Jobs that run a container of their own, unlike array jobs and pipelines, whose runs and stages do"""
+    return Job.objects.filter(parameter_grid='', stages='')
+
+def clamp_requests(cpus, memory_mb, timeout):
+    """Return requested CPUs, megabytes of memory and timeout seconds lowered to the JOB_MAX_* ceilings, None meaning the default"""
+    if cpus is not None and settings.JOB_MAX_CPUS:
+        cpus = min(cpus, settings.JOB_MAX_CPUS)
+    if memory_mb is not None and settings.JOB_MAX_MEMORY_MB:
+        memory_mb = min(memory_mb, settings.JOB_MAX_MEMORY_MB)
+    # A timeout of 0 asks for no limit at all
+    if timeout is not None and settings.JOB_MAX_TIMEOUT and not 0 < timeout <= settings.JOB_MAX_TIMEOUT:
+        timeout = settings.JOB_MAX_TIMEOUT
+    return cpus, memory_mb, timeout
+
+
 class Comment(models.Model):
     job = models.ForeignKey(Job, verbose_name='Job', related_name='comments', on_delete=models.CASCADE)
     text = models.CharField(verbose_name='Text', max_length=1024)
@@ -205,6 +336,100 @@ class Comment(models.Model):
         return f'{self.job.id}@{self.timestamp}-- {self.by}: {self.text}'
 
 
+class JobPhaseTiming(models.Model):
+    PHASES = (
+        ('queue', 'Queue'),
+        ('dispatch', 'Dispatch'),
+        ('extract', 'Extract'),
+        ('pull', 'Pull'),
+        ('build', 'Build'),
+        ('push', 'Push'),
+        ('run', 'Run'),
+        ('collect', 'Collect'),
+    )
+
+    job = models.ForeignKey(Job, verbose_name='Job', related_name='phase_timings', on_delete=models.CASCADE)
+    phase = models.CharField(verbose_name='Phase', max_length=16, choices=PHASES)
+    started_at = models.DateTimeField(verbose_name='Started At')
+    duration = models.FloatField(verbose_name='Duration', help_text='Seconds.')
+
+    class Meta:
+        ordering = ['started_at']
+
+    def __str__(self):
+        return f'<JobPhaseTiming {self.job_id}:{self.phase}:{self.duration:.3f}s>'
+
+
+class JobResourceUsage(models.Model):
+    job = models.OneToOneField(Job, verbose_name='Job', related_name='resource_usage', on_delete=models.CASCADE)
+    cpu_seconds = models.FloatField(verbose_name='CPU Time', default=0, help_text='Seconds, over all cores.')
+    peak_memory = models.BigIntegerField(verbose_name='Peak Memory', default=0, help_text='Bytes.')
+    block_read = models.BigIntegerField(verbose_name='Block Read', default=0, help_text='Bytes.')
+    block_written = models.BigIntegerField(verbose_name='Block Written', default=0, help_text='Bytes.')
+    network_received = models.BigIntegerField(verbose_name='Network Received', default=0, help_text='Bytes.')
+    network_sent = models.BigIntegerField(verbose_name='Network Sent', default=0, help_text='Bytes.')
+    wall_seconds = models.FloatField(verbose_name='Sampled For', default=0, help_text='Seconds.')
+    samples = models.PositiveIntegerField(verbose_name='Samples', default=0)
+    recorded_at = models.DateTimeField(verbose_name='Recorded At', auto_now=True)
+
+    @property
+    def cpu_cores(self):
+        """Average number of cores busy while sampled"""
+        return self.cpu_seconds / self.wall_seconds if self.wall_seconds else 0
+
+    def __str__(self):
+        return f'<JobResourceUsage {self.job_id}:{self.cpu_seconds:.1f}s:{self.peak_memory}>'
+
+
+class JobDispatch(models.Model):
+    task = models.CharField(verbose_name='Task', max_length=255)
+    job = models.ForeignKey(Job, verbose_name='Job', related_name='dispatches', null=True, blank=True, on_delete=models.CASCADE, help_text='Passed to the task as its only argument, if set.')
+    created_at = models.DateTimeField(verbose_name='Created At', auto_now_add=True)
+    published_at = models.DateTimeField(verbose_name='Published At', null=True, blank=True)
+    attempts = models.PositiveIntegerField(verbose_name='Attempts', default=0)
+    last_error = models.TextField(verbose_name='Last Error', blank=True)
+
+    def __str__(self):
+        return f'<JobDispatch {self.id}:{self.task}:{self.job_id}:{self.published_at}>'
+
+
+class CachedImage(models.Model):
+    node = models.CharField(verbose_name='Runner Node', max_length=255)
+    digest = models.CharField(verbose_name='Digest', max_length=64, help_text='SHA-256 of the submission file the image was built from.')
+    image_id = models.CharField(verbose_name='Image ID', max_length=128, blank=True, help_text='Blank once the image has been evicted from the runner.')
+    size = models.BigIntegerField(verbose_name='Size', default=0)
+    created_at = models.DateTimeField(verbose_name='Created At', auto_now_add=True)
+    last_used_at = models.DateTimeField(verbose_name='Last Used At', auto_now=True)
+    hits = models.PositiveIntegerField(verbose_name='Hits', default=0)
+    misses = models.PositiveIntegerField(verbose_name='Misses', default=0)
+
+    class Meta:
+        unique_together = ('node', 'digest')
+
+    @property
+    def tag(self):
+        return f'{settings.JOB_IMAGE_CACHE_REPOSITORY}:{self.digest}'
+
+    def __str__(self):
+        return f'<CachedImage {self.digest[:12]}:{self.image_id}:{self.hits}/{self.misses}>'
+
+
+class RegistryImage(models.Model):
+    digest = models.CharField(verbose_name='Digest', max_length=64, unique=True, help_text='SHA-256 of the submission file the image was built from, and its tag in the registry.')
+    manifest_digest = models.CharField(verbose_name='Manifest Digest', max_length=128, blank=True, help_text='Looked up from the registry when blank.')
+    size = models.BigIntegerField(verbose_name='Size', default=0)
+    pushed_at = models.DateTimeField(verbose_name='Pushed At', auto_now_add=True)
+    last_used_at = models.DateTimeField(verbose_name='Last Used At', default=timezone.now)
+    pulls = models.PositiveIntegerField(verbose_name='Pulls', default=0)
+
+    @property
+    def name(self):
+        return f'{settings.JOB_IMAGE_REGISTRY}/{settings.JOB_IMAGE_CACHE_REPOSITORY}:{self.digest}'
+
+    def __str__(self):
+        return f'<RegistryImage {self.digest[:12]}:{self.pulls}>'
+
+
 status_type_badges = {
     Job.Status.DELETED: 'dark',
     Job.Status.PENDING_CODE_REVIEW: 'secondary',
@@ -213,6 +438,7 @@ status_type_badges = {
     Job.Status.QUEUED_ERROR: 'danger',
     Job.Status.RUNNING: 'info',
     Job.Status.RUN_ERROR: 'danger',
+    Job.Status.CANCELLED: 'dark',
     Job.Status.PENDING_OUTPUT_REVIEW: 'warning',
     Job.Status.OUTPUT_REJECTED: 'danger',
     Job.Status.RELEASED: 'success',
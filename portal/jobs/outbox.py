@@ -0,0 +1,52 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import JobDispatch
+
+
+def enqueue(task, job=None):
+    """
+    Record that task (by name) is to be sent, with job's ID as its argument if
+    given, in the current transaction. It is published as soon as the
+    transaction commits, and by the sweeper should that fail.
+    """
+    dispatch = JobDispatch.objects.create(task=task, job=job)
+    transaction.on_commit(lambda: publish(dispatch.id))
+    return dispatch
+
+def publish(dispatch_id):
+    """Send an unpublished dispatch to the broker, returning whether it was sent"""
+    from .celery import app
+    with transaction.atomic():
+        # The row lock keeps the sweeper and on_commit from both sending it
+        dispatch = JobDispatch.objects.select_for_update().filter(pk=dispatch_id, published_at=None).first()
+        if dispatch is None:
+            return False
+        dispatch.attempts += 1
+        try:
+            app.send_task(dispatch.task, args=[dispatch.job_id] if dispatch.job_id else [])
+        except Exception as ex:
+            print(ex)
+            dispatch.last_error = str(ex)
+            dispatch.save(update_fields=['attempts', 'last_error'])
+            return False
+        dispatch.published_at = timezone.now()
+        dispatch.save(update_fields=['attempts', 'published_at'])
+    return True
+
+def sweep():
+    """
+    Publish dispatches left unpublished for JOB_DISPATCH_SWEEP_AFTER seconds,
+    e.g. because the broker was down at commit, and forget published ones after
+    JOB_DISPATCH_RETENTION seconds. Returns the number published.
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=settings.JOB_DISPATCH_SWEEP_AFTER)
+    pending = JobDispatch.objects.filter(published_at=None, created_at__lt=stale).order_by('id')
+    published = sum(publish(dispatch_id) for dispatch_id in pending.values_list('id', flat=True))
+    expired = now - datetime.timedelta(seconds=settings.JOB_DISPATCH_RETENTION)
+    JobDispatch.objects.filter(published_at__lt=expired).delete()
+    return published
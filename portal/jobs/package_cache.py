@@ -0,0 +1,75 @@
+import re
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+import requests
+
+
+# Lines of squid's mgr:info report, and their 60 minute average where it has one
+STATS = {
+    'requests': 'Number of HTTP requests received',
+    'hit_ratio': 'Hits as % of all requests',
+    'byte_hit_ratio': 'Hits as % of bytes sent',
+    'disk_kilobytes': 'Storage Swap size',
+    'disk_capacity': 'Storage Swap capacity',
+}
+PERCENTAGE = re.compile(r'60min: ([\d.]+)%')
+
+
+def build_args():
+    """Return the build args sending an image build's downloads through its daemon's package cache"""
+    if not settings.RUNNER_PACKAGE_CACHE_PORT:
+        return {}
+    proxy = settings.RUNNER_PACKAGE_CACHE_BUILD_PROXY
+    # Docker's predefined proxy args need no ARG in the Dockerfile and are left
+    # out of the image's history
+    return {name: proxy for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY')}
+
+def proxy_url(host):
+    """Return the package cache of the daemon at a RUNNER_DOCKER_HOSTS URL, as seen from this worker"""
+    return f'http://{urlparse(host).hostname}:{settings.RUNNER_PACKAGE_CACHE_PORT}'
+
+def stats(host):
+    """Return the hit rates and disk use of a daemon's package cache, from squid's cache manager"""
+    response = requests.get(f'{proxy_url(host)}/squid-internal-mgr/info', timeout=settings.RUNNER_PACKAGE_CACHE_TIMEOUT)
+    response.raise_for_status()
+    report = {}
+    for line in response.text.splitlines():
+        label, _, value = line.strip().partition(':')
+        report[label] = value.strip()
+    result = {}
+    for key, label in STATS.items():
+        value = report.get(label, '')
+        match = PERCENTAGE.search(value)
+        if match:
+            result[key] = float(match.group(1))
+        elif key == 'disk_capacity':
+            result[key] = value
+        else:
+            result[key] = int(value.split()[0]) if value else None
+    return result
+
+def seed(host, urls):
+    """
+    Download urls through a daemon's package cache so that builds find them
+    there, returning (cached URLs, failed URLs). Only plain HTTP downloads can
+    be cached, HTTPS URLs are refused.
+    """
+    proxy = proxy_url(host)
+    cached, failed = [], []
+    for url in urls:
+        if urlparse(url).scheme != 'http':
+            failed.append(url)
+            continue
+        try:
+            with requests.get(url, proxies={'http': proxy}, stream=True, timeout=settings.RUNNER_PACKAGE_CACHE_TIMEOUT) as response:
+                response.raise_for_status()
+                for _ in response.iter_content(settings.JOB_FILE_CHUNK_SIZE):
+                    pass
+        except requests.exceptions.RequestException as ex:
+            print(f'{url}: {ex}')
+            failed.append(url)
+        else:
+            cached.append(url)
+    return cached, failed
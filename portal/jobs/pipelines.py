@@ -0,0 +1,96 @@
+import re
+import json
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Job
+from .arrays import finished
+from . import outbox
+
+
+# Stage directories double as part of their image's cache key
+STAGE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+
+
+def parse_stages(text):
+    """
+    Return the stage directories in a JSON list of them. Raises ValueError if
+    it is not one, or has fewer than two or more than JOB_PIPELINE_MAX_STAGES.
+    """
+    try:
+        stages = json.loads(text)
+    except ValueError:
+        raise ValueError('The stages are not valid JSON')
+    if not isinstance(stages, list) or not all(isinstance(stage, str) for stage in stages):
+        raise ValueError('The stages must be a list of directory names')
+    if len(stages) < 2:
+        raise ValueError('A pipeline needs at least two stages')
+    if settings.JOB_PIPELINE_MAX_STAGES and len(stages) > settings.JOB_PIPELINE_MAX_STAGES:
+        raise ValueError(f'At most {settings.JOB_PIPELINE_MAX_STAGES} stages are allowed')
+    for stage in stages:
+        if not STAGE_NAME.match(stage):
+            raise ValueError(f'{stage!r} is not a valid stage directory name')
+    if len(set(stages)) < len(stages):
+        raise ValueError('Every stage needs its own directory')
+    return stages
+
+def queue_stage(job, index):
+    """Create the QUEUED run of the pipeline's stage at index"""
+    Job.objects.create(
+        name=job.name,
+        description=job.description,
+        status=Job.Status.QUEUED.name,
+        owner=job.owner,
+        filename=job.filename,
+        file=job.file.name,
+        cpus=job.cpus,
+        memory_mb=job.memory_mb,
+        timeout=job.timeout,
+        run_after=job.run_after,
+        off_peak=job.off_peak,
+        parent=job,
+        run_index=index,
+        stage=json.loads(job.stages)[index],
+    )
+
+def is_last_stage(stage):
+    return stage.run_index == len(json.loads(stage.parent.stages)) - 1
+
+def previous_node(stage):
+    """The node the stage before this one ran on, which holds the pipeline's volume; None for the first stage"""
+    if not stage.run_index:
+        return None
+    return stage.parent.runs.get(run_index=stage.run_index - 1).runner_node or None
+
+def stage_finished(stage):
+    """
+    Move the pipeline on once a stage is over: queue the next stage after a
+    successful one, else complete the pipeline with the stage's output, failed
+    unless the stage was the last and succeeded. Returns whether it did.
+    """
+    with transaction.atomic():
+        # The row lock keeps a stage's collection and its cancellation from both
+        # moving the pipeline on
+        job = Job.objects.select_for_update().get(pk=stage.parent_id)
+        stage = Job.objects.get(pk=stage.pk)
+        if not finished(stage) or job.runs.filter(run_index__gt=stage.run_index).exists():
+            return False
+        succeeded = stage.status_enum is Job.Status.PENDING_OUTPUT_REVIEW and not stage.failed
+        if job.status_enum is Job.Status.QUEUED:
+            # The first stage was cancelled before it started
+            job.cancel()
+        if job.status_enum is Job.Status.CANCELLED:
+            job.set_run_files(stage.output.name, stage.errors.name, stage.artifacts.name)
+        elif job.status_enum is not Job.Status.RUNNING:
+            return False
+        elif succeeded and not is_last_stage(stage):
+            queue_stage(job, stage.run_index + 1)
+            outbox.enqueue('jobs.celery.task_schedule_jobs')
+            return True
+        elif succeeded:
+            job.complete_job_run(stage.output.name, stage.errors.name, stage.artifacts.name)
+        else:
+            job.fail_job_run(stage.output.name, stage.errors.name, stage.artifacts.name)
+        job.save()
+    return True
@@ -0,0 +1,59 @@
+import uuid
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+import docker
+import requests
+
+from .models import Job, runnable_jobs
+from .backends import get_backend
+
+
+def orphaned_jobs():
+    """
+    RUNNING jobs, and CANCELLED ones whose container is still to be collected,
+    that no worker has shown signs of life for in RUNNER_RECONCILE_AFTER seconds
+    """
+    stale = timezone.now() - datetime.timedelta(seconds=settings.RUNNER_RECONCILE_AFTER)
+    collecting = Q(status=Job.Status.RUNNING.name) | (Q(status=Job.Status.CANCELLED.name) & ~Q(container_id=''))
+    return runnable_jobs().filter(collecting).filter(Q(heartbeat_at__lt=stale) | Q(heartbeat_at=None))
+
+def reconcile_jobs(resume, fail):
+    """
+    Call resume(job) to queue the run stage again for orphaned jobs whose
+    container still exists, running or not, after recording it on the job, and
+    for built jobs whose container was never started, e.g. as their run stage
+    is still waiting in the queue. Call fail(job) for the rest, whose container
+    is gone or which died building. Jobs on daemons that cannot be reached are
+    left for the next pass.
+    """
+    for job in orphaned_jobs():
+        # Claim the job by bumping its heartbeat, so an overlapping pass skips
+        # it, and hand its run stage to the one resume queues, so a run stage
+        # queued before is ignored
+        job.run_task_id = str(uuid.uuid4())
+        claimed = Job.objects.filter(pk=job.pk, heartbeat_at=job.heartbeat_at).update(heartbeat_at=timezone.now(), run_task_id=job.run_task_id)
+        if not claimed:
+            continue
+        if not job.runner_node:
+            # Died before it was placed, so no container was ever started
+            fail(job)
+            continue
+        try:
+            container_id = get_backend().find(job)
+        except (docker.errors.APIError, requests.exceptions.RequestException) as ex:
+            print(f'{job.runner_node}: {ex}')
+            continue
+        if container_id is not None:
+            job.container_id = container_id
+            job.save(update_fields=['container_id'])
+            resume(job)
+        elif job.image_id and not job.container_id:
+            # Built, but its run stage never started the container: it is late
+            # or was lost
+            resume(job)
+        else:
+            fail(job)
@@ -0,0 +1,96 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+import docker
+import requests
+
+from .models import RegistryImage
+
+
+MANIFEST_MEDIA_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+def repository():
+    return f'{settings.JOB_IMAGE_REGISTRY}/{settings.JOB_IMAGE_CACHE_REPOSITORY}'
+
+def touch_image(digest):
+    """Mark the registry's image built from the file with this digest as used, returning whether it has one"""
+    return RegistryImage.objects.filter(digest=digest).update(last_used_at=timezone.now()) > 0
+
+def pull_image(docker_client, digest):
+    """Pull the image built from the file with this digest onto a daemon, or return None if the registry has none"""
+    if not touch_image(digest):
+        return None
+    try:
+        image = docker_client.images.pull(repository(), tag=digest)
+    except docker.errors.NotFound:
+        # Deleted from the registry behind our back
+        RegistryImage.objects.filter(digest=digest).delete()
+        return None
+    RegistryImage.objects.filter(digest=digest).update(pulls=F('pulls') + 1)
+    # Left with the registry's name as well, evicting it from the image cache
+    # would not remove it from the daemon
+    image.tag(settings.JOB_IMAGE_CACHE_REPOSITORY, digest)
+    docker_client.images.remove(f'{repository()}:{digest}', noprune=True)
+    return image
+
+def push_image(docker_client, image, digest):
+    """Push an image cached under the digest of its submission file to the registry, returning whether it got there"""
+    image.tag(repository(), digest)
+    manifest_digest = ''
+    try:
+        for chunk in docker_client.images.push(repository(), tag=digest, stream=True, decode=True):
+            if 'error' in chunk:
+                raise docker.errors.APIError(chunk['error'])
+            manifest_digest = chunk.get('aux', {}).get('Digest', manifest_digest)
+    except (docker.errors.APIError, requests.exceptions.ConnectionError) as ex:
+        # The job can still run from the daemon's copy
+        print(ex)
+        return False
+    finally:
+        docker_client.images.remove(f'{repository()}:{digest}', noprune=True)
+    add_image(digest, manifest_digest, image.attrs.get('Size', 0))
+    return True
+
+def add_image(digest, manifest_digest='', size=0):
+    """Record an image pushed to the registry with the digest of its submission file as its tag"""
+    RegistryImage.objects.update_or_create(digest=digest, defaults={
+        'manifest_digest': manifest_digest,
+        'size': size,
+        'last_used_at': timezone.now(),
+    })
+
+def expire_images():
+    """Delete the images no job has used for JOB_IMAGE_REGISTRY_MAX_AGE from the registry, returning their digests"""
+    max_age = datetime.timedelta(seconds=settings.JOB_IMAGE_REGISTRY_MAX_AGE)
+    expired = []
+    for entry in RegistryImage.objects.filter(last_used_at__lt=timezone.now() - max_age):
+        try:
+            _delete_manifest(entry)
+        except requests.exceptions.RequestException as ex:
+            print(f'{entry.name}: {ex}')
+            continue
+        entry.delete()
+        expired.append(entry.digest)
+    return expired
+
+def _delete_manifest(entry):
+    # Manifests can only be deleted by their own digest, not by tag. The
+    # registry frees the layers on its next garbage-collect.
+    manifests_url = f'{settings.JOB_IMAGE_REGISTRY_URL}/v2/{settings.JOB_IMAGE_CACHE_REPOSITORY}/manifests'
+    manifest_digest = entry.manifest_digest
+    if not manifest_digest:
+        response = requests.head(
+            f'{manifests_url}/{entry.digest}', headers={'Accept': MANIFEST_MEDIA_TYPE},
+            timeout=settings.JOB_IMAGE_REGISTRY_TIMEOUT,
+        )
+        if response.status_code == 404:
+            return
+        response.raise_for_status()
+        manifest_digest = response.headers['Docker-Content-Digest']
+    response = requests.delete(f'{manifests_url}/{manifest_digest}', timeout=settings.JOB_IMAGE_REGISTRY_TIMEOUT)
+    if response.status_code != 404:
+        response.raise_for_status()
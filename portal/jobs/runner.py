@@ -0,0 +1,175 @@
+import time
+from collections import Counter
+
+from django.conf import settings
+
+import docker
+import requests
+from docker.transport import SSLAdapter
+
+from .models import Job, runnable_jobs
+from . import scheduler
+
+
+class NoRunnerAvailable(Exception):
+    pass
+
+
+# Label on every job container holding the job's ID, so a container can be
+# found again even if its ID was never saved
+JOB_LABEL = 'privascope.job'
+
+
+# One client per runner daemon and worker process, so connections (and TLS
+# sessions) are pooled across jobs instead of being set up for each one
+_docker_clients = {}
+_docker_clients_checked_at = {}
+
+
+def _connect(host):
+    kwargs = docker.utils.kwargs_from_env()
+    kwargs['base_url'] = host
+    docker_client = docker.DockerClient(timeout=settings.RUNNER_DOCKER_TIMEOUT, **kwargs)
+    # docker-py's num_pools only sets how many hosts' pools are kept, each of
+    # requests' default size, so mount adapters whose one pool is sized instead
+    tls = kwargs.get('tls')
+    if tls:
+        adapter = SSLAdapter(
+            ssl_version=tls.ssl_version,
+            assert_hostname=tls.assert_hostname,
+            assert_fingerprint=tls.assert_fingerprint,
+            pool_connections=1,
+            pool_maxsize=settings.RUNNER_DOCKER_POOL_SIZE,
+        )
+    else:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.RUNNER_DOCKER_POOL_SIZE)
+    docker_client.api.mount('https://' if tls else 'http://', adapter)
+    return docker_client
+
+def reset_docker_clients():
+    """Drop this process's clients, e.g. after a fork, so the next use connects afresh"""
+    for host in list(_docker_clients):
+        reset_docker_client(host)
+
+def reset_docker_client(host):
+    docker_client = _docker_clients.pop(host, None)
+    if docker_client is not None:
+        docker_client.close()
+
+def get_docker_client(host):
+    """
+    Return this process's Docker client for a runner daemon, connecting on first use.
+
+    A client idle for more than RUNNER_DOCKER_HEALTH_CHECK_INTERVAL seconds is
+    pinged first and replaced if the daemon does not answer.
+    """
+    now = time.monotonic()
+    docker_client = _docker_clients.get(host)
+    if docker_client is not None and now - _docker_clients_checked_at[host] > settings.RUNNER_DOCKER_HEALTH_CHECK_INTERVAL:
+        try:
+            docker_client.ping()
+        except (docker.errors.APIError, requests.exceptions.RequestException):
+            reset_docker_client(host)
+            docker_client = None
+    if docker_client is None:
+        docker_client = _connect(host)
+        docker_client.ping()
+        _docker_clients[host] = docker_client
+    _docker_clients_checked_at[host] = now
+    return docker_client
+
+def _node_load(host):
+    """Return (running containers, bytes of memory) of a daemon"""
+    info = get_docker_client(host).info()
+    return info['ContainersRunning'], info['MemTotal']
+
+def _reserved_memory(job_id):
+    """Return the bytes of memory reserved by the RUNNING jobs on each node, but the job being placed"""
+    reserved = Counter()
+    for job in runnable_jobs().filter(status=Job.Status.RUNNING.name).exclude(runner_node='').exclude(pk=job_id):
+        reserved[job.runner_node] += scheduler.job_reservation(job)[1]
+    return reserved
+
+def choose_docker_host(reservation, job_id=None):
+    """
+    Return the least loaded healthy daemon in RUNNER_DOCKER_HOSTS for a job
+    reserving (CPUs, bytes of memory), as from jobs.scheduler.job_reservation.
+    The job's own reservation, left on a node by an earlier attempt, is not
+    counted.
+
+    Daemons that do not answer, or without room for the job's memory next to
+    what the RUNNING jobs placed on them reserve, are skipped. Among the rest
+    the one running the fewest containers wins, then the one with the most
+    memory left.
+    """
+    memory = reservation[1]
+    reserved = _reserved_memory(job_id)
+    candidates = []
+    for host in settings.RUNNER_DOCKER_HOSTS:
+        try:
+            running, total_memory = _node_load(host)
+        except (docker.errors.APIError, requests.exceptions.RequestException) as ex:
+            print(f'{host}: {ex}')
+            continue
+        free_memory = total_memory - reserved[host]
+        if free_memory >= memory:
+            candidates.append((running, -free_memory, host))
+    if not candidates:
+        raise NoRunnerAvailable('No healthy runner daemon has capacity for another job')
+    return min(candidates)[2]
+
+def cluster_capacity():
+    """Return the total (CPUs, bytes of memory) of the healthy daemons in RUNNER_DOCKER_HOSTS"""
+    cpus, memory = 0, 0
+    for host in settings.RUNNER_DOCKER_HOSTS:
+        try:
+            info = get_docker_client(host).info()
+        except (docker.errors.APIError, requests.exceptions.RequestException) as ex:
+            print(f'{host}: {ex}')
+            continue
+        cpus += info['NCPU']
+        memory += info['MemTotal']
+    return cpus, memory
+
+def _split_image_name(name):
+    repository, _, tag = name.rpartition(':')
+    if not repository or '/' in tag:
+        # No tag, only a registry port
+        return name, 'latest'
+    return repository, tag
+
+def base_image_status():
+    """Return {host: {image: present}} for RUNNER_BASE_IMAGES, None for daemons that do not answer"""
+    status = {}
+    for host in settings.RUNNER_DOCKER_HOSTS:
+        try:
+            docker_client = get_docker_client(host)
+            present = {}
+            for name in settings.RUNNER_BASE_IMAGES:
+                try:
+                    docker_client.images.get(':'.join(_split_image_name(name)))
+                    present[name] = True
+                except docker.errors.ImageNotFound:
+                    present[name] = False
+            status[host] = present
+        except (docker.errors.APIError, requests.exceptions.RequestException) as ex:
+            print(f'{host}: {ex}')
+            status[host] = None
+    return status
+
+def prewarm_base_images():
+    """
+    Pull every RUNNER_BASE_IMAGES image on every daemon, so builds starting FROM
+    one of them never wait for the pull. Pulling an image that is already
+    present only refreshes it if its tag moved. Returns {host: [pulled images]}.
+    """
+    pulled = {}
+    for host in settings.RUNNER_DOCKER_HOSTS:
+        pulled[host] = []
+        for name in settings.RUNNER_BASE_IMAGES:
+            try:
+                get_docker_client(host).images.pull(*_split_image_name(name))
+                pulled[host].append(name)
+            except (docker.errors.APIError, requests.exceptions.RequestException) as ex:
+                print(f'{host}: {ex}')
+    return pulled
@@ -0,0 +1,157 @@
+import datetime
+from collections import Counter, OrderedDict, deque
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Avg
+from django.utils import timezone
+
+import docker
+
+from .models import Job, JobPhaseTiming, runnable_jobs
+from .backends import get_backend
+
+
+# A weight of 0 or less would divide by zero, or give its owner every turn
+MIN_USER_WEIGHT = 0.01
+
+
+def job_reservation(job):
+    """Return the (CPUs, bytes of memory) a job's container may use: what was approved for it, else the JOB_CONTAINER_* limits"""
+    if job.cpus:
+        cpus = job.cpus
+    elif settings.JOB_CONTAINER_CPU_QUOTA and settings.JOB_CONTAINER_CPU_PERIOD:
+        cpus = settings.JOB_CONTAINER_CPU_QUOTA / settings.JOB_CONTAINER_CPU_PERIOD
+    else:
+        cpus = 1
+    if job.memory_mb:
+        return cpus, job.memory_mb * 1024 * 1024
+    return cpus, docker.utils.parse_bytes(settings.JOB_CONTAINER_MEM_LIMIT or 0)
+
+def _user_weight(username):
+    return max(settings.JOB_SCHEDULER_USER_WEIGHTS.get(username, 1), MIN_USER_WEIGHT)
+
+def active_jobs():
+    """Jobs holding cluster resources: dispatched to a worker or running"""
+    return runnable_jobs().filter(Q(status=Job.Status.RUNNING.name) | Q(status=Job.Status.QUEUED.name, dispatched_at__isnull=False))
+
+def pending_jobs():
+    """QUEUED jobs the scheduler has not admitted yet"""
+    return runnable_jobs().filter(status=Job.Status.QUEUED.name, dispatched_at__isnull=True)
+
+def built_arrays():
+    """IDs of the array jobs one of whose runs has got past building its image"""
+    runs = Job.objects.filter(parent__isnull=False)
+    started = runs.exclude(container_id='') | runs.exclude(status__in=[Job.Status.QUEUED.name, Job.Status.RUNNING.name])
+    return set(started.values_list('parent_id', flat=True))
+
+def _clock_time(value):
+    hours, minutes = value.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+def next_off_peak(moment):
+    """Return moment if it falls in the JOB_OFF_PEAK_START-JOB_OFF_PEAK_END window, else when the window next opens"""
+    start, end = _clock_time(settings.JOB_OFF_PEAK_START), _clock_time(settings.JOB_OFF_PEAK_END)
+    local = timezone.localtime(moment)
+    time_of_day = local.time()
+    if start == end or (start <= time_of_day < end if start < end else time_of_day >= start or time_of_day < end):
+        return moment
+    day = local.date() if time_of_day < start else local.date() + datetime.timedelta(days=1)
+    return timezone.make_aware(datetime.datetime.combine(day, start))
+
+def held_until(job, now=None):
+    """Return when a job held back by staff may be admitted, or None if it may be now"""
+    now = now or timezone.now()
+    opens = max(job.run_after or now, now)
+    if job.off_peak:
+        opens = next_off_peak(opens)
+    return opens if opens > now else None
+
+def schedule_jobs(dispatch):
+    """
+    Admit QUEUED jobs while the cluster has CPU and memory headroom.
+
+    Owners take turns by fair share: the next job comes from the owner with
+    the fewest active jobs relative to their JOB_SCHEDULER_USER_WEIGHTS weight,
+    oldest job first, and nobody gets more than
+    JOB_SCHEDULER_MAX_RUNNING_PER_USER active jobs. A job that does not fit
+    skips its owner for this round so smaller jobs can fill the gap.
+
+    Admitted jobs are stamped with dispatched_at and handed to dispatch(job)
+    in the same transaction. Returns the admitted jobs.
+
+    Only one run of an array job is admitted until one of them has built the
+    image, which the rest then find in the image cache or registry. Jobs held
+    until a later time or the off-peak window wait for it.
+    """
+    free_cpus, free_memory = get_backend().capacity()
+    now = timezone.now()
+    with transaction.atomic():
+        queues = OrderedDict()
+        for job in pending_jobs().select_for_update().select_related('owner').order_by('id'):
+            if held_until(job, now) is None:
+                queues.setdefault(job.owner, deque()).append(job)
+        active = Counter()
+        built, building = built_arrays(), set()
+        for job in active_jobs().select_related('owner'):
+            cpus, memory = job_reservation(job)
+            free_cpus -= cpus
+            free_memory -= memory
+            active[job.owner] += 1
+            if job.parent_id and job.parent_id not in built:
+                building.add(job.parent_id)
+        admitted = []
+        max_running = settings.JOB_SCHEDULER_MAX_RUNNING_PER_USER
+        while queues:
+            owner = min(queues, key=lambda o: (active[o] / _user_weight(o.username), queues[o][0].id))
+            job = queues[owner][0]
+            if job.parent_id in building:
+                queues[owner].popleft()
+                if not queues[owner]:
+                    del queues[owner]
+                continue
+            cpus, memory = job_reservation(job)
+            if (max_running and active[owner] >= max_running) or cpus > free_cpus or memory > free_memory:
+                del queues[owner]
+                continue
+            queues[owner].popleft()
+            if not queues[owner]:
+                del queues[owner]
+            job.dispatched_at = timezone.now()
+            job.save(update_fields=['dispatched_at'])
+            dispatch(job)
+            free_cpus -= cpus
+            free_memory -= memory
+            active[owner] += 1
+            if job.parent_id and job.parent_id not in built:
+                building.add(job.parent_id)
+            admitted.append(job)
+    return admitted
+
+def queue_estimate(job):
+    """
+    Return (position, estimated start) of a job the scheduler has not admitted
+    yet, or of the next run of an array job or pipeline; None if there is none.
+
+    Its position counts the pending jobs due before it, the older ones first
+    when due at the same time, ignoring fair share. The estimate assumes every job takes the average run time of
+    the last JOB_ESTIMATE_SAMPLE runs, and that as many run at once as are
+    active now. It is None without any runs to go by, unless the job is held.
+    """
+    if job.is_array or job.is_pipeline:
+        job = pending_jobs().filter(parent=job).order_by('id').first()
+    if job is None or job.status_enum is not Job.Status.QUEUED or job.dispatched_at is not None:
+        return None
+    now = timezone.now()
+    opens = held_until(job, now) or now
+    ahead = sum(
+        1 for other in pending_jobs().exclude(pk=job.pk)
+        if ((held_until(other, now) or now), other.id) < (opens, job.id)
+    )
+    recent = JobPhaseTiming.objects.filter(phase='run').order_by('-started_at')[:settings.JOB_ESTIMATE_SAMPLE]
+    average = JobPhaseTiming.objects.filter(pk__in=list(recent.values_list('pk', flat=True))).aggregate(Avg('duration'))['duration__avg']
+    if average is None:
+        return ahead + 1, opens if opens > now else None
+    active = active_jobs().count()
+    waves = (active + ahead) // max(active, 1)
+    return ahead + 1, max(now + datetime.timedelta(seconds=waves * average), opens)
@@ -11,7 +11,8 @@ from .models import Job
 
 @receiver(post_save, sender=Job)
 def send_job_created_email(sender, instance, created, **kwargs):
-    if not created:
+    # The runs of an array job were reviewed along with it
+    if not created or instance.parent_id:
         return
     staff = User.objects.filter(is_staff=True)
     to = (s.email for s in staff)
@@ -74,6 +75,17 @@ def email_reject_output(job):
     email.content_subtype = "html"
     email.send()
 
+def email_cancel(job):
+    to = [job.owner.email]
+    cc = (c.email for c in job.collaborators.all())
+    subject = f'Job Cancelled: {job.name}'
+    url = settings.ABSOLUTE_URL_BASE + reverse('jobs:detail', args=(job.id,))
+    link = f'<a href="{url}">{job.id} ({job.name})</a>'
+    body = f'Your job {link} was cancelled. Any output it produced is kept for review.'
+    email = EmailMessage(subject, body, to=to, cc=cc)
+    email.content_subtype = "html"
+    email.send()
+
 def _notify_job_owner(job, is_failure):
     to = [job.owner.email]
     cc = (c.email for c in job.collaborators.all())
@@ -100,6 +112,7 @@ TRANSITION_EMAILS = {
     'reject_code': email_reject_code,
     'complete_job_run': email_complete_job_run,
     'fail_job_run': email_fail_job_run,
+    'cancel': email_cancel,
     'approve_output': email_approve_output,
     'reject_output': email_reject_output,
 }
@@ -108,6 +121,9 @@ TRANSITION_EMAILS = {
 def job_post_transition(sender, **kwargs): # instance, name, source, target
     name = kwargs['name']
     job = kwargs['instance']
+    if job.parent_id:
+        # Only the array job's own transitions are worth an email
+        return
     email = TRANSITION_EMAILS.get(name, None)
     if not email:
         return
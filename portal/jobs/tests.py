@@ -1,16 +1,84 @@
-from django.test import TestCase, Client, override_settings
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.files import File
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
 
-from .models import Job
-from .celery import run_job_docker
+from .models import Job, CachedImage, RegistryImage, JobResourceUsage, JobDispatch, JobPhaseTiming
+from .celery import run_job, run_container, collect_job, stop_container, task_build_job, task_run_container, task_stop_job, task_prewarm_base_images, task_sweep_runners, _reconcile_failed
+from .backends.docker import _build_image, _repack_job_dir, _stream_repacked, _get_image, _container_limits
+from .backends.kubernetes import KubernetesBackend, KubernetesError, parse_quantity
+from .backends.base import find_dockerfile_dir
+from .logs import JobLogWriter
+from . import runner
+from . import scheduler
+from . import janitor
+from . import reconciler
+from . import outbox
+from . import registry
+from . import package_cache
+from . import usage
+from . import arrays
+from . import pipelines
 
+import io
+import os
+import json
+import hashlib
 import time
+import datetime
+import tarfile
+import tempfile
+import threading
+import tracemalloc
+import http.server
+import runpy
+import socket
+from unittest import mock, skipUnless
+from urllib.parse import urlparse, parse_qs
 
+import docker
+import requests
+import urllib3
 
+
+def _docker_reachable():
+    """Whether a runner daemon answers, for the end-to-end tests that need real containers"""
+    for host in settings.RUNNER_DOCKER_HOSTS:
+        try:
+            docker_client = docker.DockerClient(base_url=host, timeout=5)
+            try:
+                docker_client.ping()
+            finally:
+                docker_client.close()
+            return True
+        except (docker.errors.DockerException, requests.exceptions.RequestException):
+            continue
+    return False
+
+requires_docker = skipUnless(_docker_reachable(), 'No Docker daemon is reachable')
+
+
+class LocalIntegrationTestCase(TestCase):
+    """Runs end to end on LocalBackend, so the pipeline is exercised without a Docker daemon"""
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(
+            JOB_EXECUTION_BACKEND='jobs.backends.local.LocalBackend',
+            JOB_LOCAL_ROOT=self.root.name,
+        )
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.root.cleanup()
+
+
+# FROM hello-world has no CMD for LocalBackend to run
+@requires_docker
 class JobHelloWorldIntegrationTestCase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -27,27 +95,28 @@ class JobHelloWorldIntegrationTestCase(TestCase):
         )
 
     def test_hello_completes(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
 
     def test_hello_has_output(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertTrue('Hello from Docker!' in self.job.output.read().decode('utf-8'))
 
     def test_hello_has_no_error(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertFalse(getattr(self.job, 'errors', None))
 
     def test_hello_not_failed(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertFalse(self.job.failed)
 
-class JobGoodbyeWorldIntegrationTestCase(TestCase):
+class JobGoodbyeWorldIntegrationTestCase(LocalIntegrationTestCase):
     def setUp(self):
+        super().setUp()
         self.client = Client()
         self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
         file = File(open('tests/goodbye.tar.gz', 'rb'))
@@ -62,25 +131,27 @@ class JobGoodbyeWorldIntegrationTestCase(TestCase):
         )
 
     def test_goodbye_completes(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
 
     def test_goodbye_has_error(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertTrue('Goodbye' in self.job.errors.read().decode('utf-8'))
 
     def test_goodbye_has_no_output(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertFalse(getattr(self.job, 'output', None))
 
     def test_goodbye_failed(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertTrue(self.job.failed)
 
+# Only a container's network is cut off from the internet
+@requires_docker
 class JobAccessInternetIntegrationTestCase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -97,27 +168,28 @@ class JobAccessInternetIntegrationTestCase(TestCase):
         )
 
     def test_access_internet_completes(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
 
     def test_access_internet_has_error(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         message = self.job.errors.read().decode('utf-8')
         self.assertTrue('Could not resolve' in message or 'timed out' in message)
 
     def test_access_internet_has_no_output(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertFalse(getattr(self.job, 'output', None))
 
     def test_access_internet_failed(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertTrue(self.job.failed)
 
 # export JOB_RESOURCES=104.40.211.35,98.137.246.8  before starting docker-compose
+@requires_docker
 class JobAccessResourceIntegrationTestCase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -134,31 +206,32 @@ class JobAccessResourceIntegrationTestCase(TestCase):
         )
 
     def test_access_resource_completes(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
 
     def test_access_resource_has_output(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         message = self.job.output.read().decode('utf-8')
         # print(message)
         self.assertTrue('html' in message)
 
     def test_access_resource_has_no_error(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         error = getattr(self.job, 'error', None)
         print(error)
         self.assertFalse(error)
 
     def test_access_resource_not_failed(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertFalse(self.job.failed)
 
-class JobEnvVarsIntegrationTestCase(TestCase):
+class JobEnvVarsIntegrationTestCase(LocalIntegrationTestCase):
     def setUp(self):
+        super().setUp()
         self.client = Client()
         self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
         file = File(open('tests/env-vars.tar.gz', 'rb'))
@@ -173,25 +246,1660 @@ class JobEnvVarsIntegrationTestCase(TestCase):
         )
 
     def test_env_var_completes(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
 
     def test_env_var_has_var(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         message = self.job.output.read().decode('utf-8')
         # print(message)
         self.assertTrue('EXAMPLE_VAR=abcd1234' in message)
 
     def test_env_var_has_no_error(self):
-        run_job_docker(self.job)
+        run_job(self.job)
         self.job.refresh_from_db()
         error = getattr(self.job, 'error', None)
         print(error)
         self.assertFalse(error)
 
     def test_env_var_not_failed(self):
-        run_job_docker(self.job)
+        run_job(self.job)
+        self.job.refresh_from_db()
+        self.assertFalse(self.job.failed)
+
+MB = 1024 * 1024
+
+
+def _write_job_tarball(path, payload_size):
+    """Write a gzipped job submission with a Dockerfile and an incompressible payload"""
+    with tarfile.open(path, 'w:gz') as job_tar:
+        dockerfile = b'FROM hello-world\n'
+        info = tarfile.TarInfo('Dockerfile')
+        info.size = len(dockerfile)
+        job_tar.addfile(info, io.BytesIO(dockerfile))
+        with tempfile.TemporaryFile() as payload:
+            for _ in range(payload_size // MB):
+                payload.write(os.urandom(MB))
+            payload.seek(0)
+            info = tarfile.TarInfo('payload.bin')
+            info.size = payload_size
+            job_tar.addfile(info, payload)
+
+
+class FakeImages:
+    def __init__(self):
+        self.context_digest = hashlib.sha256()
+        self.build_kwargs = None
+        self.builds = 0
+        self.tagged = {}
+        self.built = {}
+        self.build_log = [{'stream': 'Step 1/1 : FROM alpine\n'}, {'status': 'Downloading', 'progressDetail': {'current': 1}}]
+        self.build_error = None
+        self.registry = None
+
+    def build(self, fileobj=None, decode=False, **kwargs):
+        # Consume the context in small reads, as the HTTP upload would
+        self.build_kwargs = kwargs
+        self.builds += 1
+        chunks = iter(lambda: fileobj.read(8192), b'') if hasattr(fileobj, 'read') else fileobj
+        for chunk in chunks:
+            self.context_digest.update(chunk)
+        yield from self.build_log
+        if self.build_error:
+            yield {'error': self.build_error}
+            return
+        image = FakeImage(self, f'sha256:{self.builds}')
+        self.built[image.id] = image
+        yield {'aux': {'ID': image.id}}
+
+    def get(self, name):
+        if name in self.built:
+            return self.built[name]
+        if name not in self.tagged:
+            raise docker.errors.ImageNotFound(name)
+        return self.tagged[name]
+
+    def prune(self, filters=None):
+        return {'ImagesDeleted': [{'Deleted': 'sha256:dangling'}], 'SpaceReclaimed': MB}
+
+    def pull(self, repository, tag):
+        name = f'{repository}:{tag}'
+        if self.registry is None:
+            image = FakeImage(self, f'sha256:{repository}')
+        elif name in self.registry:
+            image = FakeImage(self, self.registry[name])
+        else:
+            raise docker.errors.NotFound(name)
+        self.tagged[name] = image
+        return image
+
+    def push(self, repository, tag, stream=False, decode=False):
+        self.registry[f'{repository}:{tag}'] = self.tagged[f'{repository}:{tag}'].id
+        return iter([{'status': 'Pushed'}, {'aux': {'Tag': tag, 'Digest': 'sha256:manifest', 'Size': MB}}])
+
+    def remove(self, name, noprune=False):
+        if self.tagged.pop(name, None) is None:
+            raise docker.errors.ImageNotFound(name)
+
+
+class FakeImage:
+    def __init__(self, images, id):
+        self.images = images
+        self.id = id
+        self.attrs = {'Size': MB}
+
+    def tag(self, repository, tag):
+        self.images.tagged[f'{repository}:{tag}'] = self
+
+
+class FakeContainer:
+    def __init__(self, id, exit_code, labels=None):
+        self.id = id
+        self.labels = labels or {}
+        self.exit_code = exit_code
+        self.status = 'exited'
+        self.stopped = threading.Event()
+        self.removed = False
+        self.samples = []
+        self.sampled = threading.Event()
+        self.archive = io.BytesIO()
+        with tarfile.open(fileobj=self.archive, mode='w') as archive_tar:
+            result = b'x,y\n1,2\n'
+            info = tarfile.TarInfo('shared/result.csv')
+            info.size = len(result)
+            archive_tar.addfile(info, io.BytesIO(result))
+
+    def stats(self, stream=False, decode=False):
+        yield from self.samples
+        self.sampled.set()
+
+    def get_archive(self, path, chunk_size=None):
+        self.archive.seek(0)
+        return iter(lambda: self.archive.read(512), b''), {'name': path.strip('/')}
+
+    def stop(self, timeout=None):
+        self.exit_code = 137
+        self.stopped.set()
+
+    def wait(self):
+        return {'StatusCode': self.exit_code}
+
+    def remove(self):
+        self.removed = True
+
+
+class FakeContainers:
+    def __init__(self, exit_code):
+        self.exit_code = exit_code
+        self.run_kwargs = None
+        self.started = []
+        self.samples = []
+        self.run_output = b''
+
+    def run(self, image, command=None, **kwargs):
+        if kwargs.get('remove'):
+            # Run to completion, returning its output
+            return self.run_output
+        self.run_kwargs = kwargs
+        self.started.append(FakeContainer(f'container{len(self.started)}', self.exit_code, kwargs.get('labels')))
+        self.started[-1].samples = self.samples
+        return self.started[-1]
+
+    def get(self, id):
+        for container in self.started:
+            if container.id == id and not container.removed:
+                return container
+        raise docker.errors.NotFound(id)
+
+    def list(self, all=False, filters=None):
+        containers = [c for c in self.started if not c.removed]
+        if 'status' in filters:
+            containers = [c for c in containers if c.status in filters['status']]
+        if 'label' in filters:
+            key, has_value, value = filters['label'].partition('=')
+            containers = [c for c in containers if key in c.labels and (not has_value or c.labels[key] == value)]
+        return containers
+
+
+class FakeAPI:
+    def __init__(self, frames, images):
+        self.frames = frames
+        self.build = images.build
+
+    def attach(self, container, stream=False, logs=False, demux=False):
+        return iter(self.frames)
+
+
+class FakeDockerClient:
+    def __init__(self, frames=(), exit_code=0, running=0, mem_total=8 * 1024 * MB):
+        self.images = FakeImages()
+        self.containers = FakeContainers(exit_code)
+        self.api = FakeAPI(frames, self.images)
+        self.running = running
+        self.mem_total = mem_total
+
+    def ping(self):
+        return True
+
+    def info(self):
+        return {'ContainersRunning': self.running, 'MemTotal': self.mem_total}
+
+    def df(self):
+        return {'LayersSize': sum(image.attrs['Size'] for image in self.images.tagged.values())}
+
+
+class JobFileStreamingTestCase(TestCase):
+    def _peak_build_memory(self, payload_size):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'job.tar.gz')
+            _write_job_tarball(path, payload_size)
+            with open(path, 'rb') as job_file:
+                tracemalloc.start()
+                try:
+                    _build_image(job_file, FakeDockerClient())
+                    return tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+
+    def test_build_memory_flat_as_tarball_grows(self):
+        small_peak = self._peak_build_memory(2 * MB)
+        large_peak = self._peak_build_memory(32 * MB)
+        self.assertLess(large_peak, small_peak + MB)
+        # Nowhere near a full copy of the 32MB archive
+        self.assertLess(large_peak, 8 * MB)
+
+
+class JobBuildContextTestCase(TestCase):
+    def _file_digest(self, path):
+        with open(path, 'rb') as job_file:
+            return hashlib.sha256(job_file.read()).hexdigest()
+
+    def test_root_dockerfile_sends_archive_unchanged(self):
+        docker_client = FakeDockerClient()
+        with open('tests/hello.tar.gz', 'rb') as job_file:
+            _build_image(job_file, docker_client)
+        self.assertEqual(docker_client.images.build_kwargs['encoding'], 'gzip')
+        self.assertEqual(docker_client.images.context_digest.hexdigest(), self._file_digest('tests/hello.tar.gz'))
+
+    def test_nested_dockerfile_is_repacked_at_context_root(self):
+        context = io.BytesIO()
+        with open('tests/access-internet.tar.gz', 'rb') as job_file:
+            _repack_job_dir(job_file, 'access-internet', context)
+        context.seek(0)
+        with tarfile.open(fileobj=context) as context_tar:
+            self.assertEqual(sorted(context_tar.getnames()), ['Dockerfile', 'access-internet.sh'])
+
+    def test_nested_dockerfile_is_streamed_to_the_daemon(self):
+        context = io.BytesIO()
+        with open('tests/access-internet.tar.gz', 'rb') as job_file:
+            _repack_job_dir(job_file, 'access-internet', context)
+        docker_client = FakeDockerClient()
+        with open('tests/access-internet.tar.gz', 'rb') as job_file:
+            _build_image(job_file, docker_client)
+        self.assertIsNone(docker_client.images.build_kwargs['encoding'])
+        self.assertEqual(docker_client.images.context_digest.hexdigest(), hashlib.sha256(context.getvalue()).hexdigest())
+
+    def test_abandoned_upload_stops_repacking(self):
+        threads = set(threading.enumerate())
+        with open('tests/access-internet.tar.gz', 'rb') as job_file:
+            chunks = _stream_repacked(job_file, 'access-internet')
+            next(chunks)
+            chunks.close()
+        self.assertEqual(set(threading.enumerate()), threads)
+
+    def test_missing_dockerfile_fails_build(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'job.tar.gz')
+            with tarfile.open(path, 'w:gz') as job_tar:
+                info = tarfile.TarInfo('README')
+                job_tar.addfile(info, io.BytesIO())
+            with open(path, 'rb') as job_file:
+                with self.assertRaises(FileNotFoundError):
+                    _build_image(job_file, FakeDockerClient())
+
+
+class JobImageCacheTestCase(TestCase):
+    def _get_image(self, docker_client, path):
+        with open(path, 'rb') as job_file:
+            return _get_image(job_file, docker_client, 'tcp://runner:2375')
+
+    def test_identical_submission_skips_build(self):
+        docker_client = FakeDockerClient()
+        first = self._get_image(docker_client, 'tests/hello.tar.gz')
+        second = self._get_image(docker_client, 'tests/hello.tar.gz')
+        self.assertEqual(docker_client.images.builds, 1)
+        self.assertEqual(first.id, second.id)
+        entry = CachedImage.objects.get()
+        self.assertEqual((entry.hits, entry.misses), (1, 1))
+
+    def test_image_removed_from_daemon_is_rebuilt(self):
+        docker_client = FakeDockerClient()
+        self._get_image(docker_client, 'tests/hello.tar.gz')
+        docker_client.images.tagged.clear()
+        self._get_image(docker_client, 'tests/hello.tar.gz')
+        self.assertEqual(docker_client.images.builds, 2)
+        self.assertEqual(CachedImage.objects.get().misses, 2)
+
+    @override_settings(JOB_IMAGE_CACHE_MAX_IMAGES=2)
+    def test_least_recently_used_image_is_evicted(self):
+        docker_client = FakeDockerClient()
+        self._get_image(docker_client, 'tests/hello.tar.gz')
+        self._get_image(docker_client, 'tests/goodbye.tar.gz')
+        self._get_image(docker_client, 'tests/hello.tar.gz')
+        self._get_image(docker_client, 'tests/env-vars.tar.gz')
+        evicted = CachedImage.objects.get(image_id='')
+        with open('tests/goodbye.tar.gz', 'rb') as job_file:
+            self.assertEqual(evicted.digest, hashlib.sha256(job_file.read()).hexdigest())
+        self.assertEqual(len(docker_client.images.tagged), 2)
+
+
+@override_settings(JOB_IMAGE_REGISTRY='registry:5000', JOB_IMAGE_REGISTRY_URL='http://registry:5000')
+class JobImageRegistryTestCase(TestCase):
+    def setUp(self):
+        # Two daemons sharing one registry
+        self.registry = {}
+        self.first = FakeDockerClient()
+        self.second = FakeDockerClient()
+        self.first.images.registry = self.second.images.registry = self.registry
+
+    def _get_image(self, docker_client, node, path):
+        with open(path, 'rb') as job_file:
+            return _get_image(job_file, docker_client, node)
+
+    def test_image_built_on_one_daemon_is_pulled_by_another(self):
+        built = self._get_image(self.first, 'tcp://runner-1:2375', 'tests/hello.tar.gz')
+        pulled = self._get_image(self.second, 'tcp://runner-2:2375', 'tests/hello.tar.gz')
+        self.assertEqual(self.second.images.builds, 0)
+        self.assertEqual(pulled.id, built.id)
+        entry = RegistryImage.objects.get()
+        self.assertEqual((entry.manifest_digest, entry.pulls), ('sha256:manifest', 1))
+        self.assertIn(entry.name, self.registry)
+        # Only the cache's own tag is left on the daemons, so eviction removes the image
+        self.assertEqual(list(self.first.images.tagged), [f'privascope-job:{entry.digest}'])
+        self.assertEqual(list(self.second.images.tagged), [f'privascope-job:{entry.digest}'])
+
+    def test_image_deleted_from_registry_is_rebuilt(self):
+        self._get_image(self.first, 'tcp://runner-1:2375', 'tests/hello.tar.gz')
+        self.registry.clear()
+        self._get_image(self.second, 'tcp://runner-2:2375', 'tests/hello.tar.gz')
+        self.assertEqual(self.second.images.builds, 1)
+        self.assertEqual(len(self.registry), 1)
+
+    @override_settings(JOB_IMAGE_REGISTRY_MAX_AGE=24 * 60 * 60)
+    def test_unused_images_expire(self):
+        registry.add_image('used', 'sha256:used')
+        registry.add_image('unused', 'sha256:unused')
+        registry.add_image('unknown')
+        RegistryImage.objects.exclude(digest='used').update(last_used_at=timezone.now() - datetime.timedelta(days=2))
+        head_response = mock.Mock(status_code=200, headers={'Docker-Content-Digest': 'sha256:unknown'})
+        with mock.patch('jobs.registry.requests.delete', return_value=mock.Mock(status_code=202)) as delete, \
+                mock.patch('jobs.registry.requests.head', return_value=head_response):
+            self.assertEqual(sorted(registry.expire_images()), ['unknown', 'unused'])
+        self.assertEqual(sorted(call[0][0] for call in delete.call_args_list), [
+            'http://registry:5000/v2/privascope-job/manifests/sha256:unknown',
+            'http://registry:5000/v2/privascope-job/manifests/sha256:unused',
+        ])
+        self.assertEqual(RegistryImage.objects.get().digest, 'used')
+
+
+class JobLogStreamingTestCase(TestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        file = File(open('tests/goodbye.tar.gz', 'rb'))
+        self.job = Job.objects.create(
+            name='Goodbye Job',
+            description='Return error with Goodbye World text',
+            status=Job.Status.QUEUED.name,
+            owner=self.creator,
+            filename=file.name,
+            file=file,
+            submitted_at=timezone.now(),
+        )
+
+    def _run(self, docker_client):
+        with mock.patch('jobs.runner.get_docker_client', return_value=docker_client):
+            run_job(self.job)
+        self.job.refresh_from_db()
+
+    @override_settings(RUNNER_DOCKER_HOSTS=['tcp://runner:2375'])
+    def test_streams_are_demultiplexed_into_storage(self):
+        frames = [(b'Hello ', None), (None, b'Goodbye'), (b'World', None)]
+        self._run(FakeDockerClient(frames, exit_code=1))
+        self.assertEqual(self.job.runner_node, 'tcp://runner:2375')
+        self.assertEqual(self.job.output.read(), b'Hello World')
+        self.assertEqual(self.job.errors.read(), b'Goodbye')
+        self.assertTrue(self.job.failed)
+        self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
+
+    def test_container_is_removed_after_collection(self):
+        docker_client = FakeDockerClient([(b'Hello', None)])
+        self._run(docker_client)
+        self.assertTrue(docker_client.containers.started[0].removed)
+        self.assertEqual(self.job.container_id, '')
+
+    def test_retried_run_reattaches_to_its_container(self):
+        docker_client = FakeDockerClient([(b'Hello', None)])
+        self.job.status = Job.Status.RUNNING.name
+        self.job.runner_node = 'tcp://runner:2375'
+        with mock.patch('jobs.runner.get_docker_client', return_value=docker_client):
+            run_container(self.job, 'sha256:1')
+            run_container(self.job, 'sha256:1')
+        self.assertEqual(len(docker_client.containers.started), 1)
+
+    def test_duplicate_build_delivery_is_ignored(self):
+        self.job.status = Job.Status.RUNNING.name
+        self.job.save()
+        self.assertEqual(task_build_job.apply(args=(self.job.id,)).state, 'IGNORED')
+
+    def test_volume_is_collected_as_artifacts(self):
+        docker_client = FakeDockerClient([(b'Hello', None)])
+        self._run(docker_client)
+        volumes = docker_client.containers.run_kwargs['volumes']
+        self.assertEqual(list(volumes), [os.path.join(settings.PRIVATE_JOB_OUTPUT_ROOT, 'toejam', str(self.job.id))])
+        with tarfile.open(fileobj=self.job.artifacts.open('rb'), mode='r:gz') as artifacts_tar:
+            self.assertEqual(artifacts_tar.extractfile('shared/result.csv').read(), b'x,y\n1,2\n')
+
+    def test_build_log_and_phase_timings_are_recorded(self):
+        self.job.dispatched_at = timezone.now()
+        self.job.save()
+        self._run(FakeDockerClient([(b'Hello', None)]))
+        self.assertEqual(self.job.build_log.read(), b'Step 1/1 : FROM alpine\n')
+        self.assertEqual(
+            [timing.phase for timing in self.job.phase_timings.all()],
+            ['dispatch', 'extract', 'build', 'run', 'collect'],
+        )
+
+    def test_failed_build_log_is_kept(self):
+        docker_client = FakeDockerClient()
+        docker_client.images.build_error = 'unknown instruction: RUNN'
+        with self.assertRaises(docker.errors.BuildError):
+            self._run(docker_client)
+        self.assertEqual(self.job.status_enum, Job.Status.RUN_ERROR)
+        self.assertEqual(self.job.build_log.read(), b'Step 1/1 : FROM alpine\nunknown instruction: RUNN\n')
+
+    @override_settings(JOB_LOG_FLUSH_INTERVAL=0)
+    def test_build_log_is_written_while_building(self):
+        seen = []
+        def build_log():
+            yield {'stream': 'Step 1/2 : FROM alpine\n'}
+            self.job.refresh_from_db()
+            seen.append(self.job.build_log.read())
+            yield {'stream': 'Step 2/2 : RUN make\n'}
+        docker_client = FakeDockerClient()
+        docker_client.images.build_log = build_log()
+        with open('tests/hello.tar.gz', 'rb') as job_file:
+            _build_image(job_file, docker_client, self.job)
+        self.assertEqual(seen, [b'Step 1/2 : FROM alpine\n'])
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.build_log.read(), b'Step 1/2 : FROM alpine\nStep 2/2 : RUN make\n')
+
+    @override_settings(JOB_TIMEOUT=1)
+    def test_run_is_stopped_at_timeout(self):
+        docker_client = FakeDockerClient()
+        def hang():
+            yield (b'Hello', None)
+            # Print nothing more until stopped
+            docker_client.containers.started[0].stopped.wait(5)
+        docker_client.api.frames = hang()
+        self._run(docker_client)
+        self.assertTrue(docker_client.containers.started[0].removed)
+        self.assertTrue(self.job.failed)
+        self.assertEqual(self.job.output.read(), b'Hello')
+        self.assertEqual(self.job.errors.read(), settings.JOB_TIMEOUT_MARKER.format(timeout=1).encode('utf8'))
+
+    def test_cancelled_run_is_stopped_and_keeps_partial_output(self):
+        docker_client = FakeDockerClient([(b'Hello', None)])
+        self.job.run_job()
+        self.job.save()
+        with mock.patch('jobs.runner.get_docker_client', return_value=docker_client):
+            run_result = run_container(self.job, 'sha256:1')
+            self.job.cancel()
+            self.job.save()
+            self.assertNotIn(self.job, scheduler.active_jobs())
+            stop_container(self.job)
+            collect_job(self.job, 137, *run_result[1:])
+        container = docker_client.containers.started[0]
+        self.assertTrue(container.stopped.is_set())
+        self.assertTrue(container.removed)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status_enum, Job.Status.CANCELLED)
+        self.assertEqual(self.job.output.read(), b'Hello')
+        self.assertTrue(self.job.artifacts)
+
+    def test_resource_usage_is_sampled_during_run(self):
+        docker_client = FakeDockerClient()
+        def sample(cpu, usage, max_usage, read, rx):
+            return {
+                'cpu_stats': {'cpu_usage': {'total_usage': cpu * 10 ** 9}},
+                'memory_stats': {'usage': usage, 'max_usage': max_usage},
+                'blkio_stats': {'io_service_bytes_recursive': [{'op': 'Read', 'value': read}, {'op': 'Write', 'value': 1024}]},
+                'networks': {'eth0': {'rx_bytes': rx, 'tx_bytes': 10}, 'eth1': {'rx_bytes': rx, 'tx_bytes': 0}},
+            }
+        docker_client.containers.samples = [sample(1, 50 * MB, 60 * MB, MB, 100), sample(3, 20 * MB, 200 * MB, 2 * MB, 300)]
+        def frames():
+            yield (b'Hello', None)
+            # Keep running until every sample was taken
+            docker_client.containers.started[0].sampled.wait(5)
+        docker_client.api.frames = frames()
+        self._run(docker_client)
+        usage = self.job.resource_usage
+        self.assertEqual(usage.samples, 2)
+        self.assertEqual(usage.cpu_seconds, 3)
+        self.assertEqual(usage.peak_memory, 200 * MB)
+        self.assertEqual((usage.block_read, usage.block_written), (2 * MB, 1024))
+        self.assertEqual((usage.network_received, usage.network_sent), (600, 10))
+
+    def test_sampling_ends_cleanly_on_a_broken_stats_stream(self):
+        def samples():
+            yield {'cpu_seconds': 2, 'peak_memory': MB}
+            raise urllib3.exceptions.ProtocolError('Connection broken: IncompleteRead')
+        with mock.patch('builtins.print') as log, usage.sample(self.job, samples()):
+            pass
+        log.assert_called_once_with(f"Sampling job {self.job.id}: ProtocolError('Connection broken: IncompleteRead')")
+        self.assertEqual((self.job.resource_usage.samples, self.job.resource_usage.peak_memory), (1, MB))
+
+    def test_empty_stream_leaves_no_file(self):
+        self._run(FakeDockerClient([(b'Hello', None)]))
+        self.assertFalse(self.job.errors)
+        self.assertFalse(self.job.failed)
+
+    @override_settings(JOB_LOG_BUFFER_SIZE=4, JOB_LOG_MAX_BYTES=10)
+    def test_output_over_limit_is_truncated(self):
+        writer = JobLogWriter(f'{self.job.id}-truncated')
+        writer.write_frames([(b'0123456', None)] * 3)
+        output, errors = writer.close()
+        self.assertIsNone(errors)
+        with self.job.output.storage.open(output) as output_file:
+            self.assertEqual(output_file.read(), b'0123456012' + settings.JOB_LOG_TRUNCATION_MARKER.format(max_bytes=10).encode('utf8'))
+
+
+class LocalBackendTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(
+            JOB_EXECUTION_BACKEND='jobs.backends.local.LocalBackend',
+            JOB_LOCAL_ROOT=self.root.name,
+            JOB_STOP_TIMEOUT=1,
+        )
+        self.settings.enable()
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+
+    def tearDown(self):
+        self.settings.disable()
+        self.root.cleanup()
+
+    @override_settings(JOB_IMAGE_REGISTRY='')
+    def test_runner_daemons_are_left_alone(self):
+        with mock.patch('jobs.runner.get_docker_client') as get_docker_client:
+            self.assertIsNone(task_prewarm_base_images())
+            self.assertEqual(task_sweep_runners(), {})
+        get_docker_client.assert_not_called()
+
+    def _run(self, path):
+        file = File(open(path, 'rb'))
+        job = Job.objects.create(
+            name='Local Job',
+            description='Run without Docker',
+            status=Job.Status.QUEUED.name,
+            owner=self.creator,
+            filename=file.name,
+            file=file,
+            submitted_at=timezone.now(),
+        )
+        run_job(job)
+        job.refresh_from_db()
+        return job
+
+    def test_dockerfile_cmd_runs_as_subprocess(self):
+        job = self._run('tests/env-vars.tar.gz')
+        self.assertEqual(job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
+        self.assertFalse(job.failed)
+        self.assertIn(b'EXAMPLE_VAR=abcd1234', job.output.read())
+        self.assertEqual(job.runner_node, 'local')
+        self.assertFalse(os.path.exists(os.path.join(self.root.name, str(job.id))))
+
+    @override_settings(JOB_LOCAL_COMMAND='sh -c "echo Hello; echo Goodbye >&2; echo 1,2 > $JOB_VOLUME/result.csv; exit 3"')
+    def test_streams_exit_code_and_volume_are_collected(self):
+        job = self._run('tests/hello.tar.gz')
+        self.assertTrue(job.failed)
+        self.assertEqual(job.output.read(), b'Hello\n')
+        self.assertEqual(job.errors.read(), b'Goodbye\n')
+        with tarfile.open(fileobj=job.artifacts.open('rb'), mode='r:gz') as artifacts_tar:
+            self.assertEqual(artifacts_tar.extractfile('shared/result.csv').read(), b'1,2\n')
+
+    @override_settings(JOB_LOCAL_COMMAND='sleep 30', JOB_TIMEOUT=1)
+    def test_timed_out_process_is_stopped(self):
+        start = time.monotonic()
+        job = self._run('tests/hello.tar.gz')
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertTrue(job.failed)
+        self.assertIn(b'[Job stopped after running for 1 seconds]', job.errors.read())
+
+
+class FakeKubernetesAPI(http.server.ThreadingHTTPServer):
+    """Just enough of the Kubernetes API for KubernetesBackend: a Job's pod has exited by the time it is created"""
+
+    def __init__(self, exit_code=0, log=b''):
+        super().__init__(('127.0.0.1', 0), FakeKubernetesHandler)
+        self.exit_code = exit_code
+        self.log = log
+        self.jobs = {}
+        self.pods = {}
+        self.network_policies = {}
+        self.nodes = []
+        self.requests = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def add_node(self, cpu, memory, ready=True, unschedulable=False):
+        self.nodes.append({
+            'spec': {'unschedulable': unschedulable},
+            'status': {
+                'allocatable': {'cpu': cpu, 'memory': memory},
+                'conditions': [{'type': 'Ready', 'status': 'True' if ready else 'False'}],
+            },
+        })
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeKubernetesHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        api = self.server
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        api.requests.append((method, url.path, query, body))
+        parts = url.path.strip('/').split('/')
+        if parts[-1] == 'nodes':
+            return self._reply(200, {'items': api.nodes})
+        if parts[-1] == 'log':
+            return self._reply(200, api.log)
+        if 'networkpolicies' in parts:
+            if method == 'POST' and body['metadata']['name'] in api.network_policies:
+                return self._reply(409, {})
+            api.network_policies[body['metadata']['name']] = body
+            return self._reply(201, body)
+        if parts[-1] == 'pods':
+            return self._reply(200, {'items': self._select(api.pods.values(), query)})
+        if parts[-1] == 'jobs':
+            if method == 'POST':
+                return self._reply(201, self._create_job(body))
+            return self._reply(200, {'items': self._select(api.jobs.values(), query)})
+        name = parts[-1]
+        if name not in api.jobs:
+            return self._reply(404, {})
+        if method == 'PATCH':
+            api.jobs[name]['spec'].update(body['spec'])
+        elif method == 'DELETE':
+            del api.jobs[name]
+            api.pods.pop(name, None)
+        return self._reply(200, api.jobs.get(name, {}))
+
+    def _create_job(self, job):
+        name = job['metadata']['name']
+        self.server.jobs[name] = job
+        self.server.pods[name] = {
+            'metadata': {'name': f'{name}-x7k2p', 'labels': {'job-name': name}},
+            'status': {
+                'phase': 'Succeeded' if self.server.exit_code == 0 else 'Failed',
+                'containerStatuses': [{'state': {'terminated': {'exitCode': self.server.exit_code}}}],
+            },
+        }
+        return job
+
+    def _select(self, objects, query):
+        if 'labelSelector' not in query:
+            return list(objects)
+        selector = dict(term.split('=') for term in query['labelSelector'].split(','))
+        return [o for o in objects if all(o['metadata']['labels'].get(key) == value for key, value in selector.items())]
+
+    def _reply(self, status, body):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class KubernetesBackendTestCase(TestCase):
+    def setUp(self):
+        self.api = FakeKubernetesAPI(log=b'Hello from Kubernetes!\n')
+        self.output_root = tempfile.TemporaryDirectory(dir=settings.PRIVATE_STORAGE_ROOT)
+        self.settings = override_settings(
+            JOB_EXECUTION_BACKEND='jobs.backends.kubernetes.KubernetesBackend',
+            KUBERNETES_API_URL=self.api.url,
+            KUBERNETES_TOKEN_FILE='/nonexistent',
+            KUBERNETES_NAMESPACE='privascope',
+            KUBERNETES_IMAGE_REPOSITORY='10.0.0.5:5000/privascope-job',
+            KUBERNETES_BUILD_EGRESS_CIDRS=['10.0.1.0/24'],
+            KUBERNETES_JOB_FILES_MOUNT=settings.PRIVATE_STORAGE_ROOT,
+            KUBERNETES_JOB_EGRESS_CIDRS=['104.40.211.35/32'],
+            KUBERNETES_POLL_INTERVAL=0.01,
+            PRIVATE_JOB_OUTPUT_ROOT=self.output_root.name,
+            JOB_CONTAINER_CPU_PERIOD=100000,
+            JOB_CONTAINER_CPU_QUOTA=50000,
+            JOB_CONTAINER_MEM_LIMIT='512m',
+        )
+        self.settings.enable()
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        file = File(open('tests/hello.tar.gz', 'rb'))
+        self.job = Job.objects.create(
+            name='Kubernetes Job',
+            description='Run as a Kubernetes Job',
+            status=Job.Status.QUEUED.name,
+            owner=self.creator,
+            filename=file.name,
+            file=file,
+            submitted_at=timezone.now(),
+        )
+
+    def tearDown(self):
+        self.settings.disable()
+        self.api.close()
+        self.output_root.cleanup()
+
+    def _created_jobs(self, role):
+        return [body for method, path, query, body in self.api.requests
+                if method == 'POST' and path.endswith('/jobs') and body['metadata']['labels']['privascope.role'] == role]
+
+    def test_job_is_built_and_run_as_kubernetes_jobs(self):
+        run_job(self.job)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
+        self.assertFalse(self.job.failed)
+        self.assertEqual(self.job.output.read(), b'Hello from Kubernetes!\n')
+        self.assertEqual(self.job.build_log.read(), b'Hello from Kubernetes!\n')
+        build, = self._created_jobs('build')
+        self.assertIn('--context=tar:///workspace/context.tar.gz', build['spec']['template']['spec']['containers'][0]['args'])
+        run, = self._created_jobs('job')
+        container = run['spec']['template']['spec']['containers'][0]
+        self.assertTrue(container['image'].startswith('10.0.0.5:5000/privascope-job:'))
+        self.assertEqual(container['resources']['requests'], {'cpu': '500m', 'memory': str(512 * MB)})
+        self.assertEqual(run['metadata']['labels'][runner.JOB_LABEL], str(self.job.id))
+        self.assertIn({'name': 'EXAMPLE_VAR', 'value': 'abcd1234'}, container['env'])
+        # Everything but the job's volume is cleaned up
+        self.assertEqual(self.api.jobs, {})
+
+    def test_egress_is_limited_to_the_whitelist(self):
+        KubernetesBackend().start(self.job, '10.0.0.5:5000/privascope-job:abc')
+        policy = self.api.network_policies['privascope-jobs']
+        self.assertEqual(policy['spec']['podSelector'], {'matchLabels': {'privascope.role': 'job'}})
+        self.assertIn({'to': [{'ipBlock': {'cidr': '104.40.211.35/32'}}]}, policy['spec']['egress'])
+        self.assertEqual(policy['spec']['ingress'], [])
+
+    def test_build_pod_only_gets_the_submission_and_the_registry(self):
+        KubernetesBackend().build(self.job, self.job.file.open('rb'))
+        build, = self._created_jobs('build')
+        container = build['spec']['template']['spec']['containers'][0]
+        self.assertEqual(container['volumeMounts'], [
+            {'name': 'job-files', 'mountPath': '/workspace/context.tar.gz', 'subPath': self.job.file.name, 'readOnly': True},
+        ])
+        policy = self.api.network_policies['privascope-builds']
+        # The policy selects the build pod
+        self.assertEqual(policy['spec']['podSelector'], {'matchLabels': {'privascope.role': 'build'}})
+        self.assertEqual(build['spec']['template']['metadata']['labels']['privascope.role'], 'build')
+        self.assertIn({'to': [{'ipBlock': {'cidr': '10.0.0.5/32'}}, {'ipBlock': {'cidr': '10.0.1.0/24'}}]}, policy['spec']['egress'])
+        self.assertEqual(policy['spec']['ingress'], [])
+
+    def test_egress_whitelist_host_names_are_resolved(self):
+        # The default, from the README's JOB_RESOURCES
+        env = {'JOB_RESOURCES': '104.40.211.35,98.137.246.8,microsoft.com,yahoo.com', 'KUBERNETES_JOB_EGRESS_CIDRS': ''}
+        with mock.patch.dict(os.environ, env):
+            del os.environ['KUBERNETES_JOB_EGRESS_CIDRS']
+            egress = runpy.run_path(os.path.join(settings.BASE_DIR, 'privascope_portal', 'settings.py'))['KUBERNETES_JOB_EGRESS_CIDRS']
+        addresses = {'microsoft.com': '20.70.246.20', 'yahoo.com': '74.6.143.25'}
+        resolve = socket.getaddrinfo
+        def getaddrinfo(host, port, *args, **kwargs):
+            if host.endswith('.invalid'):
+                raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+            if host in addresses:
+                return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (addresses[host], 0))]
+            return resolve(host, port, *args, **kwargs)
+        with override_settings(KUBERNETES_JOB_EGRESS_CIDRS=egress + ['10.1.0.0/16', 'gone.invalid']), \
+                mock.patch('socket.getaddrinfo', getaddrinfo), mock.patch('builtins.print'):
+            KubernetesBackend().start(self.job, '10.0.0.5:5000/privascope-job:abc')
+        policy = self.api.network_policies['privascope-jobs']
+        self.assertIn({'to': [{'ipBlock': {'cidr': cidr}} for cidr in (
+            '104.40.211.35/32', '98.137.246.8/32', '20.70.246.20/32', '74.6.143.25/32', '10.1.0.0/16',
+        )]}, policy['spec']['egress'])
+
+    def test_failed_build_keeps_its_log(self):
+        self.api.exit_code = 1
+        self.api.log = b'error: unknown instruction: FORM\n'
+        with self.assertRaises(KubernetesError):
+            KubernetesBackend().build(self.job, self.job.file.open('rb'))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.build_log.read(), b'error: unknown instruction: FORM\n')
+
+    def test_stopped_job_is_found_and_removed(self):
+        backend = KubernetesBackend()
+        self.job.container_id = backend.start(self.job, '10.0.0.5:5000/privascope-job:abc')
+        self.assertEqual(backend.find(self.job), self.job.container_id)
+        backend.stop(self.job)
+        self.assertEqual(self.api.jobs[self.job.container_id]['spec']['activeDeadlineSeconds'], 1)
+        backend.remove(self.job)
+        self.assertIsNone(backend.find(self.job))
+        # Gone jobs are no error
+        backend.stop(self.job)
+        backend.remove(self.job)
+
+    def test_build_job_is_not_found_as_the_jobs_container(self):
+        backend = KubernetesBackend()
+        # Left behind by a worker that died mid-build
+        name = backend._create_job(self.job, 'build', {'name': 'build', 'image': settings.KUBERNETES_BUILD_IMAGE})
+        self.assertEqual(self.api.jobs[name]['spec']['ttlSecondsAfterFinished'], 60 * 60)
+        self.assertIsNone(backend.find(self.job))
+        self.job.container_id = backend.start(self.job, '10.0.0.5:5000/privascope-job:abc')
+        self.assertNotIn('ttlSecondsAfterFinished', self.api.jobs[self.job.container_id]['spec'])
+        self.assertEqual(backend.find(self.job), self.job.container_id)
+
+    @override_settings(JOB_IMAGE_REGISTRY='', KUBERNETES_IMAGE_REPOSITORY='')
+    def test_an_image_repository_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            KubernetesBackend()
+
+    def test_capacity_counts_ready_schedulable_nodes(self):
+        self.api.add_node('4', '16Gi')
+        self.api.add_node('3800m', '8388608Ki')
+        self.api.add_node('8', '32Gi', ready=False)
+        self.api.add_node('8', '32Gi', unschedulable=True)
+        cpus, memory = KubernetesBackend().capacity()
+        self.assertAlmostEqual(cpus, 7.8)
+        self.assertEqual(memory, 24 * 1024 * MB)
+        self.assertEqual(parse_quantity('1e3'), 1000)
+
+
+class JobLogFlushTestCase(TransactionTestCase):
+    # The flusher thread records the log on the job over its own connection
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        file = File(open('tests/hello.tar.gz', 'rb'))
+        self.job = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.RUNNING.name,
+            owner=self.creator,
+            filename=file.name,
+            file=file,
+            submitted_at=timezone.now(),
+        )
+
+    @override_settings(JOB_LOG_FLUSH_INTERVAL=0.05)
+    def test_output_is_flushed_when_no_more_arrives(self):
+        writer = JobLogWriter(f'{self.job.id}-silent', self.job)
+        writer.write('out', b'Hello')
+        deadline = time.monotonic() + 5
+        while not Job.objects.get(pk=self.job.pk).output and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.job.refresh_from_db()
+        with self.job.output.storage.open(self.job.output.name) as output_file:
+            self.assertEqual(output_file.read(), b'Hello')
+        writer.close()
+        self.assertFalse(writer.flusher.is_alive())
+
+
+class JobTailTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        self.staff = User.objects.create_user('earl', 'earl@funkotron.net', 'earl', is_staff=True)
+        file = File(open('tests/hello.tar.gz', 'rb'))
+        self.job = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.RUNNING.name,
+            owner=self.creator,
+            filename=file.name,
+            file=file,
+            submitted_at=timezone.now(),
+        )
+
+    @override_settings(JOB_LOG_FLUSH_INTERVAL=0)
+    def test_running_output_is_recorded_and_flushed(self):
+        writer = JobLogWriter(f'{self.job.id}-tail', self.job)
+        writer.write('out', b'Hello')
         self.job.refresh_from_db()
+        with self.job.output.storage.open(self.job.output.name) as output_file:
+            self.assertEqual(output_file.read(), b'Hello')
+        writer.close()
+
+    def test_tail_returns_bytes_after_offset(self):
+        writer = JobLogWriter(f'{self.job.id}-tail', self.job)
+        writer.write('out', b'Hello World')
+        writer.close()
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('jobs:job_tail', args=(self.job.id,)), {'stream': 'output', 'offset': 6})
+        self.assertEqual(response.content, b'World')
+        self.assertEqual(response['X-Log-Offset'], '11')
+        self.assertEqual(response['X-Job-Status'], Job.Status.RUNNING.name)
+
+    @override_settings(RESTRICTED_ACCESS_GROUPS=None, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_detail_offers_tail_to_staff(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('jobs:detail', args=(self.job.id,)))
+        self.assertContains(response, reverse('jobs:job_tail', args=(self.job.id,)))
+
+    def test_tail_is_staff_only(self):
+        self.client.force_login(self.creator)
+        response = self.client.get(reverse('jobs:job_tail', args=(self.job.id,)))
+        self.assertEqual(response.status_code, 302)
+
+
+class RunnerDockerClientTestCase(TestCase):
+    def setUp(self):
+        runner.reset_docker_clients()
+
+    def tearDown(self):
+        runner.reset_docker_clients()
+
+    def test_client_is_reused(self):
+        with mock.patch('jobs.runner._connect') as connect:
+            self.assertIs(runner.get_docker_client('tcp://a:2375'), runner.get_docker_client('tcp://a:2375'))
+        self.assertEqual(connect.call_count, 1)
+
+    @override_settings(RUNNER_DOCKER_HEALTH_CHECK_INTERVAL=-1)
+    def test_unhealthy_client_is_replaced(self):
+        with mock.patch('jobs.runner._connect') as connect:
+            first = runner.get_docker_client('tcp://a:2375')
+            first.ping.side_effect = docker.errors.APIError('daemon went away')
+            connect.return_value = mock.Mock()
+            second = runner.get_docker_client('tcp://a:2375')
+        self.assertIsNot(first, second)
+        first.close.assert_called_once_with()
+
+    @override_settings(RUNNER_DOCKER_POOL_SIZE=7)
+    def test_connection_pool_is_sized(self):
+        with mock.patch.dict(os.environ, {'DOCKER_TLS_VERIFY': ''}):
+            docker_client = runner._connect('tcp://a:2375')
+        adapter = docker_client.api.get_adapter('http://a:2375/version')
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.poolmanager.connection_pool_kw['maxsize'], 7)
+
+
+@override_settings(
+    RUNNER_DOCKER_HOSTS=['tcp://busy:2375', 'tcp://idle:2375', 'tcp://full:2375', 'tcp://down:2375'],
+    JOB_CONTAINER_MEM_LIMIT='1g',
+)
+class RunnerPlacementTestCase(TestCase):
+    def _get_docker_client(self, host):
+        if host == 'tcp://down:2375':
+            raise requests.exceptions.ConnectionError(host)
+        return {
+            'tcp://busy:2375': FakeDockerClient(running=3),
+            'tcp://idle:2375': FakeDockerClient(running=1),
+            'tcp://full:2375': FakeDockerClient(running=0, mem_total=512 * MB),
+        }[host]
+
+    def test_least_loaded_healthy_node_is_chosen(self):
+        with mock.patch('jobs.runner.get_docker_client', self._get_docker_client):
+            self.assertEqual(runner.choose_docker_host(scheduler.job_reservation(Job())), 'tcp://idle:2375')
+
+    @override_settings(RUNNER_DOCKER_HOSTS=['tcp://full:2375', 'tcp://down:2375'])
+    def test_no_node_with_capacity(self):
+        with mock.patch('jobs.runner.get_docker_client', self._get_docker_client):
+            with self.assertRaises(runner.NoRunnerAvailable):
+                runner.choose_docker_host(scheduler.job_reservation(Job()))
+
+    def test_requested_memory_is_reserved_on_its_node(self):
+        owner = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.RUNNING.name,
+            owner=owner,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            runner_node='tcp://idle:2375',
+            memory_mb=6 * 1024,
+        )
+        with mock.patch('jobs.runner.get_docker_client', self._get_docker_client):
+            # The idle node has 2 GB left, not the 7 GB the default limit would leave
+            self.assertEqual(runner.choose_docker_host(scheduler.job_reservation(Job(memory_mb=4 * 1024))), 'tcp://busy:2375')
+            # Placing the running job again, its own reservation does not count
+            job = Job.objects.get()
+            self.assertEqual(runner.choose_docker_host(scheduler.job_reservation(job), job.id), 'tcp://idle:2375')
+
+    @override_settings(RUNNER_DOCKER_HOSTS=['tcp://full:2375'])
+    def test_job_without_a_node_with_room_is_queued_again(self):
+        owner = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        job = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.QUEUED.name,
+            owner=owner,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            dispatched_at=timezone.now(),
+        )
+        with mock.patch('jobs.runner.get_docker_client', self._get_docker_client):
+            result = task_build_job.apply(args=(job.id,))
+        self.assertEqual(result.state, 'IGNORED')
+        job.refresh_from_db()
+        self.assertEqual((job.status_enum, job.dispatched_at, job.runner_node), (Job.Status.QUEUED, None, ''))
+        self.assertIn(job, scheduler.pending_jobs())
+
+
+@override_settings(
+    RUNNER_DOCKER_HOSTS=['tcp://warm:2375', 'tcp://down:2375'],
+    RUNNER_BASE_IMAGES=['python:3.7', 'localhost:5000/r-base'],
+)
+class RunnerBaseImagesTestCase(TestCase):
+    def setUp(self):
+        self.warm = FakeDockerClient()
+
+    def _get_docker_client(self, host):
+        if host == 'tcp://down:2375':
+            raise requests.exceptions.ConnectionError(host)
+        return self.warm
+
+    def test_prewarm_pulls_base_images_on_every_node(self):
+        with mock.patch('jobs.runner.get_docker_client', self._get_docker_client):
+            self.assertEqual(runner.base_image_status(), {
+                'tcp://warm:2375': {'python:3.7': False, 'localhost:5000/r-base': False},
+                'tcp://down:2375': None,
+            })
+            pulled = runner.prewarm_base_images()
+            self.assertEqual(pulled['tcp://warm:2375'], ['python:3.7', 'localhost:5000/r-base'])
+            self.assertEqual(pulled['tcp://down:2375'], [])
+            self.assertIn('localhost:5000/r-base:latest', self.warm.images.tagged)
+            self.assertEqual(runner.base_image_status()['tcp://warm:2375'], {
+                'python:3.7': True, 'localhost:5000/r-base': True,
+            })
+
+
+class JobResourceUsageReportTestCase(TestCase):
+    def setUp(self):
+        creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        for peak_memory in range(1, 101):
+            job = Job.objects.create(name=f'Job {peak_memory}', owner=creator, submitted_at=timezone.now())
+            JobResourceUsage.objects.create(job=job, peak_memory=peak_memory * MB, cpu_seconds=peak_memory, wall_seconds=100)
+
+    def test_percentiles_by_nearest_rank(self):
+        queryset = JobResourceUsage.objects.all()
+        self.assertEqual(usage.percentiles(queryset, 'peak_memory', (50, 95, 100)), {50: 50 * MB, 95: 95 * MB, 100: 100 * MB})
+        self.assertEqual(usage.percentiles(queryset, 'cpu_cores', (1,)), {1: 0.01})
+        self.assertEqual(usage.percentiles(queryset.none(), 'peak_memory', (50,)), {})
+
+    def test_report_command(self):
+        out = io.StringIO()
+        call_command('resource_usage', stdout=out)
+        self.assertIn('100 jobs in the last 30 days', out.getvalue())
+        self.assertIn('Peak memory', out.getvalue())
+
+
+SQUID_INFO = """Squid Object Cache: Version 3.5.27
+Connection information for squid:
+\tNumber of clients accessing cache:\t2
+\tNumber of HTTP requests received:\t1250
+Cache information for squid:
+\tHits as % of all requests:\t5min: 40.0%, 60min: 62.5%
+\tHits as % of bytes sent:\t5min: 55.1%, 60min: 81.2%
+\tStorage Swap size:\t524288 KB
+\tStorage Swap capacity:\t 5.0% used, 95.0% free
+"""
+
+
+@override_settings(RUNNER_PACKAGE_CACHE_PORT=3128, RUNNER_PACKAGE_CACHE_BUILD_PROXY='http://172.17.0.1:3128')
+class RunnerPackageCacheTestCase(TestCase):
+    def test_builds_download_through_the_cache(self):
+        docker_client = FakeDockerClient()
+        with open('tests/hello.tar.gz', 'rb') as job_file:
+            _build_image(job_file, docker_client)
+        buildargs = docker_client.images.build_kwargs['buildargs']
+        self.assertEqual(buildargs['http_proxy'], 'http://172.17.0.1:3128')
+        self.assertEqual(buildargs['HTTPS_PROXY'], 'http://172.17.0.1:3128')
+
+    @override_settings(RUNNER_PACKAGE_CACHE_PORT=0)
+    def test_builds_download_directly_without_a_cache(self):
+        self.assertEqual(package_cache.build_args(), {})
+
+    def test_stats_are_read_from_the_cache_manager(self):
+        with mock.patch('jobs.package_cache.requests.get', return_value=mock.Mock(text=SQUID_INFO)) as get:
+            stats = package_cache.stats('tcp://runner-docker-daemon:2375')
+        self.assertEqual(get.call_args[0][0], 'http://runner-docker-daemon:3128/squid-internal-mgr/info')
+        self.assertEqual(stats, {
+            'requests': 1250,
+            'hit_ratio': 62.5,
+            'byte_hit_ratio': 81.2,
+            'disk_kilobytes': 524288,
+            'disk_capacity': '5.0% used, 95.0% free',
+        })
+
+    def test_seed_downloads_http_urls_through_the_cache(self):
+        urls = ['http://deb.debian.org/debian/pool/main/c/curl/curl_7.64.0-4_amd64.deb', 'https://pypi.org/simple/numpy/']
+        with mock.patch('jobs.package_cache.requests.get') as get:
+            get.return_value.__enter__.return_value.iter_content.return_value = [b'deb']
+            cached, failed = package_cache.seed('tcp://runner-docker-daemon:2375', urls)
+        self.assertEqual((cached, failed), ([urls[0]], [urls[1]]))
+        self.assertEqual(get.call_args[1]['proxies'], {'http': 'http://runner-docker-daemon:3128'})
+
+
+@override_settings(RUNNER_GC_MAX_AGE=24 * 60 * 60, RUNNER_GC_DISK_HIGH_WATER=0)
+class RunnerJanitorTestCase(TestCase):
+    def setUp(self):
+        self.node = 'tcp://runner:2375'
+        self.docker_client = FakeDockerClient()
+        self.docker_client.containers.run_output = b'2048\t/output/toejam/1\n'
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        job = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.RUNNING.name,
+            owner=self.creator,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+        )
+        failed = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.RUN_ERROR.name,
+            owner=self.creator,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+        )
+        running = self.docker_client.containers.run('image', labels={runner.JOB_LABEL: str(job.id)})
+        self.docker_client.containers.run('image', labels={runner.JOB_LABEL: str(failed.id)})
+        job.container_id = running.id
+        job.save()
+        for digest, age in (('old', 2), ('older', 3), ('fresh', 0)):
+            image = FakeImage(self.docker_client.images, f'sha256:{digest}')
+            image.tag(settings.JOB_IMAGE_CACHE_REPOSITORY, digest)
+            CachedImage.objects.create(node=self.node, digest=digest, image_id=image.id, size=MB)
+            CachedImage.objects.filter(digest=digest).update(last_used_at=timezone.now() - datetime.timedelta(days=age))
+
+    def _sweep(self):
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            return janitor.sweep_daemon(self.node)
+
+    def test_sweep_reports_what_it_reclaimed(self):
+        report = self._sweep()
+        self.assertEqual(report['containers'], ['container1'])
+        self.assertEqual(report['images'], ['sha256:dangling', 'privascope-job:older', 'privascope-job:old'])
+        self.assertEqual(report['output_dirs'], ['toejam/1'])
+        self.assertEqual(report['bytes'], 3 * MB + 2 * MB)
+        self.assertFalse(self.docker_client.containers.started[0].removed)
+        self.assertEqual(list(self.docker_client.images.tagged), ['privascope-job:fresh'])
+
+    def test_only_orphaned_job_containers_are_removed(self):
+        queued = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.QUEUED.name,
+            owner=self.creator,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+        )
+        # Started but not saved yet, and some other workload's
+        starting = self.docker_client.containers.run('image', labels={runner.JOB_LABEL: str(queued.id)})
+        unrelated = self.docker_client.containers.run('image')
+        report = self._sweep()
+        self.assertEqual(report['containers'], ['container1'])
+        self.assertFalse(starting.removed)
+        self.assertFalse(unrelated.removed)
+
+    def test_cancelled_jobs_container_is_kept_until_collected(self):
+        job = Job.objects.get(status=Job.Status.RUNNING.name)
+        job.cancel()
+        job.save()
+        report = self._sweep()
+        self.assertEqual(report['containers'], ['container1'])
+        self.assertFalse(self.docker_client.containers.started[0].removed)
+        # Once collected it is the janitor's, though it still names the job
+        Job.objects.filter(pk=job.pk).update(container_id='')
+        report = self._sweep()
+        self.assertEqual(report['containers'], ['container0'])
+
+    @override_settings(RUNNER_GC_MAX_AGE=7 * 24 * 60 * 60, RUNNER_GC_DISK_HIGH_WATER=2 * MB)
+    def test_images_are_evicted_down_to_the_high_water_mark(self):
+        report = self._sweep()
+        self.assertEqual(report['images'], ['sha256:dangling', 'privascope-job:older'])
+        self.assertEqual(CachedImage.objects.filter(image_id='').get().digest, 'older')
+
+
+@override_settings(RUNNER_RECONCILE_AFTER=60)
+class JobReconcilerTestCase(TestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        self.docker_client = FakeDockerClient([(b'Hello', None)])
+        self.resumed = []
+        self.failed = []
+
+    def _create_job(self, heartbeat_age):
+        return Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.RUNNING.name,
+            owner=self.creator,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+            runner_node='tcp://runner:2375',
+            heartbeat_at=timezone.now() - datetime.timedelta(seconds=heartbeat_age),
+        )
+
+    def _reconcile(self):
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            reconciler.reconcile_jobs(self.resumed.append, self.failed.append)
+
+    def test_orphaned_job_is_reattached_to_its_labelled_container(self):
+        job = self._create_job(heartbeat_age=120)
+        # The worker died before saving the container ID
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            run_container(job, 'sha256:1')
+        Job.objects.filter(pk=job.pk).update(container_id='', heartbeat_at=timezone.now() - datetime.timedelta(seconds=120))
+        self._reconcile()
+        self.assertEqual([resumed.id for resumed in self.resumed], [job.id])
+        self.assertEqual(self.resumed[0].container_id, 'container0')
+        self.assertEqual(self.failed, [])
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            exit_code, output, errors = run_container(self.resumed[0], None)
+        self.assertEqual(len(self.docker_client.containers.started), 1)
+        with self.resumed[0].output.storage.open(output) as output_file:
+            self.assertEqual(output_file.read(), b'Hello')
+
+    def test_built_job_whose_run_stage_is_late_is_queued_again(self):
+        job = self._create_job(heartbeat_age=120)
+        Job.objects.filter(pk=job.pk).update(image_id='sha256:1')
+        self._reconcile()
+        self.assertEqual(self.failed, [])
+        self.assertEqual([resumed.id for resumed in self.resumed], [job.id])
+        run_task_id = Job.objects.get(pk=job.pk).run_task_id
+        self.assertEqual(self.resumed[0].run_task_id, run_task_id)
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            # The run stage queued at first is ignored when it finally arrives
+            late = task_run_container.apply(args=('sha256:1', job.id), task_id='late')
+            self.assertEqual(late.state, 'IGNORED')
+            self.assertEqual(self.docker_client.containers.started, [])
+            resumed = task_run_container.apply(args=('sha256:1', job.id), task_id=run_task_id)
+        self.assertEqual(resumed.state, 'SUCCESS')
+        self.assertEqual(len(self.docker_client.containers.started), 1)
+
+    def test_cancelled_job_of_a_dead_worker_is_collected(self):
+        job = self._create_job(heartbeat_age=120)
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            run_container(job, 'sha256:1')
+        job.cancel()
+        job.save()
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(seconds=120))
+        self._reconcile()
+        self.assertEqual([resumed.id for resumed in self.resumed], [job.id])
+        with mock.patch('jobs.runner.get_docker_client', return_value=self.docker_client):
+            result = task_run_container.apply(args=(None, job.id), task_id=self.resumed[0].run_task_id)
+        exit_code, output, errors = result.get()
+        with job.output.storage.open(output) as output_file:
+            self.assertEqual(output_file.read(), b'Hello')
+        # Its container gone, there is nothing to collect
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(seconds=120))
+        self.docker_client.containers.started[0].removed = True
+        self._reconcile()
+        self.assertEqual([failed.id for failed in self.failed], [job.id])
+        with mock.patch('jobs.celery.task_schedule_jobs'):
+            _reconcile_failed(self.failed[0])
+        job.refresh_from_db()
+        self.assertEqual((job.status_enum, job.container_id), (Job.Status.CANCELLED, ''))
+
+    def test_job_with_live_worker_is_left_alone(self):
+        self._create_job(heartbeat_age=10)
+        self._reconcile()
+        self.assertEqual((self.resumed, self.failed), ([], []))
+
+    def test_job_without_container_is_failed(self):
+        job = self._create_job(heartbeat_age=120)
+        self._reconcile()
+        self.assertEqual([failed.id for failed in self.failed], [job.id])
+        # Claimed, so an overlapping pass does not fail it twice
+        self._reconcile()
+        self.assertEqual(len(self.failed), 1)
+
+
+@override_settings(JOB_DISPATCH_SWEEP_AFTER=0)
+class JobDispatchOutboxTestCase(TestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        self.job = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.PENDING_CODE_REVIEW.name,
+            owner=self.creator,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+        )
+
+    def test_approval_records_dispatch_without_touching_the_broker(self):
+        with mock.patch('jobs.celery.app.send_task') as send_task:
+            self.job.approve_code()
+            self.job.save()
+        send_task.assert_not_called()
+        dispatch = JobDispatch.objects.get()
+        self.assertEqual((dispatch.task, dispatch.published_at), ('jobs.celery.task_schedule_jobs', None))
+
+    def test_sweeper_retries_until_published(self):
+        dispatch = outbox.enqueue('jobs.celery.task_run_job', self.job)
+        with mock.patch('jobs.celery.app.send_task', side_effect=requests.exceptions.ConnectionError('broker down')):
+            self.assertEqual(outbox.sweep(), 0)
+        dispatch.refresh_from_db()
+        self.assertEqual((dispatch.attempts, dispatch.last_error), (1, 'broker down'))
+        with mock.patch('jobs.celery.app.send_task') as send_task:
+            self.assertEqual(outbox.sweep(), 1)
+            self.assertEqual(outbox.sweep(), 0)
+        send_task.assert_called_once_with('jobs.celery.task_run_job', args=[self.job.id])
+        dispatch.refresh_from_db()
+        self.assertEqual(dispatch.attempts, 2)
+        self.assertIsNotNone(dispatch.published_at)
+
+
+@override_settings(JOB_CONTAINER_MEM_LIMIT='1g', JOB_CONTAINER_CPU_QUOTA=None, JOB_SCHEDULER_USER_WEIGHTS={})
+class JobSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@funkotron.net', 'alice')
+        self.bob = User.objects.create_user('bob', 'bob@funkotron.net', 'bob')
+        self.alice_jobs = [self._create_job(self.alice) for _ in range(5)]
+        self.bob_jobs = [self._create_job(self.bob) for _ in range(2)]
+
+    def _create_job(self, owner):
+        return Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.QUEUED.name,
+            owner=owner,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+        )
+
+    def _schedule(self, cpus, memory):
+        with mock.patch('jobs.runner.cluster_capacity', return_value=(cpus, memory)):
+            return scheduler.schedule_jobs(mock.Mock())
+
+    @override_settings(JOB_SCHEDULER_MAX_RUNNING_PER_USER=2)
+    def test_owners_are_interleaved_up_to_their_cap(self):
+        admitted = self._schedule(16, 16 * 1024 * MB)
+        self.assertEqual(admitted, [self.alice_jobs[0], self.bob_jobs[0], self.alice_jobs[1], self.bob_jobs[1]])
+
+    @override_settings(JOB_SCHEDULER_MAX_RUNNING_PER_USER=0)
+    def test_admission_stops_at_cluster_capacity(self):
+        self.assertEqual(len(self._schedule(16, 3 * 1024 * MB)), 3)
+        # Admitted jobs keep holding their share until they finish
+        self.assertEqual(self._schedule(16, 3 * 1024 * MB), [])
+
+    @override_settings(JOB_SCHEDULER_MAX_RUNNING_PER_USER=0, JOB_SCHEDULER_USER_WEIGHTS={'alice': 2})
+    def test_weights_skew_the_share(self):
+        admitted = self._schedule(6, 64 * 1024 * MB)
+        self.assertEqual([job.owner for job in admitted].count(self.alice), 4)
+
+    @override_settings(JOB_SCHEDULER_MAX_RUNNING_PER_USER=0, JOB_SCHEDULER_USER_WEIGHTS={'alice': 0, 'bob': -1})
+    def test_non_positive_weights_are_clamped(self):
+        admitted = self._schedule(4, 64 * 1024 * MB)
+        self.assertEqual([job.owner for job in admitted].count(self.alice), 2)
+
+
+@override_settings(JOB_MAX_CPUS=4, JOB_MAX_MEMORY_MB=2048, JOB_MAX_TIMEOUT=3600)
+class JobResourceRequestsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('joe', 'joe@funkotron.net', 'joe')
+        self.job = Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.PENDING_CODE_REVIEW.name,
+            owner=self.user,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+        )
+
+    def test_approval_clamps_the_requests(self):
+        self.job.cpus, self.job.memory_mb, self.job.timeout = 16, 64 * 1024, 0
+        self.job.approve_code()
+        self.assertEqual((self.job.cpus, self.job.memory_mb, self.job.timeout), (4, 2048, 3600))
+
+    def test_requests_within_the_ceilings_are_kept(self):
+        self.job.cpus, self.job.memory_mb, self.job.timeout = 0.5, 256, 60
+        self.job.approve_code()
+        self.assertEqual((self.job.cpus, self.job.memory_mb, self.job.timeout), (0.5, 256, 60))
+
+    @override_settings(JOB_CONTAINER_CPU_PERIOD=None, JOB_CONTAINER_CPU_QUOTA=None,
+                       JOB_CONTAINER_MEM_LIMIT='1g', JOB_CONTAINER_MEMSWAP_LIMIT='1536m')
+    def test_container_limits_follow_the_requests(self):
+        self.job.cpus, self.job.memory_mb = 2.5, 256
+        self.assertEqual(scheduler.job_reservation(self.job), (2.5, 256 * MB))
+        self.assertEqual(_container_limits(self.job), {
+            'cpu_period': 100000,
+            'cpu_quota': 250000,
+            'mem_limit': 256 * MB,
+            'memswap_limit': 768 * MB,
+        })
+
+    @override_settings(JOB_CONTAINER_CPU_PERIOD=100000, JOB_CONTAINER_CPU_QUOTA=50000,
+                       JOB_CONTAINER_MEM_LIMIT='1g', JOB_CONTAINER_MEMSWAP_LIMIT='1g')
+    def test_jobs_without_requests_get_the_defaults(self):
+        self.assertEqual(scheduler.job_reservation(self.job), (0.5, 1024 * MB))
+        self.assertEqual(_container_limits(self.job), {
+            'cpu_period': 100000,
+            'cpu_quota': 50000,
+            'mem_limit': '1g',
+            'memswap_limit': '1g',
+        })
+
+
+@override_settings(JOB_ENV_DICT={'EXAMPLE_VAR': 'abcd1234'}, RUNNER_DOCKER_HOSTS=['tcp://runner:2375'])
+class JobArrayTestCase(TestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        file = File(open('tests/hello.tar.gz', 'rb'))
+        self.job = Job.objects.create(
+            name='Hello Sweep',
+            description='Say hello with every seed',
+            status=Job.Status.PENDING_CODE_REVIEW.name,
+            owner=self.creator,
+            filename=file.name,
+            file=file,
+            submitted_at=timezone.now(),
+            parameter_grid='{"SEED": [1, 2], "MODE": ["fast"]}',
+        )
+        self.job.approve_code()
+        self.job.save()
+        self.runs = list(self.job.runs.order_by('run_index'))
+
+    def test_grid_is_validated(self):
+        self.assertEqual(arrays.parse_grid('{"A": [1, "x"], "B": [true]}'), {'A': ['1', 'x'], 'B': ['true']})
+        for grid in ('[1, 2]', '{}', '{"A": 1}', '{"A": []}', '{"A": [[1]]}', '{"NOT VALID": [1]}', '{"EXAMPLE_VAR": ["x"]}'):
+            with self.assertRaises(ValueError):
+                arrays.parse_grid(grid)
+        with override_settings(JOB_ARRAY_MAX_RUNS=3), self.assertRaises(ValueError):
+            arrays.parse_grid('{"A": [1, 2], "B": [1, 2]}')
+
+    def test_approval_creates_a_run_for_every_combination(self):
+        self.assertEqual([run.run_parameters() for run in self.runs], [{'SEED': '1', 'MODE': 'fast'}, {'SEED': '2', 'MODE': 'fast'}])
+        self.assertTrue(all(run.status_enum is Job.Status.QUEUED and run.file.name == self.job.file.name for run in self.runs))
+        self.assertEqual(self.runs[1].environment(), {'EXAMPLE_VAR': 'abcd1234', 'SEED': '2', 'MODE': 'fast'})
+        self.assertEqual(list(scheduler.pending_jobs().order_by('id')), self.runs)
+
+    def test_runs_share_one_image_and_their_output_is_gathered(self):
+        docker_client = FakeDockerClient([(b'Hello World\n', None)])
+        with mock.patch('jobs.runner.get_docker_client', return_value=docker_client):
+            run_job(self.runs[0])
+            self.job.refresh_from_db()
+            self.assertEqual(self.job.status_enum, Job.Status.RUNNING)
+            docker_client.containers.exit_code = 1
+            run_job(self.runs[1])
+        self.assertEqual(docker_client.images.builds, 1)
+        self.assertEqual(docker_client.containers.run_kwargs['environment']['SEED'], '2')
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
+        self.assertTrue(self.job.failed)
+        self.assertEqual(self.job.output.read(), (
+            b'==> Run 0: SEED=1 MODE=fast (Pending Output Review) <==\nHello World\n'
+            b'==> Run 1: SEED=2 MODE=fast (Pending Output Review, failed) <==\nHello World\n'
+        ))
+        with tarfile.open(fileobj=self.job.artifacts.open('rb'), mode='r:gz') as bundle:
+            self.assertEqual(bundle.getnames(), ['run-0.tar.gz', 'run-1.tar.gz'])
+        self.job.approve_output()
+        self.assertEqual({run.status for run in self.job.runs.all()}, {Job.Status.RELEASED.name})
+
+    @override_settings(JOB_CONTAINER_MEM_LIMIT='1g', JOB_CONTAINER_CPU_QUOTA=None, JOB_SCHEDULER_MAX_RUNNING_PER_USER=0)
+    def test_runs_wait_for_the_first_to_build_the_image(self):
+        with mock.patch('jobs.runner.cluster_capacity', return_value=(16, 16 * 1024 * MB)):
+            self.assertEqual(scheduler.schedule_jobs(mock.Mock()), [self.runs[0]])
+            self.assertEqual(scheduler.schedule_jobs(mock.Mock()), [])
+            Job.objects.filter(pk=self.runs[0].pk).update(status=Job.Status.RUNNING.name, container_id='container0')
+            self.assertEqual(scheduler.schedule_jobs(mock.Mock()), [self.runs[1]])
+
+    def test_cancelling_the_array_job_cancels_its_runs(self):
+        self.job.cancel()
+        self.job.save()
+        self.assertEqual({run.status for run in self.job.runs.all()}, {Job.Status.CANCELLED.name})
+
+    def test_cancelling_every_run_of_a_queued_array_job_cancels_it(self):
+        with mock.patch('jobs.celery.task_schedule_jobs'):
+            for run in self.runs:
+                run.cancel()
+                run.save()
+                task_stop_job.apply(args=(run.id,))
+                self.job.refresh_from_db()
+        self.assertEqual(self.job.status_enum, Job.Status.CANCELLED)
+        self.assertEqual(self.job.output.read(), (
+            b'==> Run 0: SEED=1 MODE=fast (Cancelled) <==\n'
+            b'==> Run 1: SEED=2 MODE=fast (Cancelled) <==\n'
+        ))
+
+
+@override_settings(RUNNER_DOCKER_HOSTS=['tcp://runner:2375', 'tcp://runner2:2375'])
+class JobPipelineTestCase(TestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp_dir.name, 'pipeline.tar.gz')
+        with tarfile.open(path, 'w:gz') as job_tar:
+            for stage in ('prepare', 'analyse'):
+                dockerfile = f'FROM alpine\nCMD ["echo", "{stage}"]\n'.encode('utf8')
+                info = tarfile.TarInfo(f'{stage}/Dockerfile')
+                info.size = len(dockerfile)
+                job_tar.addfile(info, io.BytesIO(dockerfile))
+        with open(path, 'rb') as job_file:
+            self.job = Job.objects.create(
+                name='Two Step Job',
+                description='Prepare the data, then analyse it',
+                status=Job.Status.PENDING_CODE_REVIEW.name,
+                owner=self.creator,
+                filename='pipeline.tar.gz',
+                file=File(job_file, name='pipeline.tar.gz'),
+                submitted_at=timezone.now(),
+                stages='["prepare", "analyse"]',
+            )
+        self.job.approve_code()
+        self.job.save()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _run_stage(self, docker_client, index):
+        stage = self.job.runs.get(run_index=index)
+        # The second daemon is the less loaded one, so only pinning keeps a
+        # later stage on the first
+        with mock.patch('jobs.runner.get_docker_client', return_value=docker_client), \
+                mock.patch('jobs.runner.choose_docker_host', return_value='tcp://runner:2375' if index == 0 else 'tcp://runner2:2375'):
+            run_job(stage)
+        stage.refresh_from_db()
+        self.job.refresh_from_db()
+        return stage
+
+    def test_stages_are_validated(self):
+        self.assertEqual(pipelines.parse_stages('["a", "b.1"]'), ['a', 'b.1'])
+        for stages in ('"a"', '["a"]', '["a", "a"]', '["a", "../b"]', '["a", 1]'):
+            with self.assertRaises(ValueError):
+                pipelines.parse_stages(stages)
+        with self.job.file.open('rb') as job_file:
+            self.assertEqual(find_dockerfile_dir(job_file, 'analyse'), 'analyse')
+            job_file.seek(0)
+            with self.assertRaises(FileNotFoundError):
+                find_dockerfile_dir(job_file, 'report')
+
+    def test_stages_share_a_volume_on_one_runner_and_only_the_last_is_reviewed(self):
+        self.assertEqual([run.stage for run in self.job.runs.all()], ['prepare'])
+        docker_client = FakeDockerClient([(b'done\n', None)])
+        first = self._run_stage(docker_client, 0)
+        self.assertEqual(self.job.status_enum, Job.Status.RUNNING)
+        self.assertEqual(first.artifacts.name, '')
+        volumes = docker_client.containers.run_kwargs['volumes']
+        second = self._run_stage(docker_client, 1)
+        self.assertEqual(second.stage, 'analyse')
+        self.assertEqual(second.runner_node, first.runner_node)
+        self.assertEqual(docker_client.containers.run_kwargs['volumes'], volumes)
+        self.assertEqual(list(volumes), [self.job.volume_path()])
+        # Each stage builds its own image from its own directory
+        self.assertEqual(docker_client.images.builds, 2)
+        self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
         self.assertFalse(self.job.failed)
+        self.assertEqual((self.job.output.name, self.job.artifacts.name), (second.output.name, second.artifacts.name))
+        self.job.approve_output()
+        self.assertEqual(
+            list(self.job.runs.order_by('run_index').values_list('status', flat=True)),
+            [Job.Status.OUTPUT_REJECTED.name, Job.Status.RELEASED.name],
+        )
+
+    def test_failed_stage_fails_the_pipeline(self):
+        first = self._run_stage(FakeDockerClient([(None, b'No data\n')], exit_code=1), 0)
+        self.assertEqual(self.job.runs.count(), 1)
+        self.assertEqual(self.job.status_enum, Job.Status.PENDING_OUTPUT_REVIEW)
+        self.assertTrue(self.job.failed)
+        self.assertEqual(self.job.errors.name, first.errors.name)
+
+
+@override_settings(JOB_CONTAINER_MEM_LIMIT='1g', JOB_CONTAINER_CPU_QUOTA=None, JOB_SCHEDULER_MAX_RUNNING_PER_USER=0)
+class JobRunWindowTestCase(TestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('toejam', 'toejam@funkotron.net', 'toejam')
+        self.jobs = [self._create_job() for _ in range(2)]
+
+    def _create_job(self, **kwargs):
+        return Job.objects.create(
+            name='Hello Job',
+            description='Return output with Hello World text',
+            status=Job.Status.QUEUED.name,
+            owner=self.creator,
+            filename='hello.tar.gz',
+            file='hello.tar.gz',
+            submitted_at=timezone.now(),
+            **kwargs
+        )
+
+    def _schedule(self):
+        with mock.patch('jobs.runner.cluster_capacity', return_value=(16, 16 * 1024 * MB)):
+            return scheduler.schedule_jobs(mock.Mock())
+
+    def _local(self, *args):
+        return timezone.make_aware(datetime.datetime(*args))
+
+    @override_settings(JOB_OFF_PEAK_START='20:00', JOB_OFF_PEAK_END='06:00')
+    def test_off_peak_window_wraps_past_midnight(self):
+        self.assertEqual(scheduler.next_off_peak(self._local(2020, 3, 2, 12, 30)), self._local(2020, 3, 2, 20, 0))
+        self.assertEqual(scheduler.next_off_peak(self._local(2020, 3, 2, 23, 0)), self._local(2020, 3, 2, 23, 0))
+        self.assertEqual(scheduler.next_off_peak(self._local(2020, 3, 3, 5, 59)), self._local(2020, 3, 3, 5, 59))
+        with override_settings(JOB_OFF_PEAK_START='01:00', JOB_OFF_PEAK_END='05:00'):
+            self.assertEqual(scheduler.next_off_peak(self._local(2020, 3, 2, 6, 0)), self._local(2020, 3, 3, 1, 0))
+
+    def test_held_jobs_wait_for_their_time(self):
+        now = timezone.localtime()
+        outside = f'{(now + datetime.timedelta(hours=1)):%H:%M}', f'{(now + datetime.timedelta(hours=2)):%H:%M}'
+        inside = f'{(now - datetime.timedelta(hours=1)):%H:%M}', f'{(now + datetime.timedelta(hours=1)):%H:%M}'
+        Job.objects.filter(pk=self.jobs[0].pk).update(run_after=now + datetime.timedelta(hours=1))
+        Job.objects.filter(pk=self.jobs[1].pk).update(off_peak=True)
+        with override_settings(JOB_OFF_PEAK_START=outside[0], JOB_OFF_PEAK_END=outside[1]):
+            self.assertEqual(self._schedule(), [])
+        with override_settings(JOB_OFF_PEAK_START=inside[0], JOB_OFF_PEAK_END=inside[1]):
+            self.assertEqual(self._schedule(), [self.jobs[1]])
+        Job.objects.filter(pk=self.jobs[0].pk).update(run_after=now - datetime.timedelta(minutes=1))
+        self.assertEqual(self._schedule(), [self.jobs[0]])
+
+    def test_queue_position_and_estimated_start(self):
+        self.assertEqual(scheduler.queue_estimate(self.jobs[1]), (2, None))
+        for job in self.jobs:
+            JobPhaseTiming.objects.create(job=job, phase='run', started_at=timezone.now(), duration=600)
+        position, start = scheduler.queue_estimate(self.jobs[1])
+        self.assertEqual(position, 2)
+        self.assertAlmostEqual((start - timezone.now()).total_seconds(), 600, delta=5)
+        # A job held for later starts no earlier, and does not count ahead of those due before it
+        run_after = timezone.now() + datetime.timedelta(hours=3)
+        Job.objects.filter(pk=self.jobs[0].pk).update(run_after=run_after)
+        self.assertEqual(scheduler.queue_estimate(self.jobs[1])[0], 1)
+        self.jobs[0].refresh_from_db()
+        self.assertEqual(scheduler.queue_estimate(self.jobs[0]), (2, run_after))
+
+    @override_settings(RESTRICTED_ACCESS_GROUPS=None, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_detail_shows_queue_position(self):
+        Job.objects.filter(pk=self.jobs[1].pk).update(off_peak=True)
+        self.client.force_login(self.creator)
+        response = self.client.get(reverse('jobs:detail', args=(self.jobs[1].id,)))
+        self.assertContains(response, 'Queue Position')
+        self.assertContains(response, 'For the off-peak window')
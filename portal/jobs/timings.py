@@ -0,0 +1,39 @@
+import time
+import datetime
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from django_fsm_log.models import StateLog
+
+from .models import Job, JobPhaseTiming
+
+
+@contextmanager
+def phase(job, name):
+    """Record how long the enclosed block took as a phase of job, whether or not it succeeds"""
+    started_at = timezone.now()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if job is not None:
+            JobPhaseTiming.objects.create(job=job, phase=name, started_at=started_at, duration=time.monotonic() - start)
+
+def record_queue_phases(job):
+    """
+    Record the time a job about to start spent waiting: 'queue' from approval
+    until the scheduler admitted it, 'dispatch' from then until a worker
+    picked it up.
+    """
+    now = timezone.now()
+    queued = StateLog.objects.for_(job).filter(state=Job.Status.QUEUED.name).order_by('-timestamp').first()
+    dispatched_at = job.dispatched_at or now
+    if queued is not None:
+        _record(job, 'queue', queued.timestamp, dispatched_at)
+    if job.dispatched_at is not None:
+        _record(job, 'dispatch', job.dispatched_at, now)
+
+def _record(job, name, started_at, finished_at):
+    duration = max(finished_at - started_at, datetime.timedelta(0)).total_seconds()
+    JobPhaseTiming.objects.create(job=job, phase=name, started_at=started_at, duration=duration)
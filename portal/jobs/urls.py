@@ -15,5 +15,8 @@ urlpatterns = [
     path('file/<int:job_id>', views.job_file, name='job_file'),
     path('output/<int:job_id>', views.job_output, name='job_output'),
     path('errors/<int:job_id>', views.job_errors, name='job_errors'),
+    path('artifacts/<int:job_id>', views.job_artifacts, name='job_artifacts'),
+    path('build-log/<int:job_id>', views.job_build_log, name='job_build_log'),
+    path('tail/<int:job_id>', views.job_tail, name='job_tail'),
     path('create', views.CreateView.as_view(), name='create'),
 ]
@@ -0,0 +1,64 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from .models import JobResourceUsage
+
+
+FIELDS = ('cpu_seconds', 'peak_memory', 'block_read', 'block_written', 'network_received', 'network_sent')
+# How long to wait for a stream that has no more samples to end
+JOIN_TIMEOUT = 5
+
+
+@contextmanager
+def sample(job, samples):
+    """
+    Consume samples, the cumulative usage figures of the job's container, from
+    a background thread while the block runs, and record their peaks as the
+    job's resource usage. Reattaching to the same container later keeps the
+    higher figures.
+    """
+    peaks = dict.fromkeys(FIELDS, 0)
+    count = 0
+    stopped = threading.Event()
+    def consume():
+        nonlocal count
+        try:
+            for usage in samples:
+                for field, value in usage.items():
+                    peaks[field] = max(peaks[field], value)
+                count += 1
+                if stopped.is_set():
+                    break
+        except Exception as ex:
+            # Usage is nice to have, never worth failing the run over; the stats
+            # stream also raises urllib3's errors, e.g. a read timeout, unwrapped
+            print(f'Sampling job {job.id}: {ex!r}')
+    start = time.monotonic()
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join(JOIN_TIMEOUT)
+        if count:
+            _record(job, dict(peaks), count, time.monotonic() - start)
+
+def _record(job, peaks, count, wall_seconds):
+    usage, _ = JobResourceUsage.objects.get_or_create(job=job)
+    for field in FIELDS:
+        setattr(usage, field, max(getattr(usage, field), peaks[field]))
+    usage.samples += count
+    usage.wall_seconds += wall_seconds
+    usage.save()
+
+def percentiles(queryset, field, ranks):
+    """Return {rank: value} of field over the queryset's rows by the nearest-rank method, {} if there are none"""
+    if field == 'cpu_cores':
+        values = sorted(usage.cpu_cores for usage in queryset)
+    else:
+        values = sorted(queryset.values_list(field, flat=True))
+    if not values:
+        return {}
+    return {rank: values[max(-(-rank * len(values) // 100) - 1, 0)] for rank in ranks}
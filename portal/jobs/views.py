@@ -3,7 +3,7 @@ import json
 import base64
 
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, FileResponse
 from django.urls import reverse
 from django.views import View
 from django.views.generic.edit import FormView
@@ -27,6 +27,7 @@ from django_fsm_log.models import StateLog
 
 from .models import Job, Comment
 from .forms import JobSubmissionForm
+from . import scheduler
 
 
 def _belongs_to_restricted_access_groups(user):
@@ -45,7 +46,8 @@ def home(request):
 @login_required
 @user_passes_test(_belongs_to_restricted_access_groups)
 def index(request):
-    jobs = Job.objects.filter(Q(owner=request.user) | Q(collaborators__in=[request.user])).exclude(status=Job.Status.DELETED.name).order_by('-id') if not request.user.is_staff else Job.objects.exclude(status=Job.Status.DELETED.name).order_by('-id')
+    # The runs of array jobs are listed on their array job's page
+    jobs = Job.objects.filter(Q(owner=request.user) | Q(collaborators__in=[request.user])).exclude(status=Job.Status.DELETED.name).filter(parent=None).order_by('-id') if not request.user.is_staff else Job.objects.exclude(status=Job.Status.DELETED.name).filter(parent=None).order_by('-id')
     ctx = {
         'jobs': jobs,
     }
@@ -72,6 +74,11 @@ class CreateView(LoginRequiredMixin, UserPassesTestMixin, FormView):
                 filename=filename,
                 file=file,
                 submitted_at=timezone.now(),
+                cpus=form.cleaned_data['cpus'],
+                memory_mb=form.cleaned_data['memory_mb'],
+                timeout=form.cleaned_data['timeout'],
+                parameter_grid=form.cleaned_data['parameter_grid'],
+                stages=form.cleaned_data['stages'],
             )
         job.collaborators.set(collaborators)
         self.success_url = reverse('jobs:detail', args=(job.id,))
@@ -117,6 +124,56 @@ def job_errors(request, job_id):
         return HttpResponse(status=401)
 
 
+@login_required
+@user_passes_test(_belongs_to_restricted_access_groups)
+def job_artifacts(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
+    if not job.can_view(request.user):
+        return HttpResponse('Unauthorized', status=401)
+    if (request.user.is_staff or job.status_enum is Job.Status.RELEASED):
+        response = FileResponse(job.artifacts.open('rb'), content_type='application/tar+gzip')
+        response['Content-Disposition'] = f'inline; filename="{job.artifacts_filename()}"'
+        return response
+    else:
+        return HttpResponse(status=401)
+
+
+@login_required
+@user_passes_test(_belongs_to_restricted_access_groups)
+def job_build_log(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
+    if not job.can_view(request.user):
+        return HttpResponse('Unauthorized', status=401)
+    if (request.user.is_staff or job.status_enum is Job.Status.RELEASED):
+        response = HttpResponse(job.build_log, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'inline; filename="{job.build_log.name}"'
+        return response
+    else:
+        return HttpResponse(status=401)
+
+
+@staff_member_required
+def job_tail(request, job_id):
+    """Return the bytes of a job's output or errors after ?offset=, for polling a RUNNING job"""
+    job = get_object_or_404(Job, pk=job_id)
+    field = {'output': job.output, 'errors': job.errors}.get(request.GET.get('stream', 'output'))
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        offset = None
+    if field is None or offset is None:
+        return HttpResponse('Bad Request', status=400)
+    data = b''
+    if field.name:
+        with field.storage.open(field.name, 'rb') as log_file:
+            log_file.seek(offset)
+            data = log_file.read(settings.JOB_LOG_TAIL_MAX_BYTES)
+    response = HttpResponse(data, content_type='text/plain; charset=utf-8')
+    response['X-Log-Offset'] = offset + len(data)
+    response['X-Job-Status'] = job.status
+    return response
+
+
 @login_required
 def logout(request):
     auth_logout(request)
@@ -168,9 +225,12 @@ def details(request, job_id):
     except Comment.DoesNotExist:
         action_required = None
     status_nodes_widget = generate_status_nodes_widget(job.status_enum, action_required, job.failed)
+    queue_estimate = scheduler.queue_estimate(job) if job.status_enum is Job.Status.QUEUED else None
     ctx = {
         'job': job,
         'status_nodes_widget': status_nodes_widget,
+        'queue_position': queue_estimate[0] if queue_estimate else None,
+        'estimated_start': queue_estimate[1] if queue_estimate else None,
     }
     return render(request, 'jobs/detail.html', ctx)
 
@@ -186,6 +246,7 @@ state_transition_messages = {
     'reject_code': "The job's code was rejected.",
     'run_job': "The job has started running.",
     'error_job_run': "An error occurred while running the job.",
+    'cancel': "The job was cancelled.",
     'complete_job_run': "The job has successfully finished running.",
     'fail_job_run': "The job failed due to an error.",
     'approve_output': "The job's output was approved and released.",
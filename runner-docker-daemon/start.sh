@@ -15,6 +15,28 @@ if [ $DOCKER_TLS_VERIFY -eq 1 ]; then
     echo -e "$DOCKER_SERVER_TLSKEY" > server-key.pem
     ARGS="--tlsverify --tlscacert=ca.pem --tlscert=server-cert.pem --tlskey=server-key.pem"
 fi
+# Pull through a registry mirror on the LAN if one is configured, e.g.
+# REGISTRY_MIRROR=http://registry-mirror:5000
+if [ -n "$REGISTRY_MIRROR" ]; then
+    ARGS="$ARGS --registry-mirror=$REGISTRY_MIRROR --insecure-registry=${REGISTRY_MIRROR#*://}"
+fi
+# Job images are shared between daemons through a registry on the LAN, e.g.
+# JOB_IMAGE_REGISTRY=registry:5000
+if [ -n "$JOB_IMAGE_REGISTRY" ]; then
+    ARGS="$ARGS --insecure-registry=$JOB_IMAGE_REGISTRY"
+fi
+# Cache the packages builds download (apt, plain HTTP PyPI and CRAN mirrors,
+# ...) in a local squid, up to PACKAGE_CACHE_SIZE_MB megabytes on disk. Builds
+# reach it through the docker0 gateway, see RUNNER_PACKAGE_CACHE_PORT.
+if [ -n "$PACKAGE_CACHE_PORT" ]; then
+    sed -e "s/PACKAGE_CACHE_PORT/$PACKAGE_CACHE_PORT/" \
+        -e "s/PACKAGE_CACHE_SIZE_MB/${PACKAGE_CACHE_SIZE_MB:-10240}/" \
+        squid.conf > /etc/squid/squid.conf
+    mkdir -p /var/log/squid
+    chown -R squid:squid /var/cache/squid /var/log/squid
+    squid -z -N
+    squid
+fi
 # Start up dockerd in the background so we can do a few more things
 sh /usr/local/bin/dockerd-entrypoint.sh $ARGS &
 PID=$!
@@ -35,6 +57,11 @@ iptables -I DOCKER-USER -i $NETWORK_INTERFACE -j DROP
 echo $JOB_RESOURCES
 iptables -I DOCKER-USER -i $NETWORK_INTERFACE -d $JOB_RESOURCES -j ACCEPT
 
+# Jobs must not reach the package cache, it would let them out to anywhere
+if [ -n "$PACKAGE_CACHE_PORT" ]; then
+    iptables -I INPUT -i $NETWORK_INTERFACE -p tcp --dport $PACKAGE_CACHE_PORT -j DROP
+fi
+
 echo $(iptables -L -v -n)
 
 wait $PID